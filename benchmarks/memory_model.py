@@ -0,0 +1,174 @@
+# Measures the memory held by a hydrated tenant.
+#
+# Builds the records of one client with `--contracts` contracts of
+# `--versions` linear versions each, then hydrates them twice and reports the
+# traced allocations:
+#   dict     the model before compaction: parents only and a version graph
+#            of skip-pointer nodes, but plain __dict__ objects with string
+#            blob IDs and a BlobID object per reference
+#   compact  the current model: __slots__ classes, 32-byte blob IDs
+#            interned per client, shared BlobIDs and array-backed version
+#            graphs
+# Both keep only parents, so the reduction is that of the compact
+# representation alone.
+#
+#   python benchmarks/memory_model.py --contracts 10 --versions 2000
+import argparse
+import base64
+import gc
+import hashlib
+import os
+import sys
+import tracemalloc
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, _ROOT)
+sys.path.insert(1, os.path.join(_ROOT, 'demo_sign_contract'))
+import client_repository
+
+
+# The object model before compaction: the same parents-only version graph
+# with skip pointers, but plain __dict__ objects holding blob ID strings and
+# a BlobID object per reference.
+
+
+class _DictBlobID(object):
+
+    def __init__(self, bid, timestamp):
+        self.bid = bid
+        self.timestamp = timestamp
+
+
+class _DictVersionNode(object):
+    __slots__ = ('blob_id', 'parents', 'depth', 'level', 'skip')
+
+    def __init__(self, blob_id, parents, depth, level, skip):
+        self.blob_id = blob_id
+        self.parents = parents
+        self.depth = depth
+        self.level = level
+        self.skip = skip
+
+
+class _DictVersionGraph(object):
+
+    def __init__(self):
+        self._nodes = {}
+
+    def add(self, blob_id, parents) -> None:
+        for parent in parents:
+            if parent.bid not in self._nodes:
+                self.add(parent, [])
+        parent_bids = [p.bid for p in parents]
+        skip = []
+        depth = 0
+        level = 0
+        if parent_bids:
+            first = self._nodes[parent_bids[0]]
+            depth = first.depth + 1
+            level = 1 + max(self._nodes[p].level for p in parent_bids)
+            skip.append(first.blob_id.bid)
+            while len(skip) <= len(self._nodes[skip[-1]].skip):
+                skip.append(self._nodes[skip[-1]].skip[len(skip) - 1])
+        self._nodes[blob_id.bid] = _DictVersionNode(blob_id, parent_bids,
+                                                    depth, level, skip)
+
+
+class _DictVersion(object):
+
+    def __init__(self, blob_id, initial_blob_data, parents, alias, graph,
+                 storage, sequence):
+        self.blob_id = blob_id
+        self.sequence = sequence
+        self.initial_blob_data = initial_blob_data
+        self.parents = parents
+        self.alias = alias
+        self.graph = graph
+        self.storage = storage
+        self._previous_versions = None
+
+
+def _BlobId(seed: str) -> str:
+    return base64.urlsafe_b64encode(
+        hashlib.sha256(seed.encode('utf-8')).digest())[:-1].decode('ascii')
+
+
+def _Records(contracts: int, versions: int) -> list[dict]:
+    records = []
+    for c in range(contracts):
+        bids = [_BlobId(f'{c}/{v}') for v in range(versions)]
+        records.append({
+            'contract_id':
+            f'contract{c}',
+            'versions': [{
+                'blob_id': bid,
+                'initial_blob_data': bids[0],
+                'parents': [bids[v - 1]] if v else [],
+                'alias': 'doc',
+                'timestamp': 1700000000 + v,
+                'sequence': v + 1,
+            } for v, bid in enumerate(bids)]
+        })
+    return records
+
+
+# Hydrates like client_repository did before compaction.  Records are in
+# order, so every parent is added before its children.
+def _HydrateDict(records: list[dict]) -> list:
+    contracts = []
+    for contract in records:
+        graph = _DictVersionGraph()
+        versions = []
+        for version in contract['versions']:
+            blob_id = _DictBlobID(version['blob_id'], version['timestamp'])
+            parents = [_DictBlobID(p, 0) for p in version['parents']]
+            graph.add(blob_id, parents)
+            versions.append(
+                _DictVersion(blob_id,
+                             _DictBlobID(version['initial_blob_data'], 0),
+                             parents, version['alias'], graph, 'blob',
+                             version['sequence']))
+        contracts.append(versions)
+    return contracts
+
+
+def _HydrateCompact(records: list[dict]) -> list:
+    keys = {}
+    return [client_repository.ContractFromRecord(c, keys) for c in records]
+
+
+# Returns the bytes still allocated by `hydrate(records)` while its result
+# is alive.
+def _Measure(hydrate, records: list[dict]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = hydrate(records)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return used
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--contracts', type=int, default=10)
+    parser.add_argument('--versions', type=int, default=1000)
+    args = parser.parse_args()
+
+    records = _Records(args.contracts, args.versions)
+    total = args.contracts * args.versions
+    # The dict objects reuse the record's strings, which are allocated
+    # before measuring, so this understates the dict model's size.
+    dict_model = _Measure(_HydrateDict, records)
+    compact = _Measure(_HydrateCompact, records)
+    print(f'{total} versions in {args.contracts} contracts')
+    for name, used in (('dict', dict_model), ('compact', compact)):
+        print(f'{name:>8}: {used / 2**20:9.1f} MiB '
+              f'{used / total:9.0f} B/version')
+    print(f'reduction: {dict_model / compact:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+# End-to-end latency benchmarks against a fake Walrus.
+#
+# For every DB size a child process generates a local DB of that many
+# versions (10 contracts of 100 linear versions per client), stores blobs
+# with fake_walrus and times:
+#   load              local_db.LoadDatabase
+#   upload            UploadFileOnVersion of a new file on a random version
+#   fetch             FetchFileByVersion of an uploaded version, cache cold
+#   fetch_cached      the same fetch again, from the blob cache
+#   query             QueryVersions, one page of 100 versions
+#   get_clients       GET /get_clients on the demo server
+#   get_clients_page  GET /get_clients?limit=100 from a random cursor
+# The first call of each operation warms the caches and is not counted.
+# Latency percentiles are reported per operation along with the DB size on
+# disk, so the rows show how each operation scales with the DB.
+#
+# Walrus is either the in-memory fake publisher (--transport http) or the
+# fake `walrus` binary (--transport cli); --store-latency and
+# --read-latency add simulated network time to every call.
+#
+#   python benchmarks/suite.py --sizes 1000,10000,100000,1000000
+#   python benchmarks/suite.py --transport cli --store-latency 0.05
+#   python benchmarks/suite.py --json out.json \
+#       --baseline benchmarks/baseline.json
+#
+# With --baseline the run fails if an operation's p50 is more than
+# --max-regression times the baseline's.
+import argparse
+import base64
+import hashlib
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CONTRACTS_PER_CLIENT = 10
+_VERSIONS_PER_CONTRACT = 100
+_OPERATIONS = ('load', 'upload', 'fetch', 'fetch_cached', 'query',
+               'get_clients', 'get_clients_page')
+# p50s below this many seconds are too noisy to compare to a baseline.
+_MIN_COMPARED_SECONDS = 0.002
+
+
+def _BlobId(seed: str) -> str:
+    return base64.urlsafe_b64encode(
+        hashlib.sha256(seed.encode('utf-8')).digest())[:-1].decode('ascii')
+
+
+# Returns a DB of about `versions` versions.
+def _GenerateDatabase(versions: int) -> dict:
+    per_client = _CONTRACTS_PER_CLIENT * _VERSIONS_PER_CONTRACT
+    clients = []
+    for c in range(max(1, versions // per_client)):
+        contracts = []
+        for k in range(_CONTRACTS_PER_CLIENT):
+            bids = [
+                _BlobId(f'{c}/{k}/{v}') for v in range(_VERSIONS_PER_CONTRACT)
+            ]
+            contracts.append({
+                'contract_id':
+                f'contract{k}',
+                'name':
+                f'Contract {k}',
+                'versions': [{
+                    'blob_id': bid,
+                    'initial_blob_data': bids[0],
+                    'parents': [bids[v - 1]] if v else [],
+                    'alias': f'doc{k}',
+                    'timestamp': 1700000000 + v,
+                    'sequence': v + 1,
+                } for v, bid in enumerate(bids)]
+            })
+        clients.append({
+            'client_id': f'client{c:07d}',
+            'name': f'Client {c}',
+            'contracts': contracts
+        })
+    return {'clients': clients}
+
+
+def _Percentile(samples: list[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def _Summary(samples: list[float]) -> dict:
+    return {
+        'n': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': _Percentile(samples, 50),
+        'p90': _Percentile(samples, 90),
+        'p99': _Percentile(samples, 99),
+    }
+
+
+# Calls `fn(i)` `samples + 1` times and returns the durations of all but the
+# first call.
+def _Time(fn, samples: int) -> list[float]:
+    durations = []
+    for i in range(samples + 1):
+        start = time.perf_counter()
+        fn(i)
+        durations.append(time.perf_counter() - start)
+    return durations[1:]
+
+
+# Sends GETs over one keep-alive connection, like a browser would.
+class _Client(object):
+
+    def __init__(self, port: int):
+        self._conn = http.client.HTTPConnection('127.0.0.1', port)
+
+    def get(self, path: str) -> bytes:
+        self._conn.request('GET', path)
+        response = self._conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f'GET {path}: {response.status} {body!r}')
+        return body
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+# Benchmarks one DB size in the current process, which must be fresh.  Runs
+# in `workdir`.  Returns {'db_bytes': ..., 'ops': {operation: summary}}.
+def _RunSize(args, versions: int, workdir: str) -> dict:
+    os.chdir(workdir)
+    db = _GenerateDatabase(versions)
+    with open('local_db.json', 'w') as f:
+        json.dump(db, f)
+    os.environ['LOCAL_DB_BACKEND'] = args.backend
+    os.environ['WALRUS_BLOB_CACHE_DIR'] = os.path.join(workdir, 'blob_cache')
+    for path in ('', 'demo_sign_contract', 'demo_sign_contract/server'):
+        sys.path.insert(1, os.path.join(_ROOT, path))
+    import fake_walrus
+    import local_db
+    import local_server_main
+    import model
+    import versioned_walrus
+    import walrus_transport
+    from http.server import ThreadingHTTPServer
+
+    if args.backend == 'sqlite':
+        import sqlite_db
+        sqlite_db.MigrateFromJson(local_db.DB_PATH, local_db.SQLITE_DB_PATH)
+        db_path = local_db.SQLITE_DB_PATH
+    else:
+        db_path = local_db.DB_PATH
+    db_bytes = os.path.getsize(db_path)
+
+    publisher = None
+    if args.transport == 'http':
+        publisher = fake_walrus.FakePublisher(
+            store_latency=args.store_latency,
+            read_latency=args.read_latency,
+            jitter=args.jitter)
+        publisher.start()
+        transport = walrus_transport.HttpTransport(publisher.url)
+    else:
+        os.environ['FAKE_WALRUS_DIR'] = os.path.join(workdir, 'walrus')
+        os.environ['FAKE_WALRUS_STORE_LATENCY'] = str(args.store_latency)
+        os.environ['FAKE_WALRUS_READ_LATENCY'] = str(args.read_latency)
+        os.environ['FAKE_WALRUS_JITTER'] = str(args.jitter)
+        transport = walrus_transport.SubprocessTransport(
+            os.path.join(_ROOT, 'fake_walrus.py'),
+            os.path.join(_ROOT, 'client_config.yaml'))
+    versioned_walrus.SetTransport(transport)
+
+    local_server_main.UPLOAD_DIR = os.path.join(workdir, 'tmp')
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0),
+                                local_server_main.RequestHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    http_client = _Client(httpd.server_address[1])
+
+    rng = random.Random(versions)
+    clients = db['clients']
+    del db
+
+    def random_version() -> tuple:
+        client = rng.choice(clients)
+        version = rng.choice(rng.choice(client['contracts'])['versions'])
+        return client['client_id'], version['blob_id']
+
+    uploaded = []
+
+    def upload(i):
+        client_id, version_id = random_version()
+        path = os.path.join(workdir, f'upload{i}.txt')
+        with open(path, 'wb') as f:
+            f.write(f'{versions} {i} '.encode('utf-8') + os.urandom(1024))
+        uploaded.append(
+            versioned_walrus.UploadFileOnVersion(path, client_id,
+                                                 version_id))
+
+    def query(i):
+        versioned_walrus.QueryVersions(uploaded[i % len(uploaded)],
+                                       model.QueryOptions(limit=100))
+
+    def get_clients_page(i):
+        client_id = rng.choice(clients)['client_id']
+        cursor = base64.urlsafe_b64encode(
+            client_id.encode('utf-8')).decode('ascii')
+        http_client.get(f'/get_clients?limit=100&cursor={cursor}')
+
+    ops = {}
+    ops['load'] = _Time(lambda i: local_db.LoadDatabase(), args.samples)
+    ops['upload'] = _Time(upload, args.samples)
+    ops['fetch'] = _Time(
+        lambda i: versioned_walrus.FetchFileByVersion(uploaded[i]),
+        args.samples)
+    ops['fetch_cached'] = _Time(
+        lambda i: versioned_walrus.FetchFileByVersion(uploaded[i]),
+        args.samples)
+    ops['query'] = _Time(query, args.samples)
+    ops['get_clients'] = _Time(lambda i: http_client.get('/get_clients'),
+                               args.samples)
+    ops['get_clients_page'] = _Time(get_clients_page, args.samples)
+
+    http_client.close()
+    httpd.shutdown()
+    versioned_walrus.SetTransport(None)
+    if publisher is not None:
+        publisher.stop()
+    return {
+        'db_bytes': db_bytes,
+        'ops': {op: _Summary(samples)
+                for op, samples in ops.items()}
+    }
+
+
+def _PrintResults(results: dict) -> None:
+    print(f'{"versions":>9} {"db MiB":>8} {"operation":<17} {"n":>4} '
+          f'{"mean ms":>9} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9}')
+    for versions, result in results.items():
+        for op in _OPERATIONS:
+            s = result['ops'][op]
+            print(f'{versions:>9} {result["db_bytes"] / 2**20:8.1f} '
+                  f'{op:<17} {s["n"]:>4} {s["mean"] * 1000:9.2f} '
+                  f'{s["p50"] * 1000:9.2f} {s["p90"] * 1000:9.2f} '
+                  f'{s["p99"] * 1000:9.2f}')
+
+
+# Returns a line per operation whose p50 regressed by more than
+# `max_regression` times against `baseline`.
+def _Regressions(results: dict, baseline: dict,
+                 max_regression: float) -> list[str]:
+    regressions = []
+    for versions, result in results.items():
+        base = baseline['results'].get(versions)
+        if base is None:
+            continue
+        for op, summary in result['ops'].items():
+            if op not in base['ops']:
+                continue
+            was = base['ops'][op]['p50']
+            now = summary['p50']
+            if (now > _MIN_COMPARED_SECONDS and
+                    now > max(was, _MIN_COMPARED_SECONDS) * max_regression):
+                regressions.append(f'{versions} versions {op}: p50 '
+                                   f'{was * 1000:.2f} ms -> '
+                                   f'{now * 1000:.2f} ms')
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',
+                        default='1000,10000,100000',
+                        help='comma separated DB sizes in versions')
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--backend',
+                        choices=('json', 'sqlite', 'journal'),
+                        default='json')
+    parser.add_argument('--transport',
+                        choices=('http', 'cli'),
+                        default='http')
+    parser.add_argument('--store-latency', type=float, default=0)
+    parser.add_argument('--read-latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--max-regression', type=float, default=3.0)
+    # Internal: benchmark one size and write its result to a file.
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        versions, out = args.child
+        workdir = tempfile.mkdtemp(prefix='walrus-bench-')
+        try:
+            result = _RunSize(args, int(versions), workdir)
+        finally:
+            os.chdir(_ROOT)
+            shutil.rmtree(workdir, ignore_errors=True)
+        with open(out, 'w') as f:
+            json.dump(result, f)
+        return
+
+    # Each size runs in its own process so caches and module state start
+    # cold every time.
+    results = {}
+    for versions in args.sizes.split(','):
+        versions = str(int(float(versions)))
+        fd, out = tempfile.mkstemp(prefix='walrus-bench-', suffix='.json')
+        os.close(fd)
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__)] +
+                           sys.argv[1:] + ['--child', versions, out],
+                           check=True)
+            with open(out, 'r') as f:
+                results[versions] = json.load(f)
+        finally:
+            os.remove(out)
+
+    _PrintResults(results)
+    report = {
+        'config': {
+            'backend': args.backend,
+            'transport': args.transport,
+            'store_latency': args.store_latency,
+            'read_latency': args.read_latency,
+            'samples': args.samples,
+        },
+        'results': results
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        for key in ('backend', 'transport', 'store_latency',
+                    'read_latency'):
+            if baseline['config'][key] != report['config'][key]:
+                sys.exit(f'{args.baseline} was run with {key}='
+                         f'{baseline["config"][key]}')
+        regressions = _Regressions(results, baseline, args.max_regression)
+        for line in regressions:
+            print(f'Regression: {line}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
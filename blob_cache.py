@@ -0,0 +1,167 @@
+# Content-addressed on-disk cache of Walrus blobs.
+#
+# Walrus blob IDs are derived from the blob content, so a cached blob never
+# goes stale.  Entries are files named by blob ID; the cache is bounded by
+# total size and evicts the least recently used entries.  Files are written
+# to a temporary name and renamed into place, so a reader never sees a
+# partial blob.  Cached blobs are returned as read-only mmaps, which avoids
+# copying large contracts into Python bytes.
+import collections
+import mmap
+import os
+import tempfile
+import threading
+import urllib.parse
+
+
+# Maps an open file read-only.  Empty files cannot be mapped and are returned
+# as b''.
+def _Map(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BlobCache(object):
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # blob ID -> size, least recently used first.
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    # Rebuilds the LRU order from the files left by earlier runs, using
+    # their modification times (refreshed on every hit).
+    def _scan(self) -> None:
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            stat = entry.stat()
+            found.append((stat.st_mtime, urllib.parse.unquote(entry.name),
+                          stat.st_size))
+        for _, blob_id, size in sorted(found):
+            self._entries[blob_id] = size
+            self._total_bytes += size
+
+    def _path(self, blob_id: str) -> str:
+        return os.path.join(self.directory,
+                            urllib.parse.quote(blob_id, safe=''))
+
+    def __contains__(self, blob_id: str) -> bool:
+        with self._lock:
+            return blob_id in self._entries
+
+    # Returns an open file for a cached blob, or None on a miss.
+    def open(self, blob_id: str, count: bool = True):
+        with self._lock:
+            if blob_id not in self._entries:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self.hits += 1
+            self._entries.move_to_end(blob_id)
+            path = self._path(blob_id)
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                # Removed behind our back; treat as a miss.
+                self._total_bytes -= self._entries.pop(blob_id)
+                if count:
+                    self.hits -= 1
+                    self.misses += 1
+                return None
+            os.utime(path)
+            return f
+
+    # Returns a read-only mmap of a cached blob, or None on a miss.  Empty
+    # blobs cannot be mapped and are returned as b''.
+    def get(self, blob_id: str, count: bool = True):
+        f = self.open(blob_id, count)
+        if f is None:
+            return None
+        with f:
+            return _Map(f)
+
+    # Returns a cached blob like get(), filling the cache with `write` (see
+    # put()) on a miss.
+    def get_or_put(self, blob_id: str, write):
+        data = self.get(blob_id)
+        if data is None:
+            data = self.put(blob_id, write)
+        return data
+
+    # Returns a new temporary path inside the cache directory.  Write a blob
+    # there and pass it to commit(), or remove it.
+    def temp_path(self) -> str:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        os.close(fd)
+        return tmp_path
+
+    # Moves a fully written temporary file into the cache as `blob_id`.
+    # Returns the blob like get().  It is mapped before the entry can be
+    # evicted, so it stays readable even if another commit evicts it at
+    # once.
+    def commit(self, blob_id: str, tmp_path: str):
+        with open(tmp_path, 'rb') as f:
+            data = _Map(f)
+            size = len(data)
+            with self._lock:
+                os.replace(tmp_path, self._path(blob_id))
+                if blob_id in self._entries:
+                    self._total_bytes -= self._entries.pop(blob_id)
+                self._entries[blob_id] = size
+                self._total_bytes += size
+                self._evict()
+        return data
+
+    # Adds a blob and returns it like get().  `write` is called with a
+    # temporary path inside the cache directory and must write the blob
+    # content there.
+    def put(self, blob_id: str, write):
+        tmp_path = self.temp_path()
+        try:
+            write(tmp_path)
+            return self.commit(blob_id, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Adds a blob from bytes.
+    def put_bytes(self, blob_id: str, data: bytes):
+
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        return self.put(blob_id, write)
+
+    # Drops least recently used entries until the cache fits.  The newest
+    # entry is always kept, even if it alone is larger than the bound.
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            blob_id, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(blob_id))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+            }
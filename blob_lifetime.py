@@ -0,0 +1,408 @@
+# Keeps Walrus blobs alive for as long as the versions using them need.
+#
+# Uploads store blobs for only INITIAL_EPOCHS epochs.  The end epoch of each
+# store is recorded in a LifetimeIndex, an append-only file of JSON lines
+# next to the local DB, and a LifetimeManager thread keeps a min-heap of the
+# upcoming expiries.  When blobs get within RENEW_MARGIN epochs of expiring
+# it decides which of them are still needed, by the policy of the contracts
+# using them, and extends those in batches, off the request path.  Blobs
+# only used by old drafts are left to lapse.
+#
+# A blob that comes due while no version needs it is only looked at again
+# at its end epoch, when it is let go, unless recheck() is told about a
+# version using it first.  versioned_walrus calls recheck() for every
+# committed version, so a blob stored just before its version is committed
+# is still extended.
+#
+# Blobs whose Sui object is not known, because Walrus answered the store
+# with `alreadyCertified` (the content was certified by an object we do not
+# own), are recorded as unmanaged: they cannot be extended, and are stored
+# again by the next upload of their content once they have expired.
+#
+# The default policy keeps the blobs of the latest KEEP_LATEST versions of a
+# contract (their chunks, packs and signature batches included) alive for
+# KEEP_EPOCHS more epochs; SetPolicy() overrides it per contract.
+#
+# Walrus has no clock call, so the current epoch is estimated from the start
+# epoch of the latest store reply plus the time since, in EPOCH_SECONDS.
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+import model
+import packing
+
+logger = logging.getLogger(__name__)
+
+# Lifetime of newly stored blobs, in epochs.
+INITIAL_EPOCHS = int(os.environ.get('WALRUS_INITIAL_EPOCHS', 1))
+# Blobs are extended once they are this many epochs from expiring.
+RENEW_MARGIN = int(os.environ.get('WALRUS_RENEW_MARGIN_EPOCHS', 1))
+# Length of a Walrus epoch.
+EPOCH_SECONDS = float(os.environ.get('WALRUS_EPOCH_SECONDS', 24 * 60 * 60))
+# How often the manager looks for blobs to extend.
+CHECK_SECONDS = float(os.environ.get('WALRUS_LIFETIME_CHECK_SECONDS', 60))
+# Most blobs extended per batch.
+BATCH_SIZE = 64
+KEEP_LATEST = int(os.environ.get('WALRUS_KEEP_LATEST', 3))
+KEEP_EPOCHS = int(os.environ.get('WALRUS_KEEP_EPOCHS', 10))
+
+
+class Policy(object):
+
+    # The latest `keep_latest` versions of a contract are kept for
+    # `keep_epochs` epochs past the current one, older versions for
+    # `draft_epochs` (0 lets them lapse).
+    def __init__(self,
+                 keep_latest: int = KEEP_LATEST,
+                 keep_epochs: int = KEEP_EPOCHS,
+                 draft_epochs: int = 0):
+        self.keep_latest = keep_latest
+        self.keep_epochs = keep_epochs
+        self.draft_epochs = draft_epochs
+
+
+DEFAULT_POLICY = Policy()
+# (client ID, contract ID) -> Policy
+_policies = {}
+
+
+def SetPolicy(client_id: str, contract_id: str, policy: Policy) -> None:
+    _policies[(client_id, contract_id)] = policy
+
+
+def PolicyFor(client_id: str, contract_id: str) -> Policy:
+    return _policies.get((client_id, contract_id), DEFAULT_POLICY)
+
+
+# Returns (end epoch, Sui object ID, start epoch) from a Walrus store reply.
+# Values the reply does not carry are None; `alreadyCertified` replies carry
+# no object ID.
+def LifetimeFromStoreResult(json_result_dict: dict) -> tuple:
+    newly_created = json_result_dict.get('newlyCreated')
+    if newly_created:
+        blob_object = newly_created.get('blobObject', {})
+        storage = blob_object.get('storage', {})
+        return (storage.get('endEpoch'), blob_object.get('id'),
+                storage.get('startEpoch'))
+    already_certified = json_result_dict.get('alreadyCertified') or {}
+    return already_certified.get('endEpoch'), None, None
+
+
+class LifetimeIndex(object):
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Blob ID -> {'end_epoch', 'object_id', 'children'}
+        self._blobs = {}
+        # (epoch, time it was seen)
+        self._clock = None
+        self._listeners = []
+        lines = 0
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash.
+                        continue
+                    lines += 1
+                    self._apply(entry)
+        if lines > 2 * len(self._blobs) + 100:
+            self._compact()
+
+    def _apply(self, entry: dict) -> None:
+        if 'epoch' in entry:
+            if self._clock is None or entry['epoch'] >= self._clock[0]:
+                self._clock = (entry['epoch'], entry['seen'])
+            return
+        blob = self._blobs.setdefault(entry['blob_id'], {
+            'end_epoch': None,
+            'object_id': None,
+            'managed': True,
+            'children': []
+        })
+        if entry.get('end_epoch') is not None:
+            blob['end_epoch'] = max(blob['end_epoch'] or 0,
+                                    entry['end_epoch'])
+        if entry.get('object_id'):
+            blob['object_id'] = entry['object_id']
+            blob['managed'] = True
+        elif entry.get('managed') is False and not blob['object_id']:
+            blob['managed'] = False
+        if entry.get('children'):
+            blob['children'] = entry['children']
+
+    # Rewrites the file with one line per blob.
+    def _compact(self) -> None:
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            if self._clock is not None:
+                f.write(
+                    json.dumps({
+                        'epoch': self._clock[0],
+                        'seen': self._clock[1]
+                    }) + '\n')
+            for blob_id, blob in self._blobs.items():
+                f.write(json.dumps(dict(blob, blob_id=blob_id)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    # Calls `listener(blob_id, end_epoch)` whenever a blob's end epoch is
+    # recorded.
+    def add_listener(self, listener) -> None:
+        with self._lock:
+            self._listeners.append(listener)
+
+    # Records what is known about blobs, given as dicts with a 'blob_id'
+    # and any of 'end_epoch', 'object_id', 'managed' (False for blobs whose
+    # object is not ours) and 'children' (the blobs a chunk manifest
+    # lists).  All entries are appended in one write.
+    def record(self, entries: list[dict]) -> None:
+        if not entries:
+            return
+        with self._lock:
+            for entry in entries:
+                self._apply(entry)
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(e) + '\n' for e in entries))
+            listeners = list(self._listeners)
+            ends = [(e['blob_id'], self._blobs[e['blob_id']]['end_epoch'])
+                    for e in entries if e.get('end_epoch') is not None]
+        for listener in listeners:
+            for blob_id, end_epoch in ends:
+                listener(blob_id, end_epoch)
+
+    # Records the current epoch seen in a store reply.
+    def observe_epoch(self, epoch: int) -> None:
+        with self._lock:
+            if self._clock is not None and self._clock[0] >= epoch:
+                return
+            self._clock = (epoch, time.time())
+            with open(self.path, 'a') as f:
+                f.write(
+                    json.dumps({
+                        'epoch': epoch,
+                        'seen': self._clock[1]
+                    }) + '\n')
+
+    # Returns the estimated current epoch, or None before the first store.
+    def current_epoch(self) -> int:
+        with self._lock:
+            if self._clock is None:
+                return None
+            epoch, seen = self._clock
+        return epoch + max(0, int((time.time() - seen) // EPOCH_SECONDS))
+
+    # Returns a copy of what is known about a blob, or None.
+    def get(self, blob_id: str) -> dict:
+        with self._lock:
+            blob = self._blobs.get(blob_id)
+            return dict(blob) if blob is not None else None
+
+    # Returns False if `blob_id`, or a blob it lists, is known to have
+    # expired.  Blobs the index knows nothing about are assumed alive.
+    def alive(self, blob_id: str) -> bool:
+        now = self.current_epoch()
+        if now is None:
+            return True
+        pending = [blob_id]
+        seen = set()
+        while pending:
+            blob = self.get(pending.pop())
+            if blob is None:
+                continue
+            if blob['end_epoch'] is not None and blob['end_epoch'] <= now:
+                return False
+            for child in blob['children']:
+                if child not in seen:
+                    seen.add(child)
+                    pending.append(child)
+        return True
+
+    # Returns (end epoch, blob ID) of every blob with a known end epoch.
+    def expiries(self) -> list[tuple]:
+        with self._lock:
+            return [(blob['end_epoch'], blob_id)
+                    for blob_id, blob in self._blobs.items()
+                    if blob['end_epoch'] is not None]
+
+
+# Returns the blobs a version record's content and signatures are stored in:
+# the batch of every signer (`sig_blob_id_<signer>`), and `sig_blob_id` of
+# records signed before anchors were kept per signer.
+def _VersionBlobs(version: dict) -> list[str]:
+    blob_id = version['blob_id']
+    if version.get('storage') == model.STORAGE_PACKED:
+        blob_id = packing.ParsePackedBlobId(blob_id)[0]
+    blobs = [blob_id]
+    for key, value in version.items():
+        if value and (key == 'sig_blob_id' or
+                      key.startswith('sig_blob_id_')):
+            blobs.append(value)
+    return blobs
+
+
+class LifetimeManager(object):
+
+    # `get_transport()` returns the transport to extend blobs with and
+    # `list_clients()` the client records to apply the policies to.
+    def __init__(self,
+                 index: LifetimeIndex,
+                 get_transport,
+                 list_clients,
+                 policy_for=PolicyFor,
+                 interval: float = CHECK_SECONDS):
+        self.index = index
+        self._get_transport = get_transport
+        self._list_clients = list_clients
+        self._policy_for = policy_for
+        self.interval = interval
+        self._lock = threading.Lock()
+        # (epoch to check at, blob ID, end epoch); entries whose end epoch
+        # has changed since are skipped when popped.
+        self._heap = [(end_epoch - RENEW_MARGIN, blob_id, end_epoch)
+                      for end_epoch, blob_id in index.expiries()]
+        heapq.heapify(self._heap)
+        self._stop = threading.Event()
+        self._thread = None
+        index.add_listener(self._push)
+
+    # Schedules a check of a blob, by default RENEW_MARGIN epochs before
+    # it expires.
+    def _push(self, blob_id: str, end_epoch: int, at: int = None) -> None:
+        if at is None:
+            at = end_epoch - RENEW_MARGIN
+        with self._lock:
+            heapq.heappush(self._heap, (at, blob_id, end_epoch))
+
+    # Checks the blobs of version records (and the blobs they list) on the
+    # next run.  Called when versions are committed, so blobs that came due
+    # before their version was are extended.
+    def recheck(self, versions: list[dict]) -> None:
+        pending = [b for version in versions for b in _VersionBlobs(version)]
+        seen = set()
+        while pending:
+            blob_id = pending.pop()
+            if blob_id in seen:
+                continue
+            seen.add(blob_id)
+            blob = self.index.get(blob_id)
+            if blob is None or blob['end_epoch'] is None:
+                continue
+            self._push(blob_id, blob['end_epoch'])
+            pending.extend(blob['children'])
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='blob_lifetime',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning('extending blobs failed: %s', e)
+
+    # Pops the blobs to check at `now`.
+    def _due(self, now: int) -> list[tuple]:
+        due = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, blob_id, end_epoch = heapq.heappop(self._heap)
+                blob = self.index.get(blob_id)
+                if blob is not None and blob['end_epoch'] == end_epoch:
+                    due[blob_id] = blob
+        return list(due.items())
+
+    # Returns blob ID -> the epoch it must live until, per the policies.
+    def _wanted(self, now: int) -> dict:
+        wanted = {}
+
+        def want(blob_id: str, epoch: int) -> None:
+            if wanted.get(blob_id, 0) >= epoch:
+                return
+            wanted[blob_id] = epoch
+            blob = self.index.get(blob_id)
+            for child in blob['children'] if blob else []:
+                want(child, epoch)
+
+        for client in self._list_clients():
+            for contract in client['contracts']:
+                policy = self._policy_for(client['client_id'],
+                                          contract['contract_id'])
+                versions = contract['versions']
+                latest = len(versions) - policy.keep_latest
+                for i, version in enumerate(versions):
+                    epochs = (policy.keep_epochs
+                              if i >= latest else policy.draft_epochs)
+                    if epochs > 0:
+                        for blob_id in _VersionBlobs(version):
+                            want(blob_id, now + epochs)
+        return wanted
+
+    # Extends the blobs that expire soon and are still wanted.  Returns the
+    # number of blobs extended.
+    def run_once(self) -> int:
+        now = self.index.current_epoch()
+        if now is None:
+            return 0
+        due = self._due(now)
+        if not due:
+            return 0
+        wanted = self._wanted(now)
+        extensions = []
+        for blob_id, blob in due:
+            target = wanted.get(blob_id)
+            if target is None or target <= blob['end_epoch']:
+                if blob['end_epoch'] > now:
+                    # Its version may not be committed yet; recheck() moves
+                    # the check forward if it is.
+                    self._push(blob_id, blob['end_epoch'],
+                               at=blob['end_epoch'])
+                else:
+                    logger.debug('let blob %s lapse at epoch %d', blob_id,
+                                 blob['end_epoch'])
+            elif not blob['managed'] or blob['object_id'] is None:
+                logger.info('cannot extend unmanaged blob %s', blob_id)
+            else:
+                extensions.append(
+                    (blob_id, blob['object_id'], blob['end_epoch'],
+                     target - blob['end_epoch']))
+        extended = 0
+        for start in range(0, len(extensions), BATCH_SIZE):
+            batch = extensions[start:start + BATCH_SIZE]
+            errors = self._get_transport().extend_blobs([
+                (object_id, epochs) for _, object_id, _, epochs in batch
+            ])
+            entries = []
+            for blob_id, object_id, end_epoch, epochs in batch:
+                if object_id in errors:
+                    logger.warning('extending blob %s failed: %s', blob_id,
+                                   errors[object_id])
+                    # Retried on the next check.
+                    self._push(blob_id, end_epoch)
+                    continue
+                entries.append({
+                    'blob_id': blob_id,
+                    'end_epoch': end_epoch + epochs
+                })
+            self.index.record(entries)
+            extended += len(entries)
+        if extended:
+            logger.info('extended %d blobs', extended)
+        return extended
@@ -0,0 +1,114 @@
+# Content-defined chunking for delta uploads.
+#
+# Files are split where a rolling gear hash of the content hits a boundary
+# pattern (FastCDC style), so an edit only changes the chunks around it and
+# the rest of the file produces the same chunks as before.  Each chunk is
+# stored as its own Walrus blob and a small manifest blob lists them in
+# order:
+#
+#   {"format": "versioned-walrus-chunks", "version": 1, "size": 1234,
+#    "chunks": [["<blob id>", <length>], ...]}
+#
+# The manifest of a sealed version has "sealed": true when each chunk was
+# sealed on its own (see sealing.py); lengths are then those of the sealed
+# chunks and "size" their sum.
+import hashlib
+import json
+
+MANIFEST_FORMAT = 'versioned-walrus-chunks'
+
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+
+_READ_SIZE = 1024 * 1024
+_MASK_64 = (1 << 64) - 1
+
+
+def _GearTable() -> list[int]:
+    return [
+        int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'little')
+        for i in range(256)
+    ]
+
+
+_GEAR = _GearTable()
+
+
+# Returns the length of the first chunk of `data`.  `data` must hold at least
+# `max_size` bytes unless it is the end of the file.
+def _CutPoint(data, min_size: int, avg_size: int, max_size: int) -> int:
+    n = len(data)
+    if n <= min_size:
+        return n
+    end = min(n, max_size)
+    # Normalized chunking: a stricter mask before the average size and a
+    # looser one after it keeps chunk sizes close to the average.
+    bits = avg_size.bit_length() - 1
+    strict_mask = ((1 << (bits + 1)) - 1) << (63 - bits)
+    loose_mask = ((1 << (bits - 1)) - 1) << (65 - bits)
+    gear = _GEAR
+    h = 0
+    i = min_size
+    middle = min(avg_size, end)
+    while i < middle:
+        h = ((h << 1) + gear[data[i]]) & _MASK_64
+        if not h & strict_mask:
+            return i + 1
+        i += 1
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & _MASK_64
+        if not h & loose_mask:
+            return i + 1
+        i += 1
+    return end
+
+
+# Yields the chunks of a binary file object, reading it incrementally.
+def IterChunks(f,
+               min_size: int = MIN_CHUNK_SIZE,
+               avg_size: int = AVG_CHUNK_SIZE,
+               max_size: int = MAX_CHUNK_SIZE):
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            block = f.read(max(_READ_SIZE, max_size))
+            if not block:
+                eof = True
+            buffer += block
+        if not buffer:
+            return
+        cut = _CutPoint(buffer, min_size, avg_size, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def BuildManifest(chunks: list[tuple], sealed: bool = False) -> bytes:
+    manifest = {
+        'format': MANIFEST_FORMAT,
+        'version': 1,
+        'size': sum(length for _, length in chunks),
+        'chunks': [[blob_id, length] for blob_id, length in chunks],
+    }
+    if sealed:
+        manifest['sealed'] = True
+    return json.dumps(manifest).encode('utf-8')
+
+
+def _LoadManifest(data: bytes) -> dict:
+    manifest = json.loads(bytes(data))
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError('Not a chunk manifest')
+    return manifest
+
+
+# Returns the [(blob_id, length)] list of a manifest.
+def ParseManifest(data: bytes) -> list[tuple]:
+    return [(blob_id, length)
+            for blob_id, length in _LoadManifest(data)['chunks']]
+
+
+# Returns True if the chunks of a manifest were sealed one by one.
+def ChunksSealed(data: bytes) -> bool:
+    return bool(_LoadManifest(data).get('sealed'))
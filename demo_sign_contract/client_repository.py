@@ -0,0 +1,403 @@
+# A process-wide cache of hydrated clients.
+#
+# Building the Client/Contract/Version object graph of a client from its DB
+# record is the expensive part of most requests, so hydrated clients are
+# kept in memory and checked against local_db's per-client generation on
+# each access.  Versions appended through local_db are applied to the cached
+# objects as they are committed; any other write drops the client, which is
+# rebuilt on next use.
+#
+# Each cached client carries an index of its versions by blob ID, and the
+# repository tracks which clients use a blob ID, so finding a base version
+# is a dict lookup instead of a scan.  The same blob ID can be a version of
+# several clients (identical content uploaded twice) and of several
+# contracts of one client.  The owner index covers every client in the DB;
+# it is listed once and then kept current from the committed mutations.
+#
+# The returned objects are shared between threads and must be treated as
+# read-only.  Readers do not lock while versions are appended to them:
+# VersionGraph and VersionIndex publish an added version only once it is
+# complete, and the version lists are only appended to.
+import base64
+import json
+import os
+import sys
+import threading
+
+import local_db
+import sign_ocntract_model
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import model
+
+
+# `sequence` is used for records written before versions were numbered.
+def _VersionFromRecord(version: dict, blob_id: model.BlobID,
+                       parents: list[model.BlobID], graph: model.VersionGraph,
+                       sequence: int, shared) -> model.Version:
+    blob_id.timestamp = version.get('timestamp', 0)
+    return model.Version(
+        blob_id=blob_id,
+        initial_blob_data=shared(version['initial_blob_data']),
+        parents=parents,
+        alias=version['alias'],
+        graph=graph,
+        storage=version.get('storage', model.STORAGE_BLOB),
+        sequence=version.get('sequence', sequence),
+        sealed_for=version.get('sealed_for'))
+
+
+# Builds a contract and the version graph of its history from its DB
+# record.  Every blob ID of the contract is a single BlobID object, shared by
+# the graph, the versions and their parents.  `keys` interns the blob ID
+# keys across the contracts being hydrated together (see model.BlobIdKey).
+def ContractFromRecord(contract: dict,
+                       keys: dict = None) -> sign_ocntract_model.Contract:
+    blob_ids = {}
+    if keys is None:
+        keys = {}
+
+    def shared(bid: str) -> model.BlobID:
+        blob_id = blob_ids.get(bid)
+        if blob_id is None:
+            blob_id = blob_ids[bid] = model.BlobID(bid=bid,
+                                                   timestamp=0,
+                                                   keys=keys)
+        return blob_id
+
+    graph = model.VersionGraph()
+    nodes = {}
+    for version in contract['versions']:
+        # Records written before versions had parents carry their full
+        # history.  Its entries that are not versions of this contract are
+        # added as a chain so that history is kept.
+        history = version.get('previous_versions') or []
+        for i, prev_blob in enumerate(history):
+            nodes.setdefault(prev_blob, (shared(prev_blob),
+                                         [shared(history[i - 1])] if i else []))
+    for version in contract['versions']:
+        nodes[version['blob_id']] = (shared(version['blob_id']), [
+            shared(parent) for parent in model.ParentsFromRecord(version)
+        ])
+    graph.add_all(nodes)
+
+    versions = [
+        _VersionFromRecord(version, *nodes[version['blob_id']], graph, i + 1,
+                           shared)
+        for i, version in enumerate(contract['versions'])
+    ]
+    return sign_ocntract_model.Contract(contract_id=contract['contract_id'],
+                                        versions=versions,
+                                        name=contract.get(
+                                            'name', 'default name'),
+                                        graph=graph)
+
+
+def ClientFromRecord(client: dict) -> sign_ocntract_model.Client:
+    keys = {}
+    return sign_ocntract_model.Client(client_id=client['client_id'],
+                                      name=client['name'],
+                                      contracts=[
+                                          ContractFromRecord(contract, keys)
+                                          for contract in client['contracts']
+                                      ])
+
+
+class _CachedClient(object):
+
+    def __init__(self, generation: tuple, client: sign_ocntract_model.Client):
+        self.generation = generation
+        self.client = client
+        self.contracts = {c.contract_id: c for c in client.contracts}
+        # blob ID key (see model.BlobIdKey) -> [(contract, version)]
+        self.versions = {}
+        for contract in client.contracts:
+            for version in contract.versions:
+                self.add(contract, version)
+
+    def add(self, contract, version) -> None:
+        self.versions.setdefault(version.blob_id.key, []).append(
+            (contract, version))
+
+
+class ClientRepository(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # client ID -> _CachedClient
+        self._clients = {}
+        # blob ID key -> IDs of the clients with a version of that blob, or
+        # None until first used.  It may name clients that no longer have
+        # the blob.
+        self._owners = None
+        # IDs of the clients whose blob IDs may be missing from _owners.
+        self._unindexed = set()
+        # Held while the owner index is listed or caught up, so concurrent
+        # lookups wait for it.
+        self._index_lock = threading.Lock()
+        local_db.AddCommitListener(self._on_commit)
+
+    def _drop(self, client_id: str) -> None:
+        self._clients.pop(client_id, None)
+
+    # Adds the owner of version records to the owner index.
+    def _index(self, client_id: str, records) -> None:
+        for record in records:
+            self._owners.setdefault(model.BlobIdKey(record['blob_id']),
+                                    set()).add(client_id)
+
+    # Returns the hydrated client.  Raises ValueError if it is unknown.
+    def get(self, client_id: str) -> sign_ocntract_model.Client:
+        return self._get(client_id).client
+
+    def _get(self, client_id: str) -> _CachedClient:
+        generation = local_db.ClientGeneration(client_id)
+        with self._lock:
+            entry = self._clients.get(client_id)
+            if entry is not None and entry.generation == generation:
+                return entry
+        # Hydrate outside the lock.  The generation was read before the
+        # record, so a write landing in between only makes the entry look
+        # stale.
+        entry = _CachedClient(generation,
+                              ClientFromRecord(local_db.GetClient(client_id)))
+        with self._lock:
+            current = self._clients.get(client_id)
+            if (current is None or current.generation !=
+                    local_db.ClientGeneration(client_id)):
+                self._clients[client_id] = entry
+        return entry
+
+    # Returns the (contract, version) pairs of a client whose version has
+    # blob ID `blob_id`, or [] if there are none.
+    def lookup(self, client_id: str, blob_id: str) -> list[tuple]:
+        return list(
+            self._get(client_id).versions.get(model.BlobIdKey(blob_id), []))
+
+    # Returns the (contract, version) of a client's version `blob_id`, the
+    # first one if several contracts have it.  Raises local_db.NotFound if
+    # the client has no such version.
+    def find_version(self, client_id: str, blob_id: str) -> tuple:
+        found = self.lookup(client_id, blob_id)
+        if not found:
+            raise local_db.NotFound(
+                f'Base version with version_id {blob_id} not found.')
+        return found[0]
+
+    # Returns (client, contract, version) for every version with blob ID
+    # `blob_id`, across all clients.  Only the clients the owner index names
+    # are looked at.
+    def locate(self, blob_id: str) -> list[tuple]:
+        with self._index_lock:
+            with self._lock:
+                building = self._owners is None
+                if building:
+                    # Commits from here on are indexed by _on_commit; the
+                    # listing below covers the ones before.
+                    self._owners = {}
+                    self._unindexed.clear()
+                owners = self._owners
+            if building:
+                clients = local_db.ListClients()
+                with self._lock:
+                    if self._owners is owners:
+                        for client in clients:
+                            for contract in client['contracts']:
+                                self._index(client['client_id'],
+                                            contract['versions'])
+            with self._lock:
+                unindexed, self._unindexed = self._unindexed, set()
+            for client_id in sorted(unindexed):
+                try:
+                    client = local_db.GetClient(client_id)
+                except ValueError:
+                    continue
+                with self._lock:
+                    if self._owners is not None:
+                        for contract in client['contracts']:
+                            self._index(client_id, contract['versions'])
+        key = model.BlobIdKey(blob_id)
+        with self._lock:
+            client_ids = sorted((self._owners or {}).get(key, ()))
+        found = []
+        for client_id in client_ids:
+            try:
+                entry = self._get(client_id)
+            except ValueError:
+                continue
+            found.extend((entry.client, contract, version)
+                         for contract, version in entry.versions.get(key, ()))
+        return found
+
+    # Drops a client, or every client, from the cache.
+    def invalidate(self, client_id: str = None) -> None:
+        with self._lock:
+            if client_id is None:
+                self._clients.clear()
+                self._owners = None
+            else:
+                self._drop(client_id)
+                self._unindexed.add(client_id)
+
+    # local_db commit listener.  Appended versions are applied in place when
+    # the cached client is up to date with the previous commit; anything
+    # else drops the client.
+    def _on_commit(self, mutation: dict, client_ids: set) -> None:
+        with self._lock:
+            if client_ids is None:
+                self._clients.clear()
+                self._owners = None
+                return
+            op = mutation['op'] if mutation is not None else None
+            if self._owners is not None:
+                self._index_mutation(mutation, client_ids)
+            if op == 'add_version':
+                appended = [(mutation['client_id'], mutation['contract_id'],
+                             mutation['version'])]
+            elif op == 'add_versions':
+                appended = mutation['versions']
+            else:
+                appended = None
+            for client_id in client_ids:
+                entry = self._clients.get(client_id)
+                if entry is None:
+                    continue
+                # The generation is bumped after listeners return.
+                epoch, count = local_db.ClientGeneration(client_id)
+                records = [(entry.contracts.get(contract_id), record)
+                           for owner, contract_id, record in appended or []
+                           if owner == client_id]
+                if (appended is None or entry.generation != (epoch, count) or
+                        any(contract is None for contract, _ in records)):
+                    self._drop(client_id)
+                    continue
+                for contract, record in records:
+                    self._append(entry, contract, record)
+                entry.generation = (epoch, count + 1)
+
+    # Adds the blob IDs a mutation writes to the owner index.
+    def _index_mutation(self, mutation: dict, client_ids: set) -> None:
+        op = mutation['op'] if mutation is not None else None
+        if op == 'add_client':
+            for contract in mutation['client']['contracts']:
+                self._index(mutation['client']['client_id'],
+                            contract['versions'])
+        elif op == 'add_contract':
+            self._index(mutation['client_id'],
+                        mutation['contract']['versions'])
+        elif op == 'add_version':
+            self._index(mutation['client_id'], [mutation['version']])
+        elif op == 'add_versions':
+            for client_id, _, record in mutation['versions']:
+                self._index(client_id, [record])
+        elif op != 'update_version' or 'blob_id' in mutation['fields']:
+            # A failed write may or may not have landed.
+            self._unindexed.update(client_ids)
+
+    def _append(self, entry: _CachedClient, contract, record: dict) -> None:
+        def shared(bid: str) -> model.BlobID:
+            return contract.graph.get(bid) or model.BlobID(bid=bid,
+                                                           timestamp=0)
+
+        parents = [shared(p) for p in model.ParentsFromRecord(record)]
+        version = _VersionFromRecord(record, shared(record['blob_id']),
+                                     parents, contract.graph,
+                                     len(contract.versions) + 1, shared)
+        contract.graph.add(version.blob_id, parents)
+        contract.versions.append(version)
+        contract.index.add(version)
+        entry.add(contract, version)
+
+
+def _EncodeCursor(client_id: str, contract_id: str, version) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([
+            client_id, contract_id, version.blob_id.timestamp,
+            version.sequence
+        ]).encode('utf-8')).decode('ascii')
+
+
+def _DecodeCursor(cursor: str) -> tuple:
+    try:
+        client_id, contract_id, timestamp, sequence = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid cursor {cursor!r}')
+    return client_id, contract_id, (timestamp, sequence)
+
+
+# Returns a contract's versions matching `query_options`, ordered by
+# (timestamp, sequence) and starting after `start_key`.
+def _MatchVersions(contract, query_options: model.QueryOptions,
+                   start_key: tuple, limit: int) -> list[model.Version]:
+    time_range = query_options.query_by_time or model.TimeRange()
+    if query_options.query_by_version is None:
+        return contract.index.range(time_range.after, time_range.before,
+                                    start_key, limit)
+    version = contract.index.by_sequence(query_options.query_by_version)
+    if version is None:
+        return []
+    timestamp = version.blob_id.timestamp
+    if ((time_range.after is not None and timestamp < time_range.after) or
+        (time_range.before is not None and timestamp > time_range.before) or
+        (start_key is not None and
+         (timestamp, version.sequence) <= tuple(start_key))):
+        return []
+    return [version]
+
+
+# Runs a query over [(client_id, contract)] pairs, which must be in the same
+# order for every page.  Returns a model.QueryPage of
+# (client_id, contract, [versions]) tuples, one per contract with matches.
+# Each contract's versions are found by bisecting its index, so a page costs
+# O(contracts * log(versions) + page size).  One match more than the page
+# holds is looked for, and next_cursor is only set if it exists.
+def QueryContracts(contracts: list[tuple],
+                   query_options: model.QueryOptions) -> model.QueryPage:
+    start = None
+    if query_options.cursor:
+        start = _DecodeCursor(query_options.cursor)
+    remaining = query_options.limit
+    page = model.QueryPage()
+    last = None
+    for client_id, contract in contracts:
+        start_key = None
+        if start is not None:
+            if (client_id, contract.contract_id) != start[:2]:
+                continue
+            start_key = start[2]
+            start = None
+        versions = _MatchVersions(
+            contract, query_options, start_key,
+            remaining + 1 if remaining is not None else None)
+        if not versions:
+            continue
+        if remaining is not None and len(versions) > remaining:
+            # The page is full and more matches remain.
+            if remaining:
+                versions = versions[:remaining]
+                page.append((client_id, contract, versions))
+                last = (client_id, contract.contract_id, versions[-1])
+            if last is not None:
+                page.next_cursor = _EncodeCursor(*last)
+            break
+        page.append((client_id, contract, versions))
+        last = (client_id, contract.contract_id, versions[-1])
+        if remaining is not None:
+            remaining -= len(versions)
+    if start is not None:
+        raise ValueError(f'Invalid cursor {query_options.cursor!r}')
+    return page
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+# Returns the process-wide repository.
+def GetRepository() -> ClientRepository:
+    global _repository
+    with _repository_lock:
+        if _repository is None:
+            _repository = ClientRepository()
+        return _repository
@@ -0,0 +1,184 @@
+# The cached /get_clients response.
+#
+# The response is a JSON list with one object per client.  Each client's
+# object is serialized once and kept as bytes; the body is the fragments
+# joined in client order.  A committed write only marks the clients it
+# touched as dirty, so the next request re-serializes just those clients.
+#
+# The body is rebuilt when local_db's DB generation changes.  Its ETag is a
+# hash of the body rather than the generation, which restarts with every
+# process and so could match a tag a client got before a restart.
+# Paginated requests are served from the same fragments in client ID order.
+import bisect
+import hashlib
+import json
+import threading
+
+import local_db
+
+
+# The /get_clients view of one client record.
+def ClientSummary(client: dict) -> dict:
+    contracts = []
+    for contract in client['contracts']:
+        contract_versions = [{
+            'alias': s['alias'],
+            'blob_id': s['blob_id']
+        } for s in contract['versions']]
+        contracts.append({
+            'contract_id': contract['contract_id'],
+            'versions': contract_versions
+        })
+    return {
+        'client_id': client['client_id'],
+        'name': client['name'],
+        'contracts': contracts
+    }
+
+
+def _Fragment(client: dict) -> bytes:
+    return json.dumps(ClientSummary(client)).encode('utf-8')
+
+
+# The number of clients copied out of the cache at a time while paging.
+_PAGE_BATCH = 64
+
+
+class ClientsResponseCache(object):
+
+    def __init__(self):
+        # Guards the fields below.  Never held while calling local_db, since
+        # commit listeners take it while local_db holds client locks.
+        self._lock = threading.Lock()
+        # Serializes refreshes.
+        self._refresh_lock = threading.Lock()
+        # Client IDs in DB order, or None before the first build and after
+        # the whole DB was replaced.
+        self._order = None
+        # The same IDs, sorted.
+        self._sorted = []
+        # Client ID -> serialized client.
+        self._fragments = {}
+        # Client IDs whose fragment is out of date.
+        self._dirty = set()
+        # The generation the fragments reflect.
+        self._generation = None
+        self._body = None
+        self._body_etag = None
+        self._body_generation = None
+        # Counts whole-DB replacements.
+        self._resets = 0
+        # Clients added while the order is being listed.
+        self._added = []
+        local_db.AddCommitListener(self._on_commit)
+
+    def _on_commit(self, mutation: dict, client_ids: set) -> None:
+        with self._lock:
+            self._generation = None
+            if client_ids is None:
+                self._resets += 1
+                self._order = None
+                self._sorted = []
+                self._fragments = {}
+                self._dirty = set()
+                self._added = []
+                return
+            if mutation is not None and mutation['op'] == 'add_client':
+                client_id = mutation['client']['client_id']
+                if self._order is not None:
+                    self._order.append(client_id)
+                    bisect.insort(self._sorted, client_id)
+                else:
+                    self._added.append(client_id)
+            self._dirty.update(client_ids)
+
+    # Re-serializes the dirty clients.  Returns the generation the fragments
+    # reflect.
+    def _refresh(self) -> tuple:
+        with self._refresh_lock:
+            while True:
+                # Read the generation before the data, so a write landing
+                # during the refresh makes the fragments look stale rather
+                # than current.
+                generation = local_db.Generation()
+                with self._lock:
+                    if self._generation == generation:
+                        return generation
+                    order = self._order
+                    dirty = self._dirty
+                    resets = self._resets
+                    self._dirty = set()
+                    if order is None:
+                        self._added = []
+                try:
+                    if order is None:
+                        clients = local_db.ListClients()
+                        order = [client['client_id'] for client in clients]
+                        fragments = {
+                            client['client_id']: _Fragment(client)
+                            for client in clients
+                        }
+                    else:
+                        fragments = {
+                            client_id:
+                            _Fragment(local_db.GetClient(client_id))
+                            for client_id in dirty
+                        }
+                except BaseException:
+                    with self._lock:
+                        if self._resets == resets:
+                            self._dirty.update(dirty)
+                    raise
+                with self._lock:
+                    if self._resets != resets:
+                        # The whole DB was replaced meanwhile; start over.
+                        continue
+                    if self._order is None:
+                        known = set(order)
+                        self._order = order + [
+                            c for c in self._added if c not in known
+                        ]
+                        self._sorted = sorted(self._order)
+                        self._added = []
+                    self._fragments.update(fragments)
+                    if not self._dirty:
+                        self._generation = generation
+                    return generation
+
+    # Returns (etag, body) for the current DB.
+    def get(self) -> tuple:
+        generation = self._refresh()
+        with self._lock:
+            if self._body is None or self._body_generation != generation:
+                # Clients added since `generation` may have no fragment yet;
+                # they are dirty and the body is already stale.
+                self._body = b'[' + b', '.join(
+                    self._fragments[c]
+                    for c in self._order if c in self._fragments) + b']'
+                self._body_etag = '"%s"' % hashlib.sha256(
+                    self._body).hexdigest()[:32]
+                self._body_generation = generation
+            return self._body_etag, self._body
+
+    # Yields (client_id, fragment) in client ID order for the clients whose
+    # ID starts with `prefix` and sorts after `after`.  Only a batch of
+    # clients is copied out of the cache at a time.
+    def iter_clients(self, prefix: str = '', after: str = None):
+        self._refresh()
+        position = after if after is not None and after >= prefix else None
+        while True:
+            with self._lock:
+                if position is None:
+                    start = bisect.bisect_left(self._sorted, prefix)
+                else:
+                    start = bisect.bisect_right(self._sorted, position)
+                batch = [(c, self._fragments.get(c))
+                         for c in self._sorted[start:start + _PAGE_BATCH]]
+            for client_id, fragment in batch:
+                if not client_id.startswith(prefix):
+                    return
+                if fragment is not None:
+                    yield client_id, fragment
+            if len(batch) < _PAGE_BATCH:
+                return
+            position = batch[-1][0]
@@ -7,34 +7,260 @@
 #
 # The walrus DB store the encrypted signed contract and signature info.
 
+import base64
+import functools
+import logging
 import os
 import sys
+import threading
+import time
+import urllib.parse
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from requests_toolbelt.multipart import decoder
+from http.server import (BaseHTTPRequestHandler, HTTPServer,
+                         ThreadingHTTPServer)
 
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 sys.path.insert(1, os.path.join(sys.path[0], '../..'))
 import json
+import client_repository
+import clients_response
 import local_db
+import metrics
 import versioned_walrus
-import model
+import signature_batch
+import streaming_multipart
+import upload_jobs
+
+logger = logging.getLogger(__name__)
 
 # Local server port.
 PORT = 8887
 
+# Largest accepted /upload_contract request body.
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 100 * 1024 * 1024))
+
+# Where uploaded files are staged until they are stored in Walrus.
+UPLOAD_DIR = os.path.join(os.getcwd(), 'tmp')
+
+# Upload jobs are kept in UPLOAD_JOBS_DB, their files in UPLOAD_DIR/jobs
+# until they are stored, and UPLOAD_WORKERS of them run at a time.
+UPLOAD_JOBS_DB = os.environ.get('UPLOAD_JOBS_DB', 'upload_jobs.sqlite')
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+
+# Default and maximum number of clients per /get_clients page.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Serve each connection on its own thread, so a slow upload does not stall
+# other requests.  Set SERVER_THREADED=0 for the old one-request-at-a-time
+# server.
+SERVER_THREADED = os.environ.get('SERVER_THREADED', '1') != '0'
+
+# LOG_LEVEL is a logging level name; LOG_FORMAT=json logs one JSON object
+# per line.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+# Request paths with their own latency histogram; others are counted as
+# 'other'.
+_HANDLERS = ('/get_clients', '/sign_contract', '/upload_contract', '/jobs',
+             '/metrics')
+_request_seconds = metrics.Histogram('http_request_duration_seconds',
+                                     'Latency of HTTP requests by handler.',
+                                     ('handler', 'method', 'status'))
+
+
+_clients_response = clients_response.ClientsResponseCache()
+_signatures = signature_batch.SignatureBatcher()
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+# Returns the upload job queue, starting its workers on first use.
+def _GetJobs() -> upload_jobs.JobQueue:
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            _jobs = upload_jobs.JobQueue(UPLOAD_JOBS_DB,
+                                         os.path.join(UPLOAD_DIR, 'jobs'),
+                                         versioned_walrus.UploadFileOnVersion,
+                                         workers=UPLOAD_WORKERS)
+            _jobs.start()
+        return _jobs
+
+
+# Returns True if an If-None-Match header value matches `etag`.
+def _EtagMatches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class _JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def _ConfigureLogging() -> None:
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter('%(asctime)s %(levelname)s %(name)s '
+                              '%(message)s'))
+    logging.basicConfig(level=LOG_LEVEL.upper(), handlers=[handler])
+
+
+# Records the latency of a do_* method in _request_seconds.
+def _Timed(method):
+
+    @functools.wraps(method)
+    def timed(self):
+        start = time.perf_counter()
+        self._status = None
+        try:
+            method(self)
+        finally:
+            path = urllib.parse.urlsplit(self.path).path
+            if path.startswith('/jobs/'):
+                path = '/jobs'
+            _request_seconds.observe(
+                time.perf_counter() - start,
+                handler=path if path in _HANDLERS else 'other',
+                method=self.command,
+                status=self._status or 500)
+
+    return timed
+
+
+# Writes an HTTP/1.1 chunked body, coalescing small writes into chunks of
+# about `chunk_size` bytes.
+class _ChunkedWriter(object):
+
+    def __init__(self, wfile, chunk_size: int = 64 * 1024):
+        self.wfile = wfile
+        self.chunk_size = chunk_size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data: bytes) -> None:
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffered:
+            self.wfile.write(b'%x\r\n' % self._buffered)
+            self.wfile.write(b''.join(self._buffer))
+            self.wfile.write(b'\r\n')
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def _EncodeCursor(client_id: str) -> str:
+    return base64.urlsafe_b64encode(client_id.encode('utf-8')).decode('ascii')
+
+
+def _DecodeCursor(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor.encode('ascii'),
+                                altchars=b'-_',
+                                validate=True).decode('utf-8')
+    except (ValueError, UnicodeError):
+        raise ValueError(f'Invalid cursor {cursor!r}')
+
+
+# Applies the contract and latest-version filters to a serialized client.
+# Returns the new fragment, or None if the client has no matching contract.
+def _FilterFragment(fragment: bytes, contract_id: str,
+                    latest_only: bool) -> bytes:
+    if contract_id is None and not latest_only:
+        return fragment
+    summary = json.loads(fragment)
+    contracts = summary['contracts']
+    if contract_id is not None:
+        contracts = [c for c in contracts if c['contract_id'] == contract_id]
+        if not contracts:
+            return None
+    if latest_only:
+        for contract in contracts:
+            contract['versions'] = contract['versions'][-1:]
+    summary['contracts'] = contracts
+    return json.dumps(summary).encode('utf-8')
+
+
+# Returns (fragments, next cursor) for one /get_clients page: the serialized
+# clients after `after` whose ID starts with `prefix`, filtered, at most
+# `limit` of them.
+def _ClientsPage(prefix: str, after: str, contract_id: str,
+                 latest_only: bool, limit: int) -> tuple:
+    fragments = []
+    last = None
+    for client_id, fragment in _clients_response.iter_clients(prefix, after):
+        fragment = _FilterFragment(fragment, contract_id, latest_only)
+        if fragment is None:
+            continue
+        if len(fragments) == limit:
+            # There is at least one more client.
+            return fragments, _EncodeCursor(last)
+        fragments.append(fragment)
+        last = client_id
+    return fragments, None
+
 
 class RequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive: every response carries a Content-Length or is chunked.
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle's algorithm
+    # the body of a keep-alive response waits ~40 ms for the client's
+    # delayed ACK.
+    disable_nagle_algorithm = True
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
 
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+    @_Timed
     def do_GET(self):
         # Handle GET requests
-        path = self.path
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
 
         if path == '/get_clients':
-            self.get_clients()
+            if url.query:
+                self.get_clients_page(urllib.parse.parse_qs(url.query))
+            else:
+                self.get_clients()
+        elif path == '/metrics':
+            self.get_metrics()
+        elif path.startswith('/jobs/'):
+            self.get_job(path[len('/jobs/'):])
         else:
             self.send_error(404, 'Endpoint not supported.')
 
+    @_Timed
     def do_POST(self):
         if self.path == '/sign_contract':
             self.sign_contract()
@@ -43,194 +269,285 @@ class RequestHandler(BaseHTTPRequestHandler):
         else:
             self.send_error(404, 'Method not supported.')
 
+    @_Timed
     def do_OPTIONS(self):
         # Handle CORS preflight requests
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     # Ideally, we should use Sign service.
     # TODO: Go to the help desk.  Their user doc's examples links are invalid.
     def sign_contract(self):
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-
         content_length = int(self.headers.get('Content-Length', 0))
         post_data = self.rfile.read(content_length)
-        data = json.loads(post_data)
-        print(post_data)
+        with metrics.Stage('json_parse'):
+            data = json.loads(post_data)
+        logger.debug('sign_contract %s', post_data)
 
         # Extract relevant data from request
         client_id = data['client_id']
         contract_id = data['contract_id']
         version_blob_id = data['version_blob_id']
+        signer = data.get('signer', 'client')
+        if signer not in ('client', 'agent'):
+            self.send_error(400, 'Unknown signer.')
+            return
 
-        # Load the database
-        db = local_db.LoadDatabase()
-
-        print("DB: ", db)
-
-        # Find the contract and version in the database
-        client = next(
-            (client
-             for client in db['clients'] if client['client_id'] == client_id),
-            None)
-        if not client:
+        # Find the contract and version; only this client is read.
+        try:
+            client = local_db.GetClient(client_id)
+        except ValueError:
             self.send_error(404, 'Client not found.')
             return
-
-        contract = next((contract for contract in client['contracts']
-                         if contract['contract_id'] == contract_id), None)
+        with metrics.Stage('lookup'):
+            contract = next((contract for contract in client['contracts']
+                             if contract['contract_id'] == contract_id),
+                            None)
+            version = contract and next(
+                (s for s in contract['versions']
+                 if s['blob_id'] == version_blob_id), None)
         if not contract:
             self.send_error(404, 'Contract not found.')
             return
-
-        version = next(
-            (s
-             for s in contract['versions'] if s['blob_id'] == version_blob_id),
-            None)
         if not version:
             self.send_error(404, 'Contract version not found.')
             return
 
-        # Save the updated database
-        local_db.SaveDatabase(db)
+        # The signature is stored in Walrus together with the others made
+        # within the batching window.
+        record = {
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'version_blob_id': version_blob_id,
+            'signer': signer,
+            'signed_at': int(time.time())
+        }
+        if data.get('signature'):
+            record['signature'] = data['signature']
+        try:
+            receipt = _signatures.sign(record)
+        except Exception as e:
+            self._send_json(502, {'status': 'fail', 'message': str(e)})
+            return
+
+        # Concurrent signers share one group commit.  Each signer's anchor
+        # is kept under its own keys, as signers are usually anchored in
+        # different batches.
+        try:
+            local_db.UpdateVersion(
+                client_id, contract_id, version_blob_id, {
+                    f'signed_by_{signer}': True,
+                    f'sig_blob_id_{signer}': receipt.sig_blob_id,
+                    f'sig_proof_{signer}': receipt.proof
+                })
+        except ValueError:
+            self.send_error(404, 'Contract version not found.')
+            return
+
         # Simple response with a success message
         response = {
             'status': 'success',
-            'message': '[Addr] has signed [BlobID].'
+            'message': f'{client_id} has signed {version_blob_id}.',
+            'sig_blob_id': receipt.sig_blob_id,
+            'sig_proof': receipt.proof
         }
 
-        print("\n\n", json.dumps(response).encode('utf-8'), "\n\n")
-
         # Send the JSON response
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+        self._send_json(200, response)
 
+    # The response is cached between writes and tagged with a SHA-256 of its
+    # body, so polling clients sending If-None-Match get a 304, also across
+    # server restarts.
     def get_clients(self):
-        # Add CORS headers
+        etag, body = _clients_response.get()
+        if _EtagMatches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+
+        # Send the client data as response
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
 
-        # Load the database
-        db = local_db.LoadDatabase()
-
-        clients_data = []
-        for client in db['clients']:
-            contracts = []
-            for contract in client['contracts']:
-                contract_versions = [{
-                    'alias': s['alias'],
-                    'blob_id': s['blob_id']
-                } for s in contract['versions']]
-                contracts.append({
-                    'contract_id': contract['contract_id'],
-                    'versions': contract_versions
-                })
-            clients_data.append({
-                'client_id': client['client_id'],
-                'name': client['name'],
-                'contracts': contracts
+    # Prometheus text format.
+    def get_metrics(self):
+        body = metrics.Render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # /jobs/<job ID>
+    # Returns the state of an upload job and, once it succeeded, the new
+    # version.
+    def get_job(self, job_id: str):
+        job = _GetJobs().get(job_id)
+        if job is None:
+            self._send_json(404, {
+                'status': 'fail',
+                'message': 'Job not found.'
             })
+            return
+        self._send_json(200, job)
+
+    # /get_clients?limit=N&cursor=C&client_id_prefix=P&contract_id=K
+    #     &latest_only=1
+    # Returns {"clients": [...], "next_cursor": C} with the clients in client
+    # ID order.  Pass `next_cursor` back to get the next page; it is null on
+    # the last one.  The page is assembled from the cached fragments before
+    # the headers are sent, so a DB error is still answered with a 500, and
+    # then streamed with chunked transfer encoding.
+    def get_clients_page(self, query: dict):
+
+        def param(name: str, default: str = None) -> str:
+            return query.get(name, [default])[-1]
+
+        try:
+            limit = int(param('limit', DEFAULT_PAGE_SIZE))
+            if not 0 < limit <= MAX_PAGE_SIZE:
+                raise ValueError(
+                    f'limit must be between 1 and {MAX_PAGE_SIZE}')
+            cursor = param('cursor')
+            after = _DecodeCursor(cursor) if cursor else None
+        except ValueError as e:
+            self._send_json(400, {'status': 'fail', 'message': str(e)})
+            return
+        prefix = param('client_id_prefix', '')
+        contract_id = param('contract_id')
+        latest_only = param('latest_only', '0').lower() in ('1', 'true')
+
+        try:
+            fragments, next_cursor = _ClientsPage(prefix, after, contract_id,
+                                                  latest_only, limit)
+        except Exception as e:
+            logger.exception('get_clients page failed')
+            self._send_json(500, {'status': 'fail', 'message': str(e)})
+            return
 
-        # Send the client data as response
-        self.wfile.write(json.dumps(clients_data).encode('utf-8'))
-
-    # TODO
-    # Placeholder for file upload implementation
-    def upload_contract(self):
-        # Read the content-length to get the size of the incoming data
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)  # Read the raw POST data
-
-        # Get the content-type and boundary from headers
-        content_type = self.headers['Content-Type']
-
-        # Parse the multipart form data
-        multipart_data = decoder.MultipartDecoder(post_data, content_type)
-
-        client_id = None
-        contract_id = None
-        version_alias = None
-        file_data = None
-        file_name = None
-        # Also used as version id
-        blob_id = None
-
-        # Loop over the parts of the multipart data
-        for part in multipart_data.parts:
-            content_disposition = part.headers.get(
-                b'Content-Disposition').decode('utf-8')
-
-            print(content_disposition, ': ', part.text)
-
-            # Parse form fields
-            if 'name="client_id"' in content_disposition:
-                client_id = part.text
-            elif 'name="contract_id"' in content_disposition:
-                contract_id = part.text
-            elif 'name="version_alias"' in content_disposition:
-                version_alias = part.text
-            elif 'name="file"' in content_disposition:
-                file_data = part.content  # This is the file content
-                file_name = part.headers.get(b'Content-Disposition').decode(
-                    'utf-8').split('filename=')[1].strip('"')
-            elif 'blob_id' in content_disposition:
-                blob_id = part.text
-
-        # Validate the form data
-        if client_id and contract_id and version_alias and file_data and file_name:
-            # Save the file to the current working directory
-            directory = os.path.join(os.getcwd(), 'tmp')
-            file_path = os.path.join(directory, file_name)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-
-            with open(file_path, 'wb') as output_file:
-                output_file.write(file_data)
-
-            # Send a JSON response back
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-
-            # Upload a new version
-            updated_version: model.Version = versioned_walrus.UploadFileOnVersion(
-                file_path, client_id, blob_id)
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
 
-            print(updated_version)
+        out = _ChunkedWriter(self.wfile)
+        out.write(b'{"clients": [')
+        for i, fragment in enumerate(fragments):
+            if i:
+                out.write(b', ')
+            out.write(fragment)
+        out.write(b'], "next_cursor": ' +
+                  json.dumps(next_cursor).encode('utf-8') + b'}')
+        out.close()
+
+    def _send_json(self, status: int, response, headers: dict = None):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-            response = {
-                'status':
-                'success',
-                'message':
-                f'File {file_name} uploaded successfully for client ' +
-                f'{client_id}.  New version ID: {updated_version.blob_id.bid}'
-            }
-            self.wfile.write(json.dumps(response).encode('utf-8'))
-        else:
-            # Missing required form data
-            self.send_response(400)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            response = {
+    # The multipart body is parsed as it arrives: the file is streamed to a
+    # temporary file in UPLOAD_DIR.  It is then handed to an upload job and
+    # the response, 202 with the job ID, is sent without waiting for Walrus;
+    # poll /jobs/<job ID> for the new version.
+    def upload_contract(self):
+        content_length = self.headers.get('Content-Length')
+        if content_length is None:
+            self.close_connection = True
+            self._send_json(411, {
                 'status': 'fail',
-                'message': 'Invalid or incomplete form data.'
-            }
-            self.wfile.write(json.dumps(response).encode('utf-8'))
+                'message': 'Content-Length required.'
+            })
+            return
 
+        try:
+            form = streaming_multipart.ParseMultipart(
+                self.rfile, self.headers['Content-Type'],
+                int(content_length), UPLOAD_DIR, MAX_UPLOAD_BYTES)
+        except streaming_multipart.UploadTooLarge as e:
+            # The rest of the body was not read; do not reuse the
+            # connection.
+            self.close_connection = True
+            self._send_json(413, {'status': 'fail', 'message': str(e)})
+            return
+        except streaming_multipart.MultipartError as e:
+            self.close_connection = True
+            self._send_json(400, {'status': 'fail', 'message': str(e)})
+            return
 
-def run(server_class=HTTPServer, handler_class=RequestHandler, port=PORT):
+        with form:
+            logger.debug('upload_contract fields %s', form.fields)
+
+            client_id = form.fields.get('client_id')
+            contract_id = form.fields.get('contract_id')
+            version_alias = form.fields.get('version_alias')
+            file_part = form.files.get('file')
+            # Also used as version id
+            blob_id = form.fields.get('blob_id')
+
+            # Validate the form data
+            if not (client_id and contract_id and version_alias and
+                    file_part and file_part.filename):
+                # Missing required form data
+                self._send_json(400, {
+                    'status': 'fail',
+                    'message': 'Invalid or incomplete form data.'
+                })
+                return
+
+            # Fail fast on an unknown base version; the job checks again.
+            try:
+                client_repository.GetRepository().find_version(
+                    client_id, blob_id)
+            except ValueError as e:
+                self._send_json(404, {'status': 'fail', 'message': str(e)})
+                return
+
+            job_id = _GetJobs().submit(file_part.path, file_part.filename,
+                                       client_id, blob_id)
+            logger.info('upload_contract client_id=%s job=%s', client_id,
+                        job_id)
+
+            status_url = f'/jobs/{job_id}'
+            self._send_json(
+                202, {
+                    'status': 'accepted',
+                    'job_id': job_id,
+                    'status_url': status_url,
+                    'message': f'File {file_part.filename} queued for upload '
+                               f'for client {client_id}.'
+                }, {'Location': status_url})
+
+
+def run(server_class=None, handler_class=RequestHandler, port=PORT):
+    _ConfigureLogging()
+    # Extends the blobs of current versions in the background.
+    versioned_walrus.GetLifetimeManager().start()
+    # Resumes the upload jobs left by the previous run.
+    _GetJobs()
+    if server_class is None:
+        server_class = ThreadingHTTPServer if SERVER_THREADED else HTTPServer
     server_address = ('', port)
     httpd = server_class(server_address, handler_class)
-    print(f'Server running on port {port}...')
+    logger.info('server running on port %d', port)
     httpd.serve_forever()
 
 
@@ -0,0 +1,193 @@
+# A streaming multipart/form-data parser.
+#
+# The request body is read in fixed size blocks.  Form fields are kept in
+# memory (up to a small limit) while file parts are written straight to
+# temporary files, so peak memory stays at a few blocks regardless of the
+# upload size.  Call UploadedForm.cleanup(), or use the form as a context
+# manager, to remove the temporary files.
+import os
+import re
+import tempfile
+
+_BLOCK_SIZE = 64 * 1024
+_MAX_HEADER_BYTES = 16 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class UploadTooLarge(MultipartError):
+    pass
+
+
+class FilePart(object):
+    name: str
+    filename: str
+    path: str
+    size: int
+
+    def __init__(self, name: str, filename: str, path: str):
+        self.name = name
+        self.filename = filename
+        self.path = path
+        self.size = 0
+
+
+class UploadedForm(object):
+    # Form field name -> value
+    fields: dict[str, str]
+    # Form field name -> FilePart
+    files: dict[str, FilePart]
+
+    def __init__(self):
+        self.fields = {}
+        self.files = {}
+
+    def cleanup(self) -> None:
+        for part in self.files.values():
+            if os.path.exists(part.path):
+                os.remove(part.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+
+def _Boundary(content_type: str) -> bytes:
+    match = re.search(r'boundary=("?)([^";]+)\1', content_type or '')
+    if not content_type or not content_type.startswith(
+            'multipart/form-data') or not match:
+        raise MultipartError('Expected multipart/form-data with a boundary')
+    return match.group(2).encode('latin-1')
+
+
+def _ParseDisposition(headers: bytes) -> tuple:
+    for line in headers.decode('utf-8', 'replace').split('\r\n'):
+        key, _, value = line.partition(':')
+        if key.strip().lower() != 'content-disposition':
+            continue
+        name = re.search(r'\bname="([^"]*)"', value)
+        filename = re.search(r'\bfilename="([^"]*)"', value)
+        return (name.group(1) if name else None,
+                filename.group(1) if filename else None)
+    raise MultipartError('Part without Content-Disposition')
+
+
+# Reads a multipart body of `content_length` bytes from `rfile`.
+#
+# File parts are written to temporary files in `directory`.  Raises
+# UploadTooLarge if the body is larger than `max_bytes` or a field value is
+# larger than `max_field_bytes`, and MultipartError if the body is malformed,
+# a field value is not UTF-8 or a file field appears twice.  Temporary files
+# are removed when parsing fails.
+def ParseMultipart(rfile,
+                   content_type: str,
+                   content_length: int,
+                   directory: str,
+                   max_bytes: int,
+                   max_field_bytes: int = 64 * 1024) -> UploadedForm:
+    if content_length > max_bytes:
+        raise UploadTooLarge(
+            f'Upload of {content_length} bytes exceeds {max_bytes}')
+    delimiter = b'\r\n--' + _Boundary(content_type)
+    os.makedirs(directory, exist_ok=True)
+
+    form = UploadedForm()
+    remaining = content_length
+    # The body starts with the delimiter minus its leading CRLF.
+    buffer = bytearray(b'\r\n')
+
+    def fill() -> bool:
+        nonlocal remaining
+        if not remaining:
+            return False
+        block = rfile.read(min(_BLOCK_SIZE, remaining))
+        if not block:
+            raise MultipartError('Request body ended early')
+        remaining -= len(block)
+        buffer.extend(block)
+        return True
+
+    # Reads until `marker` is in the buffer and returns its position.
+    def find(marker: bytes, limit: int) -> int:
+        while True:
+            index = buffer.find(marker)
+            if index >= 0:
+                return index
+            if len(buffer) > limit:
+                raise MultipartError('Multipart header too large')
+            if not fill():
+                raise MultipartError('Malformed multipart body')
+
+    try:
+        # Skip any preamble up to the first delimiter.
+        start = find(delimiter, content_length + len(delimiter))
+        del buffer[:start + len(delimiter)]
+        while True:
+            while len(buffer) < 2 and fill():
+                pass
+            if buffer[:2] == b'--':
+                # Closing delimiter.  Discard the epilogue so the connection
+                # can be reused.
+                while fill():
+                    buffer.clear()
+                return form
+            if buffer[:2] != b'\r\n':
+                raise MultipartError('Malformed multipart delimiter')
+            end = find(b'\r\n\r\n', _MAX_HEADER_BYTES)
+            name, filename = _ParseDisposition(bytes(buffer[2:end]))
+            del buffer[:end + 4]
+
+            if filename is not None:
+                if name in form.files:
+                    raise MultipartError(f'Duplicate file field {name}')
+                fd, path = tempfile.mkstemp(
+                    dir=directory,
+                    prefix='upload-',
+                    suffix='-' + os.path.basename(filename))
+                part = FilePart(name, os.path.basename(filename), path)
+                form.files[name] = part
+                sink = os.fdopen(fd, 'wb')
+            else:
+                part = None
+                sink = None
+                value = bytearray()
+
+            # Copy the part body until the next delimiter, keeping back
+            # enough bytes to recognize a delimiter split across blocks.
+            try:
+                while True:
+                    index = buffer.find(delimiter)
+                    if index >= 0:
+                        data = buffer[:index]
+                    else:
+                        data = buffer[:max(0, len(buffer) - len(delimiter))]
+                    if sink is not None:
+                        sink.write(data)
+                        part.size += len(data)
+                    else:
+                        value += data
+                        if len(value) > max_field_bytes:
+                            raise UploadTooLarge(
+                                f'Form field {name} is too large')
+                    del buffer[:len(data)]
+                    if index >= 0:
+                        del buffer[:len(delimiter)]
+                        break
+                    if not fill():
+                        raise MultipartError('Malformed multipart body')
+            finally:
+                if sink is not None:
+                    sink.close()
+            if part is None:
+                try:
+                    form.fields[name] = value.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise MultipartError(
+                        f'Form field {name} is not valid UTF-8') from None
+    except BaseException:
+        form.cleanup()
+        raise
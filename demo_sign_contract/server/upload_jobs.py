@@ -0,0 +1,248 @@
+# A durable queue of upload jobs.
+#
+# /upload_contract only stages the uploaded file and queues a job; a pool of
+# worker threads stores it in Walrus and creates the version.  Jobs live in
+# a SQLite table and their files in a spool directory, so queued jobs, and
+# jobs interrupted by a crash, are picked up again when the server restarts.
+#
+# A job is 'queued', 'running', 'succeeded' or 'failed'.  A job whose client
+# or base version does not exist (local_db.NotFound) fails at once; any other
+# failure, including a malformed publisher reply, is treated as transient
+# and retried with exponential backoff, up to MAX_ATTEMPTS times.  Retrying
+# is safe: storing the same content again is answered by the digest index
+# and the existing version is returned.
+#
+# A job's spooled file is deleted once the job succeeds or fails.  Files
+# left behind by a crash (e.g. between spooling a file and queueing its
+# job) are swept when the queue starts.
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import local_db
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# Delay before the first retry, doubled after each further failure.
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    client_id TEXT NOT NULL,
+    version_id TEXT,
+    filename TEXT NOT NULL,
+    path TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    error TEXT,
+    result TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_next_attempt
+    ON jobs (state, next_attempt);
+"""
+
+_COLUMNS = ('id', 'state', 'client_id', 'version_id', 'filename', 'attempts',
+            'error', 'result', 'created_at', 'updated_at')
+
+
+class JobQueue(object):
+
+    # `upload(filepath, client_id, version_id)` stores a file and returns
+    # the new model.Version, like versioned_walrus.UploadFileOnVersion.
+    def __init__(self,
+                 path: str,
+                 spool_dir: str,
+                 upload,
+                 workers: int = 4,
+                 max_attempts: int = MAX_ATTEMPTS,
+                 retry_delay: float = RETRY_DELAY):
+        self.path = path
+        self.spool_dir = spool_dir
+        self._upload = upload
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+        # Serializes claiming jobs and wakes idle workers.
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        os.makedirs(spool_dir, exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+
+    # One connection per thread; sqlite3 connections must not be shared.
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    # Requeues the jobs a previous process left running, deletes the spooled
+    # files no pending job uses and starts the workers.
+    def start(self) -> None:
+        with self._conn() as conn:
+            conn.execute('UPDATE jobs SET state = ? WHERE state = ?',
+                         (QUEUED, RUNNING))
+        self._sweep()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name=f'upload_jobs-{i}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Deletes the files in the spool directory that belong to no queued job.
+    # Called before the workers start, so no job is being submitted.
+    def _sweep(self) -> None:
+        pending = {
+            os.path.basename(row[0])
+            for row in self._conn().execute(
+                'SELECT path FROM jobs WHERE state = ?', (QUEUED, ))
+        }
+        for name in os.listdir(self.spool_dir):
+            if name not in pending:
+                logger.info('deleting orphaned upload %s', name)
+                os.remove(os.path.join(self.spool_dir, name))
+
+    # Lets the running jobs finish and stops the workers.
+    def stop(self) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    # Queues the upload of the file at `filepath`, which is moved into the
+    # spool directory.  Returns the job ID.
+    def submit(self, filepath: str, filename: str, client_id: str,
+               version_id: str) -> str:
+        job_id = uuid.uuid4().hex
+        spooled = os.path.join(self.spool_dir, job_id)
+        os.replace(filepath, spooled)
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    'INSERT INTO jobs (id, state, client_id, version_id, '
+                    'filename, path, next_attempt, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, QUEUED, client_id, version_id, filename,
+                     spooled, now, now, now))
+        except BaseException:
+            os.remove(spooled)
+            raise
+        with self._cond:
+            self._cond.notify()
+        return job_id
+
+    # Returns a job as a dict, or None if it is unknown.
+    def get(self, job_id: str) -> dict:
+        row = self._conn().execute(
+            f'SELECT {", ".join(_COLUMNS)} FROM jobs WHERE id = ?',
+            (job_id, )).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        job['version'] = json.loads(job.pop('result') or 'null')
+        return job
+
+    # Marks the next due job as running.  Returns (id, client ID, version
+    # ID, path, attempts), or the seconds until a job is due (None if there
+    # is none).
+    def _claim(self):
+        now = time.time()
+        with self._conn() as conn:
+            row = conn.execute(
+                'SELECT id, client_id, version_id, path, attempts, '
+                'next_attempt FROM jobs WHERE state = ? '
+                'ORDER BY next_attempt LIMIT 1', (QUEUED, )).fetchone()
+            if row is None:
+                return None
+            if row[5] > now:
+                return row[5] - now
+            conn.execute(
+                'UPDATE jobs SET state = ?, attempts = attempts + 1, '
+                'updated_at = ? WHERE id = ?', (RUNNING, now, row[0]))
+        return row[:5]
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    claimed = self._claim()
+                    if isinstance(claimed, tuple):
+                        break
+                    self._cond.wait(claimed)
+            self._run(*claimed)
+
+    def _run(self, job_id: str, client_id: str, version_id: str, path: str,
+             attempts: int) -> None:
+        attempts += 1
+        try:
+            version = self._upload(path, client_id, version_id)
+        except Exception as e:
+            if (isinstance(e, local_db.NotFound) or
+                    attempts >= self.max_attempts):
+                logger.warning('upload job %s failed: %s', job_id, e)
+                self._finish(job_id, FAILED, error=str(e))
+            else:
+                delay = min(self.retry_delay * 2**(attempts - 1),
+                            MAX_RETRY_DELAY)
+                logger.info('upload job %s failed (%s), retrying in %.1fs',
+                            job_id, e, delay)
+                with self._conn() as conn:
+                    conn.execute(
+                        'UPDATE jobs SET state = ?, error = ?, '
+                        'next_attempt = ?, updated_at = ? WHERE id = ?',
+                        (QUEUED, str(e), time.time() + delay, time.time(),
+                         job_id))
+                with self._cond:
+                    self._cond.notify()
+            return
+        self._finish(job_id,
+                     SUCCEEDED,
+                     result={
+                         'blob_id': version.blob_id.bid,
+                         'alias': version.alias,
+                         'sequence': version.sequence,
+                         'storage': version.storage
+                     })
+        logger.info('upload job %s created version %s', job_id,
+                    version.blob_id.bid)
+
+    def _finish(self,
+                job_id: str,
+                state: str,
+                error: str = None,
+                result: dict = None) -> None:
+        with self._conn() as conn:
+            path = conn.execute('SELECT path FROM jobs WHERE id = ?',
+                                (job_id, )).fetchone()[0]
+            conn.execute(
+                'UPDATE jobs SET state = ?, error = ?, result = ?, '
+                'updated_at = ? WHERE id = ?',
+                (state, error, json.dumps(result) if result else None,
+                 time.time(), job_id))
+        if os.path.exists(path):
+            os.remove(path)
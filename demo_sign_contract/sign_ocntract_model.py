@@ -8,11 +8,19 @@ class Contract(object):
     contract_id: str
     versions: list[model.Version]
     name: str
+    # History of all versions of this contract.
+    graph: model.VersionGraph
+    # The versions by time and sequence number.
+    index: model.VersionIndex
 
-    def __init__(self, contract_id: str, versions: list[model.Version], name="default name"):
+    def __init__(self, contract_id: str, versions: list[model.Version], name="default name",
+                 graph: model.VersionGraph = None, index: model.VersionIndex = None):
         self.contract_id = contract_id
         self.versions = versions 
         self.name = name
+        self.graph = graph if graph is not None else model.VersionGraph()
+        self.index = index if index is not None else model.VersionIndex(
+            [v for v in versions if v.sequence is not None])
 
     def to_dict(self):
         return {
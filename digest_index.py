@@ -0,0 +1,85 @@
+# Maps content digests to the Walrus blob IDs they were stored as.
+#
+# A Walrus blob ID is derived from the erasure coded content and cannot be
+# computed cheaply on the client, so we remember the SHA-256 of every file
+# we store.  Uploading identical content again is then answered locally
+# without a Walrus call.
+#
+# The index is an append-only file of JSON lines kept next to the local DB
+# and loaded into memory once.  Each append is fsynced; a torn last line
+# from a crash is cut off on load, so the next append starts a new line.
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+_BLOCK_SIZE = 1024 * 1024
+
+
+# Returns the hex SHA-256 of a file, reading it in blocks.
+def FileDigest(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Returns the hex SHA-256 of in-memory data.
+def BytesDigest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class DigestIndex(object):
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._blob_ids = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        good_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn last line from a crash.
+                    break
+                good_bytes += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning('skipping corrupt line in %s', self.path)
+                    continue
+                self._blob_ids[entry['digest']] = entry['blob_id']
+        if good_bytes != os.path.getsize(self.path):
+            logger.warning('truncating torn line in %s', self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_bytes)
+
+    # Returns the blob ID stored for `digest`, or None.
+    def lookup(self, digest: str) -> str:
+        with self._lock:
+            return self._blob_ids.get(digest)
+
+    def record(self, digest: str, blob_id: str) -> None:
+        with self._lock:
+            if self._blob_ids.get(digest) == blob_id:
+                return
+            self._blob_ids[digest] = blob_id
+            with open(self.path, 'a') as f:
+                f.write(
+                    json.dumps({
+                        'digest': digest,
+                        'blob_id': blob_id
+                    }) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._blob_ids)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Local stand-ins for Walrus.
+#
+# FakePublisher is an in-memory publisher/aggregator.  It speaks the same
+# HTTP API that HttpTransport uses, so the library can be exercised without
+# network access or testnet config:
+#
+#   publisher = fake_walrus.FakePublisher()
+#   publisher.start()
+#   versioned_walrus.SetTransport(
+#       walrus_transport.HttpTransport(publisher.url))
+#   ...
+#   publisher.stop()
+#
+# Run as a program, this file is a fake `walrus` binary for
+# SubprocessTransport: `fake_walrus.py json` reads the same JSON commands as
+# `walrus json` and keeps blobs in the directory $FAKE_WALRUS_DIR.
+#
+# Blob IDs are derived from the content, so storing the same bytes twice
+# returns an `alreadyCertified` reply, like the real service; FakePublisher
+# stores a blob anew once `current_epoch` reaches its end epoch.  Both fakes
+# can add latency to every call to stand in for the network:
+# FakePublisher(store_latency=..., read_latency=...) and
+# $FAKE_WALRUS_STORE_LATENCY / $FAKE_WALRUS_READ_LATENCY, in seconds.
+import base64
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.parse
+
+
+def BlobIdForContent(data: bytes) -> str:
+    digest = hashlib.sha256(data).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+
+# Returns the Walrus JSON reply for storing a blob.
+def StoreReply(blob_id: str, size: int, created: bool, start_epoch: int,
+               end_epoch: int) -> dict:
+    if not created:
+        return {
+            'alreadyCertified': {
+                'blobId': blob_id,
+                'endEpoch': end_epoch
+            }
+        }
+    return {
+        'newlyCreated': {
+            'blobObject': {
+                'id': '0x' + hashlib.sha256(blob_id.encode()).hexdigest(),
+                'blobId': blob_id,
+                'size': size,
+                'storage': {
+                    'startEpoch': start_epoch,
+                    'endEpoch': end_epoch
+                }
+            }
+        }
+    }
+
+
+# Sleeps for about `latency` seconds, +/- `jitter` of it.
+def _Delay(latency: float, jitter: float) -> None:
+    if latency > 0:
+        time.sleep(latency * random.uniform(1 - jitter, 1 + jitter))
+
+
+class _FakePublisherHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent separately; without TCP_NODELAY the body
+    # waits for the client's delayed ACK, adding ~40 ms to every call.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/v1/store':
+            self._reply(404, b'Not found', 'text/plain')
+            return
+        epochs = int(
+            urllib.parse.parse_qs(url.query).get('epochs', ['1'])[0])
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        publisher = self.server.publisher
+        _Delay(publisher.store_latency, publisher.jitter)
+        reply = publisher.store(data, epochs)
+        self._reply(200, json.dumps(reply).encode('utf-8'),
+                    'application/json')
+
+    def do_GET(self):
+        publisher = self.server.publisher
+        _Delay(publisher.read_latency, publisher.jitter)
+        blob_id = urllib.parse.unquote(self.path[len('/v1/'):])
+        data = publisher.blobs.get(blob_id)
+        if not self.path.startswith('/v1/') or data is None:
+            self._reply(404, b'Blob not found', 'text/plain')
+            return
+        self._reply(200, data, 'application/octet-stream')
+
+
+class FakePublisher(object):
+
+    # `store_latency` and `read_latency` are added to every call, in
+    # seconds, varied by +/- `jitter` of their value.
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 store_latency: float = 0,
+                 read_latency: float = 0,
+                 jitter: float = 0):
+        self.store_latency = store_latency
+        self.read_latency = read_latency
+        self.jitter = jitter
+        self.blobs = {}
+        # Blob ID -> end epoch
+        self.end_epochs = {}
+        self.current_epoch = 1
+        self.store_calls = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _FakePublisherHandler)
+        self._server.daemon_threads = True
+        self._server.publisher = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    # Returns the Walrus JSON reply for storing `data`.
+    def store(self, data: bytes, epochs: int) -> dict:
+        blob_id = BlobIdForContent(data)
+        with self._lock:
+            self.store_calls += 1
+            # Expired blobs are stored again, like new ones.
+            created = self.end_epochs.get(blob_id, 0) <= self.current_epoch
+            if created:
+                self.blobs[blob_id] = data
+                self.end_epochs[blob_id] = self.current_epoch + epochs
+            end_epoch = self.end_epochs[blob_id]
+        return StoreReply(blob_id, len(data), created, self.current_epoch,
+                          end_epoch)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+# The fake `walrus json`: runs one JSON command read from stdin, like
+# {"config": ..., "command": {"store": {"file": ..., "epochs": ...}}} or
+# {"config": ..., "command": {"read": {"blobId": ..., "out": ...}}} or
+# {"config": ..., "command": {"extend": {"blobObjId": ..., ...}}}.
+def _RunJsonCommand(blob_dir: str) -> None:
+    command = json.load(sys.stdin)['command']
+    os.makedirs(blob_dir, exist_ok=True)
+    jitter = float(os.environ.get('FAKE_WALRUS_JITTER', 0))
+    if 'store' in command:
+        _Delay(float(os.environ.get('FAKE_WALRUS_STORE_LATENCY', 0)), jitter)
+        with open(command['store']['file'], 'rb') as f:
+            data = f.read()
+        blob_id = BlobIdForContent(data)
+        path = os.path.join(blob_dir, blob_id)
+        created = not os.path.exists(path)
+        if created:
+            tmp_path = f'{path}.tmp.{os.getpid()}'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        print(
+            json.dumps(
+                StoreReply(blob_id, len(data), created, 1,
+                           1 + command['store']['epochs'])))
+    elif 'read' in command:
+        _Delay(float(os.environ.get('FAKE_WALRUS_READ_LATENCY', 0)), jitter)
+        path = os.path.join(blob_dir, command['read']['blobId'])
+        if not os.path.exists(path):
+            sys.exit(f'Blob {command["read"]["blobId"]} not found')
+        shutil.copyfile(path, command['read']['out'])
+    elif 'extend' in command:
+        # Blobs never expire here.
+        print(json.dumps({}))
+    else:
+        sys.exit(f'Unsupported command {command}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['json']:
+        sys.exit(f'Usage: {sys.argv[0]} json < command.json')
+    _RunJsonCommand(
+        os.environ.get('FAKE_WALRUS_DIR',
+                       os.path.join(tempfile.gettempdir(), 'fake_walrus')))
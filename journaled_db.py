@@ -0,0 +1,226 @@
+# Journaled mode for the JSON DB.
+#
+# The snapshot is the regular local_db.json file.  Every mutation is appended
+# to `<snapshot>.log` as one JSON line and fsynced before it is applied in
+# memory, so a write costs one small append instead of a full rewrite and a
+# crash can at worst lose a torn last line.
+#
+# On startup the snapshot is loaded and the log replayed.  Once the log grows
+# past `compact_bytes`, a background thread writes a new snapshot and drops
+# the records it covers:
+#   1. Under the lock, the current log is renamed to `<snapshot>.log.old`, a
+#      fresh log is started and the in-memory state is copied.
+#   2. The copy is written to a temporary file and atomically renamed over
+#      the snapshot.
+#   3. `<snapshot>.log.old` is deleted.
+# If a previous compaction failed before step 3, `<snapshot>.log.old` still
+# holds records no snapshot covers; step 1 then appends the current log to
+# it instead of replacing it, so it is only ever deleted once a snapshot
+# covering it is written.  Each record carries a sequence number and the
+# snapshot stores the last one it includes, so a crash at any step replays
+# each record exactly once.
+import copy
+import json
+import logging
+import os
+import threading
+
+import local_db
+
+logger = logging.getLogger(__name__)
+
+_SEQ_KEY = 'journal_seq'
+
+
+class JournaledJsonBackend(object):
+
+    def __init__(self,
+                 path: str = local_db.DB_PATH,
+                 compact_bytes: int = 4 * 1024 * 1024):
+        self.path = path
+        self.log_path = path + '.log'
+        self.old_log_path = path + '.log.old'
+        self.compact_bytes = compact_bytes
+        self._lock = threading.Lock()
+        self._compactor = None
+        self._db, self._seq = self._recover()
+        self._log = open(self.log_path, 'ab')
+
+    # Loads the snapshot and replays the logs on top of it.
+    def _recover(self) -> tuple:
+        with open(self.path, 'r') as f:
+            db = json.load(f)
+        seq = db.pop(_SEQ_KEY, 0)
+        for log_path in (self.old_log_path, self.log_path):
+            seq = self._replay(db, seq, log_path)
+        return db, seq
+
+    def _replay(self, db: dict, seq: int, log_path: str) -> int:
+        if not os.path.exists(log_path):
+            return seq
+        good_bytes = 0
+        with open(log_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write from a crash.  Nothing after it was
+                    # acknowledged.
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good_bytes += len(line)
+                if record['seq'] > seq:
+                    local_db.ApplyMutation(db, record)
+                    seq = record['seq']
+        if good_bytes != os.path.getsize(log_path):
+            logger.warning('truncating torn journal record in %s', log_path)
+            with open(log_path, 'r+b') as f:
+                f.truncate(good_bytes)
+        return seq
+
+    # Appends the records that would apply, fsyncs once, then applies them
+    # in memory.  Returns one error (or None) per record.
+    def apply_batch(self, records: list[dict]) -> list:
+        with self._lock:
+            errors = []
+            lines = []
+            accepted = []
+            for record in records:
+                # Reject records that would not apply before making them
+                # durable.  A record may depend on an earlier record of the
+                # same batch (e.g. a contract added just before), so on a
+                # failed check the records accepted so far are written and
+                # applied and the check is repeated.
+                try:
+                    local_db.CheckMutation(self._db, record)
+                except ValueError as e:
+                    if not accepted:
+                        errors.append(e)
+                        continue
+                    self._apply_accepted(accepted, lines)
+                    accepted = []
+                    lines = []
+                    try:
+                        local_db.CheckMutation(self._db, record)
+                    except ValueError as e:
+                        errors.append(e)
+                        continue
+                self._seq += 1
+                record['seq'] = self._seq
+                lines.append(
+                    json.dumps(record, separators=(',', ':')).encode('utf-8') +
+                    b'\n')
+                accepted.append(record)
+                errors.append(None)
+            self._apply_accepted(accepted, lines)
+            if (self._log.tell() >= self.compact_bytes and
+                    self._compactor is None):
+                self._compactor = threading.Thread(target=self.compact,
+                                                   daemon=True)
+                self._compactor.start()
+            return errors
+
+    # Writes and fsyncs `lines`, then applies `records`.  Called with the lock
+    # held.
+    def _apply_accepted(self, records: list[dict], lines: list[bytes]) -> None:
+        if not records:
+            return
+        try:
+            self._log.write(b''.join(lines))
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        except BaseException:
+            self._seq = records[0]['seq'] - 1
+            raise
+        for record in records:
+            local_db.ApplyMutation(self._db, record)
+
+    def _append(self, record: dict) -> None:
+        error = self.apply_batch([record])[0]
+        if error is not None:
+            raise error
+
+    # Writes a new snapshot and drops the log records it covers.
+    def compact(self) -> None:
+        try:
+            with self._lock:
+                self._log.close()
+                if os.path.exists(self.old_log_path):
+                    # A previous compaction did not finish, and no snapshot
+                    # covers its records yet.
+                    self._append_log(self.log_path, self.old_log_path)
+                    os.remove(self.log_path)
+                else:
+                    os.replace(self.log_path, self.old_log_path)
+                self._log = open(self.log_path, 'ab')
+                snapshot = copy.deepcopy(self._db)
+                snapshot[_SEQ_KEY] = self._seq
+            local_db.WriteJsonAtomically(self.path, snapshot)
+            os.remove(self.old_log_path)
+        finally:
+            self._compactor = None
+
+    # Appends the log at `src_path` to the one at `dst_path` and fsyncs it.
+    # A crash midway leaves a torn record at the end, which recovery drops;
+    # the records are still in `src_path`.
+    @staticmethod
+    def _append_log(src_path: str, dst_path: str) -> None:
+        with open(src_path, 'rb') as src, open(dst_path, 'ab') as dst:
+            for block in iter(lambda: src.read(1024 * 1024), b''):
+                dst.write(block)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+    def load(self) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._db)
+
+    def save(self, db: dict) -> None:
+        self._append({'op': 'replace', 'db': db})
+
+    def list_clients(self) -> list[dict]:
+        return self.load()['clients']
+
+    def get_client(self, client_id: str) -> dict:
+        with self._lock:
+            return copy.deepcopy(local_db._FindClient(self._db, client_id))
+
+    def add_client(self, client: dict) -> None:
+        self._append({'op': 'add_client', 'client': client})
+
+    def add_contract(self, client_id: str, contract: dict) -> None:
+        self._append({
+            'op': 'add_contract',
+            'client_id': client_id,
+            'contract': contract
+        })
+
+    def add_version(self, client_id: str, contract_id: str,
+                    version: dict) -> None:
+        self._append({
+            'op': 'add_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'version': version
+        })
+
+    def add_versions(self, versions: list[tuple]) -> None:
+        self._append({'op': 'add_versions', 'versions': versions})
+
+    def update_version(self, client_id: str, contract_id: str, blob_id: str,
+                       fields: dict) -> None:
+        self._append({
+            'op': 'update_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'blob_id': blob_id,
+            'fields': fields
+        })
+
+    def close(self) -> None:
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            self._log.close()
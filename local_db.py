@@ -2,23 +2,592 @@
 #
 # The local DB stores the user data, the contracts metadata and other sensitive
 # data.
+#
+# The storage engine is pluggable.  JsonBackend keeps everything in one JSON
+# file; sqlite_db.SqliteBackend keeps clients, contracts and versions in
+# indexed tables so reads and writes only touch the rows involved;
+# journaled_db.JournaledJsonBackend appends each mutation to a log next to
+# the JSON file; sharded_db.ShardedJsonBackend keeps one JSON file per
+# client.  Set LOCAL_DB_BACKEND to sqlite, journal or sharded, or call
+# SetBackend(), to switch.
+import contextlib
 import json
+import logging
+import os
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'local_db.json'
+SQLITE_DB_PATH = 'local_db.sqlite'
+# Directory of the sharded DB, see sharded_db.py.
+SHARDS_PATH = 'local_db.shards'
+# Index of content digests to Walrus blob IDs, see digest_index.py.
+DIGEST_INDEX_PATH = 'local_db.digests.jsonl'
+# Expiry epochs of stored blobs, see blob_lifetime.py.
+LIFETIMES_PATH = 'local_db.lifetimes.jsonl'
+
+
+# Writes `data` to a temporary file and renames it over `path`, so readers
+# and crashes see either the old or the new file, never a partial one.
+def WriteJsonAtomically(path: str, data) -> None:
+    tmp_path = f'{path}.tmp.{os.getpid()}.{threading.get_ident()}'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Raised for an unknown client, contract or version.  A ValueError, like the
+# other errors of invalid requests.
+class NotFound(ValueError):
+    pass
+
+
+# Raised when a version is added to a contract that already has a version
+# with the same blob ID, e.g. by two concurrent uploads of the same file.
+class VersionExists(ValueError):
+
+    def __init__(self, contract_id: str, blob_id: str):
+        super().__init__(
+            f'Contract {contract_id} already has version {blob_id}.')
+        self.contract_id = contract_id
+        self.blob_id = blob_id
+
+
+def _FindClient(db: dict, client_id: str) -> dict:
+    for client in db['clients']:
+        if client['client_id'] == client_id:
+            return client
+    raise NotFound(f"Client with ID {client_id} not found.")
+
+
+def _FindContract(client: dict, contract_id: str) -> dict:
+    for contract in client['contracts']:
+        if contract['contract_id'] == contract_id:
+            return contract
+    raise NotFound(f"Contract with ID {contract_id} not found.")
+
+
+def _FindVersion(contract: dict, blob_id: str) -> dict:
+    for version in contract['versions']:
+        if version['blob_id'] == blob_id:
+            return version
+    raise NotFound(f"Version with blob ID {blob_id} not found.")
+
+
+# Mutations are plain dicts, e.g.
+#   {'op': 'add_version', 'client_id': ..., 'contract_id': ...,
+#    'version': {...}}
+# so backends can batch them and journaled_db can log them as they are.
+# The ops are add_client, add_contract, add_version, add_versions,
+# update_version and replace (the whole DB).
+
+
+# Raises ValueError if `mutation` refers to a missing client, contract or
+# version, and VersionExists if it adds a version its contract already has.
+# Backends check under the written clients' locks, so of two concurrent
+# appends of the same version only the first is applied.
+def CheckMutation(db: dict, mutation: dict) -> None:
+    op = mutation['op']
+    if op == 'add_versions':
+        added = set()
+        for client_id, contract_id, version in mutation['versions']:
+            contract = _FindContract(_FindClient(db, client_id), contract_id)
+            key = (client_id, contract_id, version['blob_id'])
+            if key in added:
+                raise VersionExists(contract_id, version['blob_id'])
+            added.add(key)
+            _CheckNewVersion(contract, version)
+    elif op in ('add_contract', 'add_version', 'update_version'):
+        client = _FindClient(db, mutation['client_id'])
+        if op != 'add_contract':
+            contract = _FindContract(client, mutation['contract_id'])
+            if op == 'update_version':
+                _FindVersion(contract, mutation['blob_id'])
+            elif op == 'add_version':
+                _CheckNewVersion(contract, mutation['version'])
+    elif op not in ('add_client', 'replace'):
+        raise ValueError(f'Unknown mutation {op}')
+
+
+def _CheckNewVersion(contract: dict, version: dict) -> None:
+    blob_id = version['blob_id']
+    if any(v['blob_id'] == blob_id for v in contract['versions']):
+        raise VersionExists(contract['contract_id'], blob_id)
+
+
+# Appends a version record, numbering it after the versions before it.  The
+# number is also set on the caller's record.
+def _AppendVersion(contract: dict, version: dict) -> None:
+    version.setdefault('sequence', len(contract['versions']) + 1)
+    contract['versions'].append(version)
+
+
+# Applies one mutation to an in-memory DB.
+def ApplyMutation(db: dict, mutation: dict) -> None:
+    op = mutation['op']
+    if op == 'add_client':
+        db['clients'].append(mutation['client'])
+    elif op == 'add_contract':
+        _FindClient(db, mutation['client_id'])['contracts'].append(
+            mutation['contract'])
+    elif op == 'add_version':
+        client = _FindClient(db, mutation['client_id'])
+        _AppendVersion(_FindContract(client, mutation['contract_id']),
+                       mutation['version'])
+    elif op == 'add_versions':
+        for client_id, contract_id, version in mutation['versions']:
+            _AppendVersion(_FindContract(_FindClient(db, client_id),
+                                         contract_id), version)
+    elif op == 'update_version':
+        client = _FindClient(db, mutation['client_id'])
+        contract = _FindContract(client, mutation['contract_id'])
+        _FindVersion(contract, mutation['blob_id']).update(mutation['fields'])
+    elif op == 'replace':
+        db.clear()
+        db.update(mutation['db'])
+    else:
+        raise ValueError(f'Unknown mutation {op}')
+
+
+# Returns the IDs of the clients a mutation writes to, or None if it writes
+# the whole DB.
+def MutationClients(mutation: dict) -> set:
+    op = mutation['op']
+    if op == 'replace':
+        return None
+    if op == 'add_client':
+        return {mutation['client']['client_id']}
+    if op == 'add_versions':
+        return {client_id for client_id, _, _ in mutation['versions']}
+    return {mutation['client_id']}
+
+
+# Keeps the whole DB in one JSON file.  Every operation loads the file and
+# every batch of mutations rewrites it once.
+class JsonBackend(object):
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+
+    def load(self) -> dict:
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self, db: dict) -> None:
+        WriteJsonAtomically(self.path, db)
+
+    def list_clients(self) -> list[dict]:
+        return self.load()['clients']
+
+    def get_client(self, client_id: str) -> dict:
+        return _FindClient(self.load(), client_id)
+
+    # Applies mutations in order with a single load and a single rewrite.
+    # Returns one error (or None) per mutation; a mutation that fails is
+    # skipped and does not affect the others.
+    def apply_batch(self, mutations: list[dict]) -> list:
+        db = self.load()
+        errors = []
+        for mutation in mutations:
+            try:
+                CheckMutation(db, mutation)
+                ApplyMutation(db, mutation)
+                errors.append(None)
+            except ValueError as e:
+                errors.append(e)
+        if any(e is None for e in errors):
+            self.save(db)
+        return errors
+
+    def _apply(self, mutation: dict) -> None:
+        error = self.apply_batch([mutation])[0]
+        if error is not None:
+            raise error
+
+    def add_client(self, client: dict) -> None:
+        self._apply({'op': 'add_client', 'client': client})
+
+    def add_contract(self, client_id: str, contract: dict) -> None:
+        self._apply({
+            'op': 'add_contract',
+            'client_id': client_id,
+            'contract': contract
+        })
+
+    def add_version(self, client_id: str, contract_id: str,
+                    version: dict) -> None:
+        self._apply({
+            'op': 'add_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'version': version
+        })
+
+    def add_versions(self, versions: list[tuple]) -> None:
+        self._apply({'op': 'add_versions', 'versions': versions})
+
+    def update_version(self, client_id: str, contract_id: str, blob_id: str,
+                       fields: dict) -> None:
+        self._apply({
+            'op': 'update_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'blob_id': blob_id,
+            'fields': fields
+        })
+
+    def close(self) -> None:
+        pass
+
+
+# A readers-writer lock that prefers writers.  The thread holding the write
+# side may take either side again; readers must not nest.
+class RWLock(object):
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self) -> None:
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writer_depth += 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writer_depth -= 1
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self) -> None:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self) -> None:
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class _PendingMutation(object):
+
+    def __init__(self, mutation: dict):
+        self.mutation = mutation
+        self.error = None
+        self.lead = False
+        self.done = threading.Event()
+
+
+# Group commit.  Writers queue their mutation; the first one in becomes the
+# leader and commits everything queued so far as one backend batch (one
+# JSON rewrite, one journal fsync or one SQLite transaction), then hands
+# leadership to the next queued writer, if any.  Mutations arriving while a
+# batch is being written wait for the next one, so under load the cost of a
+# write is shared by every mutation in its batch.
+class GroupCommitter(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._active = False
+
+    def commit(self, backend, mutation: dict) -> None:
+        entry = _PendingMutation(mutation)
+        with self._lock:
+            self._pending.append(entry)
+            lead = not self._active
+            self._active = True
+        if not lead:
+            entry.done.wait()
+            if not entry.lead:
+                if entry.error is not None:
+                    raise entry.error
+                return
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+        try:
+            try:
+                errors = backend.apply_batch([e.mutation for e in batch])
+            except Exception as e:
+                errors = [e] * len(batch)
+            for pending, error in zip(batch, errors):
+                pending.error = error
+        finally:
+            for pending in batch:
+                if pending is not entry:
+                    pending.done.set()
+            with self._lock:
+                if self._pending:
+                    self._pending[0].lead = True
+                    self._pending[0].done.set()
+                else:
+                    self._active = False
+        if entry.error is not None:
+            raise entry.error
+
+
+_lock = threading.Lock()
+_backend = None
+
+
+def _DefaultBackend():
+    if os.environ.get('LOCAL_DB_BACKEND') == 'sqlite':
+        import sqlite_db
+        return sqlite_db.SqliteBackend(SQLITE_DB_PATH)
+    if os.environ.get('LOCAL_DB_BACKEND') == 'journal':
+        import journaled_db
+        return journaled_db.JournaledJsonBackend(DB_PATH)
+    if os.environ.get('LOCAL_DB_BACKEND') == 'sharded':
+        import sharded_db
+        return sharded_db.ShardedJsonBackend(SHARDS_PATH)
+    return JsonBackend(DB_PATH)
+
+
+# Returns the process-wide storage backend, creating it on first use.
+def GetBackend():
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = _DefaultBackend()
+        return _backend
+
+
+# Replaces the storage backend.  Passing None restores the default on next
+# use.
+def SetBackend(backend) -> None:
+    global _backend
+    with _lock:
+        if _backend is not None and _backend is not backend:
+            _backend.close()
+        _backend = backend
+
+
+# Concurrency model.  Reads and mutations of one client hold that client's
+# lock (shared for reads, exclusive for writes), and every per-client
+# operation also holds the DB lock shared.  Whole-DB writers take the DB lock
+# exclusively; wrap a LoadDatabase/SaveDatabase round trip in
+# `with ExclusiveAccess():` so no other write lands in between.  Writes go
+# through one GroupCommitter, so concurrent writers for different clients
+# share a single backend write instead of racing on it.
+_db_lock = RWLock()
+_client_locks = {}
+_client_locks_lock = threading.Lock()
+_committer = GroupCommitter()
+
+# Generations let caches of DB data notice changes.  Every committed
+# mutation bumps the generation of each client it writes; replacing the
+# whole DB starts a new epoch.
+_epoch = 0
+_commits = 0
+_generations = {}
+_generation_lock = threading.Lock()
+_listeners = []
+
+
+# Returns the lock guarding one client's records.
+def ClientLock(client_id: str) -> RWLock:
+    with _client_locks_lock:
+        lock = _client_locks.get(client_id)
+        if lock is None:
+            lock = _client_locks[client_id] = RWLock()
+        return lock
+
+
+# Holds the whole DB exclusively, e.g. for a LoadDatabase/SaveDatabase round
+# trip.
+def ExclusiveAccess():
+    return _db_lock.write_locked()
+
+
+# Returns the generation of a client's records as an (epoch, count) pair.  It
+# changes whenever a write to that client is committed by this process.
+def ClientGeneration(client_id: str) -> tuple:
+    return _epoch, _generations.get(client_id, 0)
+
+
+# Returns the generation of the whole DB as an (epoch, count) pair.  It
+# changes whenever this process commits a write.
+def Generation() -> tuple:
+    return _epoch, _commits
+
+
+# Registers `listener(mutation, client_ids)` to be called after each
+# committed mutation, while the written clients are still locked, so
+# listeners see the commits of a client in order.  Generations are bumped
+# right after the listeners return.  `client_ids` is None when
+# the whole DB was replaced, and `mutation` is None when a write failed
+# midway and may or may not have landed.  Listeners must not call back into
+# local_db.
+def AddCommitListener(listener) -> None:
+    _listeners.append(listener)
+
+
+def _Committed(mutation: dict, client_ids: set) -> None:
+    global _epoch, _commits
+    # Listeners run before the generations move, so a cache that reads the
+    # new generation has already been told about the write.
+    for listener in _listeners:
+        listener(mutation, client_ids)
+    with _generation_lock:
+        _commits += 1
+        if client_ids is None:
+            _epoch += 1
+            _generations.clear()
+        else:
+            for client_id in client_ids:
+                _generations[client_id] = _generations.get(client_id, 0) + 1
+
+
+def _Commit(mutation: dict) -> None:
+    with metrics.Stage('db_save'):
+        _CommitLocked(mutation)
+
+
+def _CommitLocked(mutation: dict) -> None:
+    client_ids = MutationClients(mutation)
+    if client_ids is None:
+        with _db_lock.write_locked():
+            try:
+                _committer.commit(GetBackend(), mutation)
+            finally:
+                _Committed(mutation, None)
+        return
+    # Sorted, so writers spanning several clients cannot deadlock.
+    locks = [ClientLock(client_id) for client_id in sorted(client_ids)]
+    with _db_lock.read_locked():
+        for lock in locks:
+            lock.acquire_write()
+        try:
+            try:
+                _committer.commit(GetBackend(), mutation)
+            except ValueError:
+                # Rejected before anything was written.
+                raise
+            except BaseException:
+                # The write may or may not have landed; make caches reload.
+                _Committed(None, client_ids)
+                raise
+            _Committed(mutation, client_ids)
+        finally:
+            for lock in reversed(locks):
+                lock.release_write()
 
 
 # Load the data from JSON file
 def LoadDatabase():
-    with open('local_db.json', 'r') as f:
-        return json.load(f)
+    with metrics.Stage('db_load'), _db_lock.read_locked():
+        return GetBackend().load()
 
 
 # Save the data back to the JSON file
 def SaveDatabase(db: str):
-    print('Updating db with ', db)
-    backup = LoadDatabase()
-    try:
-        with open('local_db.json', 'w') as f:
-            json.dump(db, f, indent=4)
-    except Exception as e:
-        # Restore db on any failures
-        with open('local_db.json', 'w') as f:
-            json.dump(backup, f, indent=4)
+    logger.debug('saving the whole DB, %d clients', len(db['clients']))
+    _Commit({'op': 'replace', 'db': db})
+
+
+# Returns the raw dict of one client.  Raises ValueError if it is unknown.
+def GetClient(client_id: str) -> dict:
+    with metrics.Stage('db_load'), _db_lock.read_locked():
+        with ClientLock(client_id).read_locked():
+            return GetBackend().get_client(client_id)
+
+
+# Returns the raw dicts of all clients.
+def ListClients() -> list[dict]:
+    with metrics.Stage('db_load'), _db_lock.read_locked():
+        return GetBackend().list_clients()
+
+
+# Adds a new client.
+def AddClient(client: dict) -> None:
+    _Commit({'op': 'add_client', 'client': client})
+
+
+# Appends a new contract to a client.
+def AddContract(client_id: str, contract: dict) -> None:
+    _Commit({
+        'op': 'add_contract',
+        'client_id': client_id,
+        'contract': contract
+    })
+
+
+# Appends a new version to a contract.  The version's `sequence` number is
+# set on `version`.  Raises VersionExists if the contract already has it.
+def AddVersion(client_id: str, contract_id: str, version: dict) -> None:
+    _Commit({
+        'op': 'add_version',
+        'client_id': client_id,
+        'contract_id': contract_id,
+        'version': version
+    })
+
+
+# Appends many versions, given as (client_id, contract_id, version) tuples,
+# in one write.  Either all or none of them are added; none are if any of
+# them exists (VersionExists).
+def AddVersions(versions: list[tuple]) -> None:
+    if versions:
+        _Commit({'op': 'add_versions', 'versions': versions})
+
+
+# Updates fields (e.g. signatures) of an existing version.
+def UpdateVersion(client_id: str, contract_id: str, blob_id: str,
+                  fields: dict) -> None:
+    _Commit({
+        'op': 'update_version',
+        'client_id': client_id,
+        'contract_id': contract_id,
+        'blob_id': blob_id,
+        'fields': fields
+    })
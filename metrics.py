@@ -0,0 +1,128 @@
+# Process-wide latency histograms, exposed in the Prometheus text format.
+#
+#   with metrics.Stage('db_load'):
+#       db = ...
+#
+# times one stage of a request into STAGE_SECONDS.  The stages are
+#   db_load          reading records from the local DB
+#   db_save          committing a write to the local DB
+#   lookup           finding clients, contracts and versions
+#   walrus_spawn     starting a `walrus` process
+#   walrus_transfer  a Walrus store or read, once connected or spawned
+#   json_parse       parsing Walrus replies and request bodies
+#   seal             compressing and encrypting a file before it is stored
+#
+# Render() returns every registered histogram for a /metrics endpoint.
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _EscapeLabel(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _FormatNumber(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Series(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets: int):
+        # Observations per bucket; the last one is +Inf.
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(object):
+
+    # Registers the histogram for Render().  Every observation must give a
+    # value for each of `labelnames`.
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Label values -> _Series
+        self._series = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self.buckets))
+            series.counts[bucket] += 1
+            series.sum += value
+            series.count += 1
+
+    # Times the body of a `with` block.
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [
+            f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram'
+        ]
+        with self._lock:
+            series = sorted((key, list(s.counts), s.sum, s.count)
+                            for key, s in self._series.items())
+        for key, counts, total, count in series:
+            labels = [
+                f'{name}="{_EscapeLabel(value)}"'
+                for name, value in zip(self.labelnames, key)
+            ]
+            cumulative = 0
+            bounds = [_FormatNumber(b) for b in self.buckets] + ['+Inf']
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                lines.append(
+                    f'{self.name}_bucket{{{bucket_labels}}} {cumulative}')
+            suffix = '{' + ','.join(labels) + '}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total!r}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('versioned_walrus_stage_seconds',
+                          'Time spent in each stage of an operation.',
+                          ('stage',))
+
+
+# Times a stage, see the list above.
+def Stage(stage: str):
+    return STAGE_SECONDS.time(stage=stage)
+
+
+# Returns all registered histograms in the Prometheus text format.
+def Render() -> str:
+    with _registry_lock:
+        histograms = list(_registry)
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
@@ -1,42 +1,415 @@
+import array
+import base64
+import binascii
+import bisect
+import sys
+
+# Walrus blob IDs are the unpadded URL-safe base64 of 32 bytes.  They are
+# kept decoded, which takes 33 bytes for the bytes object's payload instead
+# of 43 characters.  Hydration interns them in a table that lives as long as
+# the hydration of one client, so the many references to one blob (as a
+# version, an initial blob and a parent, in any of the client's contracts)
+# share a single object without a process-wide table that only grows.
+_BLOB_ID_BYTES = 32
+
+
+# Returns the compact key of a blob ID string: its raw bytes if it is a
+# canonical Walrus blob ID, else the (interned) string itself, so IDs such
+# as 'null' round trip unchanged.  Raw keys are interned in `keys`, if
+# given.
+def BlobIdKey(bid: str, keys: dict = None):
+    if isinstance(bid, str) and len(bid) == 43:
+        try:
+            raw = base64.urlsafe_b64decode(bid + '=')
+        except (binascii.Error, ValueError):
+            raw = None
+        if (raw is not None and len(raw) == _BLOB_ID_BYTES and
+                base64.urlsafe_b64encode(raw)[:-1].decode('ascii') == bid):
+            return raw if keys is None else keys.setdefault(raw, raw)
+    if isinstance(bid, str):
+        return sys.intern(bid)
+    return bid
+
+
+# The inverse of BlobIdKey.
+def BlobIdString(key) -> str:
+    if isinstance(key, bytes):
+        return base64.urlsafe_b64encode(key)[:-1].decode('ascii')
+    return key
+
+
 class BlobID(object):
-    bid: str
+    __slots__ = ('key', 'timestamp')
+
+    # See BlobIdKey.
+    key: object
     timestamp: int
-    def __init__(self, bid, timestamp):
-      self.bid = bid
+
+    def __init__(self, bid, timestamp, keys: dict = None):
+      self.key = BlobIdKey(bid, keys)
       self.timestamp = timestamp
 
+    @property
+    def bid(self) -> str:
+        return BlobIdString(self.key)
+
     def to_dict(self):
         return {
             "bid": self.bid,
             "timestamp": self.timestamp
         }
 
+
+# The version history of a contract as a DAG.  Each version stores only its
+# parent(s).  Versions are numbered in the order they are added and their
+# first parent, depth, level and jump pointer are kept in flat arrays.
+#
+# Jump pointers follow the skew-binary scheme: each version points either at
+# its parent or far up the first-parent chain, so walking to any depth takes
+# O(log n) steps with a single pointer per version.  `is_ancestor` and
+# `common_base` are therefore O(log n) while the history has no merges.
+#
+# A graph is read without locks while a single writer adds versions: a
+# version only becomes visible through _numbers once its arrays are filled
+# in.
+class VersionGraph(object):
+
+    def __init__(self):
+        # Blob ID key -> version number.
+        self._numbers = {}
+        # Version number -> BlobID.
+        self._blob_ids = []
+        # First parent, or -1 for a root.
+        self._first = array.array('i')
+        # Parents after the first one, for merges only.
+        self._merge_parents = {}
+        # Distance to the root along first parents.
+        self._depth = array.array('i')
+        # 1 + the highest level of any parent.  An ancestor always has a
+        # lower level than its descendants.
+        self._level = array.array('i')
+        # Jump pointer along first parents; a root points at itself.
+        self._jump = array.array('i')
+
+    def _number(self, bid: str) -> int:
+        return self._numbers[BlobIdKey(bid)]
+
+    def __contains__(self, bid: str) -> bool:
+        return BlobIdKey(bid) in self._numbers
+
+    def __len__(self) -> int:
+        return len(self._blob_ids)
+
+    def _parents(self, n: int) -> list[int]:
+        if self._first[n] < 0:
+            return []
+        return [self._first[n]] + self._merge_parents.get(n, [])
+
+    def parents(self, bid: str) -> list[str]:
+        return [self._blob_ids[p].bid for p in self._parents(self._number(bid))]
+
+    def depth(self, bid: str) -> int:
+        return self._depth[self._number(bid)]
+
+    # Returns the graph's BlobID for `bid`, or None.
+    def get(self, bid: str) -> BlobID:
+        n = self._numbers.get(BlobIdKey(bid))
+        return self._blob_ids[n] if n is not None else None
+
+    # Adds a version.  Parents must already be in the graph; unknown
+    # parents are added as roots.  Re-adding a version is a no-op.
+    def add(self, blob_id: BlobID, parents: list[BlobID]) -> None:
+        if blob_id.key in self._numbers:
+            return
+        for parent in parents:
+            if parent.key not in self._numbers:
+                self.add(parent, [])
+        numbers = [self._numbers[p.key] for p in parents]
+        n = len(self._blob_ids)
+        if not numbers:
+            self._first.append(-1)
+            self._depth.append(0)
+            self._level.append(0)
+            self._jump.append(n)
+        else:
+            first = numbers[0]
+            if len(numbers) > 1:
+                self._merge_parents[n] = numbers[1:]
+            self._first.append(first)
+            self._depth.append(self._depth[first] + 1)
+            self._level.append(1 + max(self._level[p] for p in numbers))
+            jump = self._jump[first]
+            if (self._depth[first] - self._depth[jump] ==
+                    self._depth[jump] - self._depth[self._jump[jump]]):
+                self._jump.append(self._jump[jump])
+            else:
+                self._jump.append(first)
+        self._blob_ids.append(blob_id)
+        self._numbers[blob_id.key] = n
+
+    # Adds many versions given as {bid: (BlobID, [parent BlobIDs])}, in any
+    # order.
+    def add_all(self, versions: dict) -> None:
+        for bid in versions:
+            stack = [bid]
+            while stack:
+                top = stack[-1]
+                blob_id, parents = versions[top]
+                if blob_id.key in self._numbers:
+                    stack.pop()
+                    continue
+                missing = [
+                    p.bid for p in parents
+                    if p.key not in self._numbers and p.bid in versions and
+                    p.bid not in stack
+                ]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                self.add(blob_id, parents)
+                stack.pop()
+
+    # Returns the first-parent ancestor of version `n` at `depth`.
+    def _ancestor_at(self, n: int, depth: int) -> int:
+        while self._depth[n] > depth:
+            if self._depth[self._jump[n]] >= depth:
+                n = self._jump[n]
+            else:
+                n = self._first[n]
+        return n
+
+    # Returns the blob IDs of the first-parent chain above `bid`, oldest
+    # first.  This is what `previous_versions` used to hold.
+    def first_parent_chain(self, bid: str) -> list[BlobID]:
+        chain = []
+        n = self._first[self._number(bid)]
+        while n >= 0:
+            chain.append(self._blob_ids[n])
+            n = self._first[n]
+        chain.reverse()
+        return chain
+
+    # Returns the blob IDs of all ancestors of `bid`, nearest first.
+    def ancestors(self, bid: str) -> list[str]:
+        if not self._merge_parents:
+            return [b.bid for b in reversed(self.first_parent_chain(bid))]
+        seen = set()
+        result = []
+        frontier = self._parents(self._number(bid))
+        while frontier:
+            next_frontier = []
+            for parent in frontier:
+                if parent not in seen:
+                    seen.add(parent)
+                    result.append(self._blob_ids[parent].bid)
+                    next_frontier.extend(self._parents(parent))
+            frontier = next_frontier
+        return result
+
+    # Returns True if `ancestor` is a strict ancestor of `bid`.
+    def is_ancestor(self, ancestor: str, bid: str) -> bool:
+        if ancestor not in self or bid not in self:
+            return False
+        a = self._number(ancestor)
+        n = self._number(bid)
+        if not self._merge_parents:
+            return (self._depth[a] < self._depth[n] and
+                    self._ancestor_at(n, self._depth[a]) == a)
+        # Walk up, skipping anything that cannot be above `ancestor`.
+        seen = set()
+        frontier = self._parents(n)
+        while frontier:
+            parent = frontier.pop()
+            if parent == a:
+                return True
+            if parent in seen or self._level[parent] <= self._level[a]:
+                continue
+            seen.add(parent)
+            frontier.extend(self._parents(parent))
+        return False
+
+    # Returns the nearest common ancestor of two versions (either version
+    # itself counts), or None if they do not share history.
+    def common_base(self, x: str, y: str) -> str:
+        if x not in self or y not in self:
+            return None
+        if not self._merge_parents:
+            x = self._number(x)
+            y = self._number(y)
+            depth = min(self._depth[x], self._depth[y])
+            x = self._ancestor_at(x, depth)
+            y = self._ancestor_at(y, depth)
+            # Jump pointers depend only on depth, so x and y stay level.
+            while x != y:
+                if self._jump[x] != self._jump[y] and self._jump[x] != x:
+                    x, y = self._jump[x], self._jump[y]
+                else:
+                    x, y = self._first[x], self._first[y]
+                    if x < 0:
+                        # Two different roots.
+                        return None
+            return self._blob_ids[x].bid
+        x_ancestors = set(self.ancestors(x))
+        x_ancestors.add(x)
+        candidates = [y] + self.ancestors(y)
+        common = [c for c in candidates if c in x_ancestors]
+        if not common:
+            return None
+        return max(common, key=lambda c: self._level[self._number(c)])
+
+
+# Sorted indexes over the versions of a contract.  Versions are ordered by
+# (timestamp, sequence), so a time range is a bisect on the keys and a page
+# continues from the key after the cursor.  Sequence numbers are looked up
+# directly.
+#
+# Like VersionGraph, an index is read without locks while a single writer
+# adds versions.  The keys and versions are replaced together by sorted
+# copies, so a reader never sees one list changed without the other.
+class VersionIndex(object):
+
+    def __init__(self, versions: list = ()):
+        entries = sorted(
+            (((version.blob_id.timestamp, version.sequence), version)
+             for version in versions),
+            key=lambda entry: entry[0])
+        # Sorted (timestamp, sequence) keys and their versions.
+        self._sorted = ([key for key, _ in entries],
+                        [version for _, version in entries])
+        self._by_sequence = {version.sequence: version for version in versions}
+
+    def __len__(self) -> int:
+        return len(self._sorted[0])
+
+    def add(self, version) -> None:
+        key = (version.blob_id.timestamp, version.sequence)
+        keys, versions = self._sorted
+        # Versions are usually appended in time order.
+        if not keys or key >= keys[-1]:
+            i = len(keys)
+        else:
+            i = bisect.bisect_right(keys, key)
+        self._by_sequence[version.sequence] = version
+        self._sorted = (keys[:i] + [key] + keys[i:],
+                        versions[:i] + [version] + versions[i:])
+
+    def by_sequence(self, sequence: int):
+        return self._by_sequence.get(sequence)
+
+    # Returns up to `limit` versions with after <= timestamp <= before (None
+    # means unbounded) whose key is greater than `start_key`, in key order.
+    def range(self,
+              after: int = None,
+              before: int = None,
+              start_key: tuple = None,
+              limit: int = None) -> list:
+        keys, versions = self._sorted
+        lo = 0
+        if after is not None:
+            lo = bisect.bisect_left(keys, (after, ))
+        if start_key is not None:
+            lo = max(lo, bisect.bisect_right(keys, tuple(start_key)))
+        hi = len(keys)
+        if before is not None:
+            hi = bisect.bisect_left(keys, (before + 1, ))
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return versions[lo:hi]
+
+
+# Returns the parent blob IDs of a stored version record.  Records written
+# before versions had parents only carry `previous_versions`, whose last
+# entry is the parent.
+def ParentsFromRecord(record: dict) -> list[str]:
+    if 'parents' in record:
+        return list(record['parents'])
+    return list(record.get('previous_versions') or [])[-1:]
+
+
+# How a version's content is laid out in Walrus.
+# The blob holds the file itself.
+STORAGE_BLOB = 'blob'
+# The blob is a chunk manifest, see chunking.py.
+STORAGE_CHUNKED = 'chunked'
+# The file is a byte range of a pack blob shared with other small files, see
+# packing.py.
+STORAGE_PACKED = 'packed'
+
+
 class Version(object):
+    __slots__ = ('blob_id', 'initial_blob_data', 'parents', 'graph', 'alias',
+                 'storage', 'sequence', 'sealed_for', '_previous_versions')
+
     # This data's blob ID
     blob_id: BlobID
 
     # The original version's blob ID
     initial_blob_data: BlobID
 
-    # All the previous versions
-    previous_versions: list[BlobID]
+    # The versions this one was derived from.  parents[0] is the base
+    # version.
+    parents: list[BlobID]
+
+    # The contract's version graph, if this version belongs to one.  Used to
+    # answer history queries without storing the history in every version.
+    graph: VersionGraph
 
     # Alias
     alias: str
 
+    # One of the STORAGE_* layouts.
+    storage: str
+
+    # 1-based number of this version within its contract, assigned when it
+    # is written to the local DB.
+    sequence: int
+
+    # None if the file is stored as is.  Otherwise it was sealed (see
+    # sealing.py) for this tenant, whose key decrypts it if it is encrypted.
+    sealed_for: str
+
     def __init__(self,
                  blob_id: BlobID,
                  initial_blob_data: BlobID = None,
                  previous_versions: list[BlobID] = None,
-                 alias: str = None):
+                 alias: str = None,
+                 parents: list[BlobID] = None,
+                 graph: VersionGraph = None,
+                 storage: str = STORAGE_BLOB,
+                 sequence: int = None,
+                 sealed_for: str = None):
         self.blob_id = blob_id
+        self.sequence = sequence
+        self.sealed_for = sealed_for
         self.initial_blob_data = initial_blob_data
-        self.previous_versions = previous_versions
+        if parents is None:
+            parents = list(previous_versions or [])[-1:]
+        self.parents = parents
         self.alias = alias
+        self.graph = graph
+        self.storage = storage
+        # Only kept for versions built from an explicit history without a
+        # graph.
+        self._previous_versions = previous_versions
 
+    # All the previous versions, oldest first.  Computed from the graph.
+    @property
+    def previous_versions(self) -> list[BlobID]:
+        if self.graph is not None and self.blob_id.bid in self.graph:
+            return self.graph.first_parent_chain(self.blob_id.bid)
+        if self._previous_versions is not None:
+            return self._previous_versions
+        return list(self.parents)
+
+    # Appends `blob_id` to the history, as the latest previous version and
+    # so the parent.  The history is then kept explicitly, as for a version
+    # built from `previous_versions`, rather than answered by the graph.
     def add_version(self, blob_id):
-        self.previous_versions.append(blob_id)
+        self._previous_versions = self.previous_versions + [blob_id]
+        self.parents = [blob_id]
+        self.graph = None
 
+    # The old wire format with the full history.
     def to_dict(self):
         return {
             "blob_id": self.blob_id.bid,
@@ -45,11 +418,86 @@ class Version(object):
             "alias": self.alias
         }
 
+    # The stored format: parents only.
+    def to_record(self):
+        record = {
+            "blob_id": self.blob_id.bid,
+            "initial_blob_data": self.initial_blob_data.bid,
+            "parents": [v.bid for v in self.parents],
+            "alias": self.alias
+        }
+        if self.blob_id.timestamp:
+            record["timestamp"] = self.blob_id.timestamp
+        if self.storage != STORAGE_BLOB:
+            record["storage"] = self.storage
+        if self.sealed_for is not None:
+            record["sealed_for"] = self.sealed_for
+        return record
+
+# The outcome of one file of a batch upload.  Exactly one of `version` and
+# `error` is set once the batch finished.
+class UploadResult(object):
+    filepath: str
+    client_id: str
+    version_id: str
+    version: Version
+    error: Exception
+
+    def __init__(self, filepath: str, client_id: str, version_id: str):
+        self.filepath = filepath
+        self.client_id = client_id
+        self.version_id = version_id
+        self.version = None
+        self.error = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+# An inclusive range of version timestamps (seconds since the epoch).  None
+# leaves that side open.
+class TimeRange(object):
+    after: int
+    before: int
+
+    def __init__(self, after: int = None, before: int = None):
+        self.after = after
+        self.before = before
+
+
 class QueryOptions(object):
+    # Only versions with this sequence number.
     query_by_version: int
 
+    # Only versions created in this range.
+    query_by_time: TimeRange
+
     # Use AI to filter the the results.
     query_description: str
 
-    def __init__(self):
-        pass
+    # Maximum number of versions per page; None returns all of them.
+    limit: int
+
+    # The `next_cursor` of the previous page.
+    cursor: str
+
+    def __init__(self,
+                 query_by_version: int = None,
+                 query_by_time: TimeRange = None,
+                 limit: int = None,
+                 cursor: str = None):
+        self.query_by_version = query_by_version
+        self.query_by_time = query_by_time
+        self.query_description = None
+        self.limit = limit
+        self.cursor = cursor
+
+
+# One page of query results.  A list, plus the cursor of the next page, which
+# is None on the last page.
+class QueryPage(list):
+    next_cursor: str
+
+    def __init__(self, items=(), next_cursor: str = None):
+        super().__init__(items)
+        self.next_cursor = next_cursor
@@ -0,0 +1,129 @@
+# Packing of small files for STORAGE_PACKED uploads.
+#
+# Storing every small file as its own Walrus blob pays the per-blob overhead
+# and epoch cost each time.  Small uploads are instead buffered for a short
+# window and written together as one pack blob: the files back to back,
+# followed by a JSON index and a fixed-size footer
+#
+#   <file 0><file 1>...<index JSON><index length: 4 bytes BE>VWPK
+#   {"format": "versioned-walrus-pack", "version": 1,
+#    "files": [[<offset>, <length>], ...]}
+#
+# A packed version's blob ID names its byte range in the pack,
+# "<pack blob ID>:<offset>:<length>", so a fetch only needs the pack (shared
+# by every file in it, and cached once) and a slice of it.
+import asyncio
+import json
+import struct
+
+PACK_FORMAT = 'versioned-walrus-pack'
+_MAGIC = b'VWPK'
+_FOOTER = struct.Struct('>I4s')
+
+
+# Returns the blob ID of a packed file.
+def PackedBlobId(pack_blob_id: str, offset: int, length: int) -> str:
+    return f'{pack_blob_id}:{offset}:{length}'
+
+
+# Returns the (pack blob ID, offset, length) named by a packed file's blob
+# ID.
+def ParsePackedBlobId(bid: str) -> tuple:
+    try:
+        pack_blob_id, offset, length = bid.rsplit(':', 2)
+        offset, length = int(offset), int(length)
+    except ValueError:
+        raise ValueError(f'{bid} is not a packed blob ID') from None
+    if not pack_blob_id or offset < 0 or length < 0:
+        raise ValueError(f'{bid} is not a packed blob ID')
+    return pack_blob_id, offset, length
+
+
+# Returns (pack, ranges): the pack holding `files` and the (offset, length)
+# of each file in it.
+def BuildPack(files: list[bytes]) -> tuple:
+    ranges = []
+    offset = 0
+    for data in files:
+        ranges.append((offset, len(data)))
+        offset += len(data)
+    index = json.dumps({
+        'format': PACK_FORMAT,
+        'version': 1,
+        'files': ranges
+    }).encode('utf-8')
+    return b''.join(files + [index, _FOOTER.pack(len(index), _MAGIC)]), ranges
+
+
+# Returns the (offset, length) of each file in a pack, from its footer index.
+def ParseIndex(pack) -> list[tuple]:
+    if len(pack) < _FOOTER.size:
+        raise ValueError('Pack is too short')
+    length, magic = _FOOTER.unpack(pack[len(pack) - _FOOTER.size:])
+    end = len(pack) - _FOOTER.size
+    if magic != _MAGIC or length > end:
+        raise ValueError('Not a pack')
+    index = json.loads(bytes(pack[end - length:end]))
+    if index.get('format') != PACK_FORMAT:
+        raise ValueError('Not a pack')
+    return [(offset, size) for offset, size in index['files']]
+
+
+# Buffers small files on one event loop and stores them as packs.  A pack
+# is written once `max_bytes` are buffered or `window` seconds after its
+# first file, whichever comes first.
+class Packer(object):
+
+    # `store(data)` is a coroutine storing a pack and returning its blob ID.
+    def __init__(self, store, max_bytes: int, window: float):
+        self._store = store
+        self.max_bytes = max_bytes
+        self.window = window
+        # (data, future) of the files not yet written.
+        self._pending = []
+        self._bytes = 0
+        self._timer = None
+        # Packs being written; referenced so their tasks are not collected.
+        self._writes = set()
+
+    # Adds a file to the next pack.  Returns its (pack blob ID, offset,
+    # length) once the pack is stored.
+    async def add(self, data: bytes) -> tuple:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((data, future))
+        self._bytes += len(data)
+        if self._bytes >= self.max_bytes:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._pending
+        self._pending = []
+        self._bytes = 0
+        if batch:
+            task = asyncio.ensure_future(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: list) -> None:
+        try:
+            pack, ranges = BuildPack([data for data, _ in batch])
+            pack_blob_id = await self._store(pack)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), (offset, length) in zip(batch, ranges):
+            if not future.done():
+                future.set_result((pack_blob_id, offset, length))
@@ -0,0 +1,273 @@
+# Compression and encryption of files before they are stored in Walrus.
+#
+# A sealed file is a header followed by frames, each holding up to
+# FRAME_SIZE bytes of the file:
+#
+#   header  VWSL <format version: 1 byte> <flags: 1 byte> <2 zero bytes>
+#           <key fingerprint: 8 bytes> <nonce prefix: 8 bytes>
+#   frame   <frame header: 4 bytes BE> <payload>
+#
+# The frame header holds the payload length, a bit telling whether the
+# payload is zlib compressed (frames that do not shrink are kept as is) and
+# a bit marking the last frame.  With FLAG_ENCRYPTED set each payload is
+# AES-256-GCM encrypted under the tenant's key, with the frame number in the
+# nonce and the header, frame header and frame number as associated data, so
+# frames cannot be altered, reordered, dropped or cut off.
+#
+# Files are sealed and unsealed one frame at a time, so memory use does not
+# depend on the file size.  Sealing is deterministic: the nonce prefix is
+# derived from the key and the content digest, so the same content sealed
+# for the same tenant gives the same bytes and is stored only once.
+#
+# Chunked versions seal each content-defined chunk on its own (SealBytes,
+# with the chunk's digest), so an edit only changes the sealed chunks around
+# it; blob and packed versions seal the whole file.
+#
+# Encryption needs the `cryptography` package; compression alone does not.
+# Tenant keys are derived from WALRUS_MASTER_KEY (32 bytes, URL-safe base64)
+# unless SetKeyProvider() installs another source, e.g. a KMS.
+import base64
+import hashlib
+import hmac
+import io
+import os
+import struct
+import zlib
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+# One of SEAL_NONE, SEAL_COMPRESS or SEAL_ENCRYPT (which also compresses).
+SEAL_NONE = ''
+SEAL_COMPRESS = 'compress'
+SEAL_ENCRYPT = 'encrypt'
+SEAL_MODE = os.environ.get('WALRUS_SEAL', SEAL_NONE)
+
+# Bytes of the file per frame.
+FRAME_SIZE = 1024 * 1024
+
+FLAG_COMPRESSED = 0x01
+FLAG_ENCRYPTED = 0x02
+
+_MAGIC = b'VWSL'
+_HEADER = struct.Struct('>4sBBH8s8s')
+_FRAME_HEADER = struct.Struct('>I')
+_FRAME_LAST = 0x80000000
+_FRAME_COMPRESSED = 0x40000000
+_FRAME_LENGTH = 0x3fffffff
+_TAG_BYTES = 16
+_KEY_BYTES = 32
+
+_key_provider = None
+
+
+class SealError(ValueError):
+    pass
+
+
+def _MasterKeyProvider(tenant: str) -> bytes:
+    master = os.environ.get('WALRUS_MASTER_KEY')
+    if not master:
+        raise SealError('WALRUS_MASTER_KEY is not set')
+    master = base64.urlsafe_b64decode(master + '=' * (-len(master) % 4))
+    if len(master) != _KEY_BYTES:
+        raise SealError('WALRUS_MASTER_KEY must be 32 bytes')
+    return hmac.new(master, b'versioned-walrus tenant\0' + tenant.encode(),
+                    hashlib.sha256).digest()
+
+
+# Overrides where tenant keys come from.  `provider(tenant)` returns the
+# tenant's 32 byte key.
+def SetKeyProvider(provider) -> None:
+    global _key_provider
+    _key_provider = provider
+
+
+# Returns the key files of `tenant` are encrypted with.
+def TenantKey(tenant: str) -> bytes:
+    key = (_key_provider or _MasterKeyProvider)(tenant)
+    if len(key) != _KEY_BYTES:
+        raise SealError(f'The key of {tenant} must be 32 bytes')
+    return key
+
+
+def _Fingerprint(key: bytes) -> bytes:
+    return hashlib.sha256(b'versioned-walrus key id\0' + key).digest()[:8]
+
+
+def _Cipher(key: bytes):
+    if AESGCM is None:
+        raise SealError('Encryption needs the cryptography package')
+    return AESGCM(key)
+
+
+def _Nonce(prefix: bytes, number: int) -> bytes:
+    return prefix + struct.pack('>I', number)
+
+
+def _AssociatedData(header: bytes, frame_header: bytes, number: int) -> bytes:
+    return header + frame_header + struct.pack('>I', number)
+
+
+# Decompresses a frame, refusing frames that expand beyond FRAME_SIZE.
+def _Decompress(payload) -> bytes:
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, FRAME_SIZE)
+    except zlib.error as e:
+        raise SealError(f'Corrupt frame: {e}') from None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise SealError('Corrupt frame')
+    return data
+
+
+# Seals the file at `src_path` into the binary file object `out`.  `digest`
+# is the file's hex SHA-256; `key` is the tenant key to encrypt with, or None
+# to only compress.
+def SealFile(src_path: str, out, digest: str, key: bytes = None) -> None:
+    with open(src_path, 'rb') as f:
+        _Seal(f, out, digest, key)
+
+
+# Returns `data` sealed, like SealFile.  `digest` is its hex SHA-256.
+def SealBytes(data: bytes, digest: str, key: bytes = None) -> bytes:
+    out = io.BytesIO()
+    _Seal(io.BytesIO(data), out, digest, key)
+    return out.getvalue()
+
+
+def _Seal(f, out, digest: str, key: bytes) -> None:
+    flags = FLAG_COMPRESSED
+    fingerprint = nonce_prefix = bytes(8)
+    cipher = None
+    if key is not None:
+        flags |= FLAG_ENCRYPTED
+        cipher = _Cipher(key)
+        fingerprint = _Fingerprint(key)
+        nonce_prefix = hmac.new(key, b'nonce\0' + digest.encode(),
+                                hashlib.sha256).digest()[:8]
+    header = _HEADER.pack(_MAGIC, 1, flags, 0, fingerprint, nonce_prefix)
+    out.write(header)
+    number = 0
+    data = f.read(FRAME_SIZE)
+    while True:
+        following = f.read(FRAME_SIZE)
+        frame_flags = 0 if following else _FRAME_LAST
+        payload = zlib.compress(data)
+        if len(payload) < len(data):
+            frame_flags |= _FRAME_COMPRESSED
+        else:
+            payload = data
+        length = len(payload) + (_TAG_BYTES if cipher else 0)
+        frame_header = _FRAME_HEADER.pack(frame_flags | length)
+        if cipher is not None:
+            payload = cipher.encrypt(
+                _Nonce(nonce_prefix, number), payload,
+                _AssociatedData(header, frame_header, number))
+        out.write(frame_header)
+        out.write(payload)
+        if not following:
+            return
+        data = following
+        number += 1
+
+
+# A binary file object that unseals what is written to it into `out`.
+# `key(tenant_fingerprint)` is called once, if the file is encrypted, and
+# returns the tenant key.  Only one frame is buffered at a time.  close()
+# raises SealError if the last frame was not seen.
+class Unsealer(object):
+
+    def __init__(self, out, key):
+        self._out = out
+        self._key = key
+        self._buffer = bytearray()
+        self._header = None
+        self._cipher = None
+        self._nonce_prefix = None
+        self._number = 0
+        self._done = False
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast('B')
+        size = len(data)
+        # Complete a header or frame split across writes first, copying only
+        # that much of `data`.
+        while self._buffer and data:
+            needed = self._needed()
+            self._buffer += data[:needed]
+            data = data[needed:]
+            del self._buffer[:self._consume(memoryview(bytes(self._buffer)))]
+        if data:
+            position = self._consume(data)
+            self._buffer += data[position:]
+        return size
+
+    # Returns how many more bytes the buffer needs to hold the next header,
+    # frame header or frame.
+    def _needed(self) -> int:
+        if self._header is None:
+            return _HEADER.size - len(self._buffer)
+        if len(self._buffer) < _FRAME_HEADER.size:
+            return _FRAME_HEADER.size - len(self._buffer)
+        (value, ) = _FRAME_HEADER.unpack(self._buffer[:_FRAME_HEADER.size])
+        return max(
+            _FRAME_HEADER.size + (value & _FRAME_LENGTH) - len(self._buffer),
+            1)
+
+    # Unseals the complete header and frames at the start of `data`.  Returns
+    # the number of bytes used.
+    def _consume(self, data: memoryview) -> int:
+        position = 0
+        if self._header is None:
+            if len(data) < _HEADER.size:
+                return 0
+            self._start(bytes(data[:_HEADER.size]))
+            position = _HEADER.size
+        while len(data) - position >= _FRAME_HEADER.size:
+            if self._done:
+                raise SealError('Data after the last frame')
+            frame_header = bytes(data[position:position +
+                                      _FRAME_HEADER.size])
+            (value, ) = _FRAME_HEADER.unpack(frame_header)
+            end = position + _FRAME_HEADER.size + (value & _FRAME_LENGTH)
+            if end > len(data):
+                break
+            payload = data[position + _FRAME_HEADER.size:end]
+            if self._cipher is not None:
+                try:
+                    payload = self._cipher.decrypt(
+                        _Nonce(self._nonce_prefix, self._number),
+                        bytes(payload),
+                        _AssociatedData(self._header, frame_header,
+                                        self._number))
+                except Exception:
+                    raise SealError(
+                        f'Frame {self._number} failed authentication'
+                    ) from None
+            if value & _FRAME_COMPRESSED:
+                payload = _Decompress(payload)
+            self._out.write(payload)
+            self._number += 1
+            self._done = bool(value & _FRAME_LAST)
+            position = end
+        return position
+
+    def _start(self, header: bytes) -> None:
+        magic, version, flags, _, fingerprint, nonce_prefix = \
+            _HEADER.unpack(header)
+        if magic != _MAGIC or version != 1:
+            raise SealError('Not a sealed file')
+        self._header = header
+        if flags & FLAG_ENCRYPTED:
+            key = self._key(fingerprint)
+            if _Fingerprint(key) != fingerprint:
+                raise SealError('The file was sealed with another key')
+            self._cipher = _Cipher(key)
+            self._nonce_prefix = nonce_prefix
+
+    def close(self) -> None:
+        if not self._done or self._buffer:
+            raise SealError('Sealed file is truncated')
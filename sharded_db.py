@@ -0,0 +1,345 @@
+# Sharded mode for the JSON DB.
+#
+# Each client is kept in its own JSON file under `<dir>/clients/`, and
+# `<dir>/manifest.json` lists the clients in DB order with the file holding
+# each one.  Reading a client opens only its shard, and a write rewrites only
+# the shards of the clients it touches:
+#   - A batch that changes a single existing client rewrites that shard in
+#     place (write to a temporary file, then rename).
+#   - Any other batch writes the changed shards under new file names, then
+#     atomically replaces the manifest to point at them, then deletes the
+#     old files.  Until the manifest is replaced readers and crashes see the
+#     old shards, so a batch spanning several clients is all-or-nothing.
+# Files no manifest points to, left by a crash, are deleted on startup.
+#
+# Split an existing DB into shards and merge it back with
+#   python sharded_db.py split local_db.json local_db.shards
+#   python sharded_db.py merge local_db.shards local_db.json
+import copy
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+
+import local_db
+
+_MANIFEST = 'manifest.json'
+_CLIENTS_DIR = 'clients'
+
+
+def _Serialize(data) -> bytes:
+    return json.dumps(data, indent=4).encode('utf-8')
+
+
+def _WriteAtomically(path: str, data: bytes) -> None:
+    tmp_path = f'{path}.tmp.{os.getpid()}.{threading.get_ident()}'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Returns the file name of a client's shard written in manifest generation
+# `generation`.  Client IDs are free-form, so only a sanitized prefix is
+# kept, followed by a hash that tells similar IDs apart.
+def _ShardName(client_id: str, generation: int) -> str:
+    digest = hashlib.sha256(client_id.encode('utf-8')).hexdigest()[:12]
+    prefix = re.sub(r'[^A-Za-z0-9_.-]', '_', client_id)[:40]
+    return f'{prefix}-{digest}.{generation}.json'
+
+
+class _Manifest(object):
+
+    def __init__(self, generation: int, order: list[str], files: dict,
+                 extra: dict):
+        self.generation = generation
+        # Client IDs in DB order.
+        self.order = order
+        # Client ID -> shard file name
+        self.files = files
+        # Top-level DB keys other than 'clients'.
+        self.extra = extra
+
+    @classmethod
+    def parse(cls, data: dict) -> '_Manifest':
+        return cls(data['generation'],
+                   [c['client_id'] for c in data['clients']],
+                   {c['client_id']: c['file']
+                    for c in data['clients']}, data.get('db', {}))
+
+    def to_dict(self) -> dict:
+        return {
+            'generation':
+            self.generation,
+            'clients': [{
+                'client_id': client_id,
+                'file': self.files[client_id]
+            } for client_id in self.order],
+            'db':
+            self.extra,
+        }
+
+
+class ShardedJsonBackend(object):
+
+    def __init__(self, directory: str = local_db.SHARDS_PATH):
+        self.directory = directory
+        self.clients_dir = os.path.join(directory, _CLIENTS_DIR)
+        self.manifest_path = os.path.join(directory, _MANIFEST)
+        # Serializes writers.
+        self._lock = threading.Lock()
+        # Guards the cached manifest.
+        self._cache_lock = threading.Lock()
+        self._manifest = None
+        self._manifest_stat = None
+        os.makedirs(self.clients_dir, exist_ok=True)
+        if not os.path.exists(self.manifest_path):
+            _WriteAtomically(self.manifest_path,
+                             _Serialize(_Manifest(0, [], {}, {}).to_dict()))
+        self._remove_orphans()
+
+    # Deletes the shard files the manifest does not point to.
+    def _remove_orphans(self) -> None:
+        used = set(self._current().files.values())
+        for name in os.listdir(self.clients_dir):
+            if name not in used:
+                os.remove(os.path.join(self.clients_dir, name))
+
+    # Returns the manifest, reading it again if the file changed.
+    def _current(self) -> _Manifest:
+        stat = os.stat(self.manifest_path)
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self._cache_lock:
+            if self._manifest_stat == key:
+                return self._manifest
+        with open(self.manifest_path, 'rb') as f:
+            manifest = _Manifest.parse(json.loads(f.read()))
+        with self._cache_lock:
+            self._manifest = manifest
+            self._manifest_stat = key
+        return manifest
+
+    def _write_manifest(self, manifest: _Manifest) -> None:
+        _WriteAtomically(self.manifest_path, _Serialize(manifest.to_dict()))
+        stat = os.stat(self.manifest_path)
+        with self._cache_lock:
+            self._manifest = manifest
+            self._manifest_stat = (stat.st_mtime_ns, stat.st_size,
+                                   stat.st_ino)
+
+    def _read_shard(self, name: str) -> bytes:
+        with open(os.path.join(self.clients_dir, name), 'rb') as f:
+            return f.read()
+
+    # Calls `read(manifest)`, retrying with the new manifest if a writer
+    # deleted a shard in between.
+    def _read(self, read):
+        while True:
+            manifest = self._current()
+            try:
+                return read(manifest)
+            except FileNotFoundError:
+                if self._current() is manifest:
+                    raise
+
+    def load(self) -> dict:
+
+        def read(manifest):
+            db = copy.deepcopy(manifest.extra)
+            db['clients'] = [
+                json.loads(self._read_shard(manifest.files[client_id]))
+                for client_id in manifest.order
+            ]
+            return db
+
+        return self._read(read)
+
+    def save(self, db: dict) -> None:
+        self._apply({'op': 'replace', 'db': db})
+
+    def list_clients(self) -> list[dict]:
+        return self.load()['clients']
+
+    def get_client(self, client_id: str) -> dict:
+
+        def read(manifest):
+            name = manifest.files.get(client_id)
+            if name is None:
+                raise local_db.NotFound(
+                    f"Client with ID {client_id} not found.")
+            return json.loads(self._read_shard(name))
+
+        return self._read(read)
+
+    # Applies mutations in order and writes the shards of the clients they
+    # changed.  Returns one error (or None) per mutation; a mutation that
+    # fails is skipped and does not affect the others.
+    def apply_batch(self, mutations: list[dict]) -> list:
+        with self._lock:
+            manifest = self._current()
+            order = list(manifest.order)
+            files = manifest.files
+            extra = manifest.extra
+            # Client ID -> record, for every client read or written
+            clients = {}
+            changed = set()
+
+            def client(client_id: str) -> dict:
+                if client_id not in clients and client_id in files:
+                    clients[client_id] = json.loads(
+                        self._read_shard(files[client_id]))
+                return clients.get(client_id)
+
+            errors = []
+            for mutation in mutations:
+                try:
+                    if mutation['op'] == 'replace':
+                        db = dict(mutation['db'])
+                        records = {}
+                        for record in db.pop('clients'):
+                            if record['client_id'] in records:
+                                raise ValueError(
+                                    f"Client with ID {record['client_id']} "
+                                    f"already exists.")
+                            records[record['client_id']] = record
+                        clients = records
+                        order = list(records)
+                        files = {}
+                        extra = db
+                        changed = set(order)
+                    else:
+                        client_ids = local_db.MutationClients(mutation)
+                        if mutation['op'] == 'add_client':
+                            (client_id, ) = client_ids
+                            if client(client_id) is not None:
+                                raise ValueError(
+                                    f"Client with ID {client_id} already "
+                                    f"exists.")
+                        # The clients the mutation touches, as a DB of
+                        # their own.
+                        partial = {
+                            'clients': [
+                                client(c) for c in sorted(client_ids)
+                                if client(c) is not None
+                            ]
+                        }
+                        local_db.CheckMutation(partial, mutation)
+                        local_db.ApplyMutation(partial, mutation)
+                        if mutation['op'] == 'add_client':
+                            clients[client_id] = partial['clients'][-1]
+                            order.append(client_id)
+                        changed.update(client_ids)
+                    errors.append(None)
+                except ValueError as e:
+                    errors.append(e)
+            if changed:
+                self._write(manifest, order, extra, clients, changed)
+            return errors
+
+    # Writes the shards of the `changed` clients and, unless only one
+    # existing shard changed, a new manifest.
+    def _write(self, manifest: _Manifest, order: list[str], extra: dict,
+               clients: dict, changed: set) -> None:
+        writes = {}
+        for client_id in changed:
+            data = _Serialize(clients[client_id])
+            name = manifest.files.get(client_id)
+            # A replaced DB is mostly saved back as it was loaded; skip the
+            # shards that did not change.
+            if name is None or self._read_shard(name) != data:
+                writes[client_id] = data
+        if order == manifest.order and extra == manifest.extra:
+            if not writes:
+                return
+            if len(writes) == 1:
+                # Rewriting one shard in place is atomic already.
+                ((client_id, data), ) = writes.items()
+                _WriteAtomically(
+                    os.path.join(self.clients_dir, manifest.files[client_id]),
+                    data)
+                return
+        generation = manifest.generation + 1
+        files = {c: manifest.files[c] for c in order if c in manifest.files}
+        for client_id, data in writes.items():
+            files[client_id] = _ShardName(client_id, generation)
+            _WriteAtomically(
+                os.path.join(self.clients_dir, files[client_id]), data)
+        self._write_manifest(_Manifest(generation, order, files, extra))
+        for name in set(manifest.files.values()) - set(files.values()):
+            os.remove(os.path.join(self.clients_dir, name))
+
+    def _apply(self, mutation: dict) -> None:
+        error = self.apply_batch([mutation])[0]
+        if error is not None:
+            raise error
+
+    def add_client(self, client: dict) -> None:
+        self._apply({'op': 'add_client', 'client': client})
+
+    def add_contract(self, client_id: str, contract: dict) -> None:
+        self._apply({
+            'op': 'add_contract',
+            'client_id': client_id,
+            'contract': contract
+        })
+
+    def add_version(self, client_id: str, contract_id: str,
+                    version: dict) -> None:
+        self._apply({
+            'op': 'add_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'version': version
+        })
+
+    def add_versions(self, versions: list[tuple]) -> None:
+        self._apply({'op': 'add_versions', 'versions': versions})
+
+    def update_version(self, client_id: str, contract_id: str, blob_id: str,
+                       fields: dict) -> None:
+        self._apply({
+            'op': 'update_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'blob_id': blob_id,
+            'fields': fields
+        })
+
+    def close(self) -> None:
+        pass
+
+
+# Splits a JSON DB into a new sharded directory.
+def Split(json_path: str, directory: str) -> None:
+    with open(json_path, 'r') as f:
+        db = json.load(f)
+    if os.path.exists(os.path.join(directory, _MANIFEST)):
+        raise ValueError(f'{directory} already holds a sharded DB.')
+    ShardedJsonBackend(directory).save(db)
+
+
+# Merges a sharded directory back into one JSON DB.
+def Merge(directory: str, json_path: str) -> None:
+    if not os.path.exists(os.path.join(directory, _MANIFEST)):
+        raise ValueError(f'{directory} does not hold a sharded DB.')
+    local_db.WriteJsonAtomically(json_path,
+                                 ShardedJsonBackend(directory).load())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ('split', 'merge'):
+        print(f'Usage: {sys.argv[0]} split <local_db.json> <shards dir>\n'
+              f'       {sys.argv[0]} merge <shards dir> <local_db.json>')
+        sys.exit(1)
+    if sys.argv[1] == 'split':
+        Split(sys.argv[2], sys.argv[3])
+    else:
+        Merge(sys.argv[2], sys.argv[3])
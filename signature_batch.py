@@ -0,0 +1,218 @@
+# Anchors contract signatures in Walrus in batches.
+#
+# Storing every signature as its own blob would make signing as slow as an
+# upload.  Instead signatures are collected for up to MAX_DELAY seconds, or
+# until MAX_BATCH are waiting, and stored together as one batch blob:
+#
+#   {"root": <hex>, "signatures": [<signature record>, ...]}
+#
+# The records are the leaves of a SHA-256 Merkle tree whose root is in the
+# blob.  Each signer gets the batch's blob ID and an inclusion proof:
+#
+#   {"record": <signature record>, "index": <leaf index>,
+#    "path": [["left" | "right", <sibling hex>], ...], "root": <hex>}
+#
+# VerifyProof() checks a proof without any Walrus call; VerifyBatch() also
+# checks it against the batch blob.  Leaves and inner nodes are hashed with
+# different prefixes, and a node without a sibling is promoted to the next
+# level as is, so a proof cannot be replayed for a different tree shape.
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Longest time a signature waits for others to share its batch.
+MAX_DELAY = float(os.environ.get('SIGNATURE_BATCH_WINDOW', 0.2))
+# Largest number of signatures stored in one batch.
+MAX_BATCH = int(os.environ.get('SIGNATURE_BATCH_SIZE', 256))
+
+_LEAF_PREFIX = b'\x00'
+_NODE_PREFIX = b'\x01'
+
+
+def _Canonical(data) -> bytes:
+    return json.dumps(data, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _LeafHash(record: dict) -> bytes:
+    return hashlib.sha256(_LEAF_PREFIX + _Canonical(record)).digest()
+
+
+def _NodeHash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(_NODE_PREFIX + left + right).digest()
+
+
+# Builds the Merkle tree of `records`.  Returns (root, paths) where paths[i]
+# is the inclusion path of records[i], leaf to root.
+def BuildTree(records: list[dict]) -> tuple:
+    if not records:
+        raise ValueError('Cannot build a Merkle tree without leaves.')
+    paths = [[] for _ in records]
+    # (hash, indexes of the leaves under the node) for the current level.
+    level = [(_LeafHash(record), [i]) for i, record in enumerate(records)]
+    while len(level) > 1:
+        parents = []
+        for j in range(0, len(level) - 1, 2):
+            (left, left_leaves), (right, right_leaves) = level[j:j + 2]
+            for i in left_leaves:
+                paths[i].append(['right', right.hex()])
+            for i in right_leaves:
+                paths[i].append(['left', left.hex()])
+            parents.append(
+                (_NodeHash(left, right), left_leaves + right_leaves))
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0][0].hex(), paths
+
+
+# Returns True if `proof` shows that its record is a leaf of its root.
+def VerifyProof(proof: dict) -> bool:
+    try:
+        node = _LeafHash(proof['record'])
+        for side, sibling in proof['path']:
+            sibling = bytes.fromhex(sibling)
+            if side == 'left':
+                node = _NodeHash(sibling, node)
+            elif side == 'right':
+                node = _NodeHash(node, sibling)
+            else:
+                return False
+        return node.hex() == proof['root']
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+# Returns True if `proof` is valid and `batch`, the content of the batch
+# blob, holds its record at its index under the same root.
+def VerifyBatch(proof: dict, batch: bytes) -> bool:
+    if not VerifyProof(proof):
+        return False
+    try:
+        batch = json.loads(bytes(batch))
+        records = batch['signatures']
+        index = proof['index']
+        return (batch['root'] == proof['root'] and
+                0 <= index < len(records) and
+                records[index] == proof['record'] and
+                BuildTree(records)[0] == batch['root'])
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+# Returns the batch blob holding `records`, and the inclusion proof of each.
+def BuildBatch(records: list[dict]) -> tuple:
+    root, paths = BuildTree(records)
+    proofs = [{
+        'record': record,
+        'index': i,
+        'path': path,
+        'root': root
+    } for i, (record, path) in enumerate(zip(records, paths))]
+    return _Canonical({'root': root, 'signatures': records}), proofs
+
+
+# Where a signature was anchored.
+class Receipt(object):
+
+    def __init__(self, sig_blob_id: str, proof: dict):
+        # Blob ID of the batch holding the signature.
+        self.sig_blob_id = sig_blob_id
+        self.proof = proof
+
+
+class SignatureBatcher(object):
+
+    # `store(data)` stores a batch blob and returns its blob ID; it defaults
+    # to versioned_walrus.StoreBytes.
+    def __init__(self,
+                 store=None,
+                 max_batch: int = MAX_BATCH,
+                 max_delay: float = MAX_DELAY):
+        if store is None:
+            import versioned_walrus
+            store = versioned_walrus.StoreBytes
+        self._store = store
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        # (record, future, submit time) of the signatures not yet stored.
+        self._pending = []
+        self._thread = None
+        self._closed = False
+
+    # Queues a signature record.  Returns a future resolving to its Receipt
+    # once its batch is stored.
+    def submit(self, record: dict) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('SignatureBatcher is closed.')
+            self._pending.append((record, future, time.monotonic()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='signature_batch',
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    # Queues a signature record and waits until it is stored.
+    def sign(self, record: dict) -> Receipt:
+        return self.submit(record).result()
+
+    # Stores the pending signatures and stops the batching thread.
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    # Waits until a batch is due.  Returns it, or None once closed and
+    # drained.
+    def _next_batch(self) -> list:
+        with self._cond:
+            while True:
+                if self._pending:
+                    wait = self._pending[0][2] + self.max_delay - \
+                        time.monotonic()
+                    if (len(self._pending) >= self.max_batch or wait <= 0 or
+                            self._closed):
+                        batch = self._pending[:self.max_batch]
+                        del self._pending[:self.max_batch]
+                        return batch
+                    self._cond.wait(wait)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # Signatures arriving while this batch is stored wait for the
+            # next one.
+            records = [record for record, _, _ in batch]
+            try:
+                data, proofs = BuildBatch(records)
+                sig_blob_id = self._store(data)
+            except Exception as e:
+                logger.warning('storing a batch of %d signatures failed: %s',
+                               len(batch), e)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            logger.debug('stored %d signatures as %s', len(batch),
+                         sig_blob_id)
+            for (_, future, _), proof in zip(batch, proofs):
+                future.set_result(Receipt(sig_blob_id, proof))
@@ -0,0 +1,388 @@
+# SQLite storage engine for the local DB.
+#
+# Clients, contracts and versions live in their own indexed tables, keyed by
+# client_id, (client, contract_id) and blob_id.  A version stores its
+# parents as rows in version_parents; a root version, which has none, is
+# marked by `"parents": []` in its extra column.  Records written before
+# versions had parents keep their `previous_versions` list as rows in
+# version_history.
+# Fields this schema does not model explicitly (e.g. signed_by_client,
+# sig_blob_id) are kept in an `extra` JSON column so round trips are
+# lossless.
+#
+# Migrate an existing JSON DB with:
+#   python sqlite_db.py local_db.json local_db.sqlite
+import json
+import sqlite3
+import sys
+import threading
+
+import local_db
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    id INTEGER PRIMARY KEY,
+    client_id TEXT NOT NULL UNIQUE,
+    name TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS contracts (
+    id INTEGER PRIMARY KEY,
+    client_row INTEGER NOT NULL REFERENCES clients(id),
+    contract_id TEXT NOT NULL,
+    name TEXT,
+    extra TEXT NOT NULL DEFAULT '{}',
+    UNIQUE (client_row, contract_id)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    contract_row INTEGER NOT NULL REFERENCES contracts(id),
+    blob_id TEXT NOT NULL,
+    initial_blob_data TEXT,
+    alias TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS versions_by_contract
+    ON versions (contract_row, id);
+CREATE INDEX IF NOT EXISTS versions_by_blob_id ON versions (blob_id);
+CREATE TABLE IF NOT EXISTS version_history (
+    version_row INTEGER NOT NULL REFERENCES versions(id),
+    position INTEGER NOT NULL,
+    blob_id TEXT NOT NULL,
+    PRIMARY KEY (version_row, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS version_parents (
+    version_row INTEGER NOT NULL REFERENCES versions(id),
+    position INTEGER NOT NULL,
+    blob_id TEXT NOT NULL,
+    PRIMARY KEY (version_row, position)
+) WITHOUT ROWID;
+"""
+
+_CLIENT_KEYS = ('client_id', 'name', 'contracts')
+_CONTRACT_KEYS = ('contract_id', 'name', 'versions')
+_VERSION_KEYS = ('blob_id', 'initial_blob_data', 'previous_versions',
+                 'parents', 'alias')
+
+
+def _Extra(d: dict, known_keys) -> str:
+    return json.dumps({k: v for k, v in d.items() if k not in known_keys})
+
+
+class SqliteBackend(object):
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+
+    # One connection per thread; sqlite3 connections must not be shared.
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    def _client_row(self, conn, client_id: str) -> tuple:
+        row = conn.execute(
+            'SELECT id, client_id, name, extra FROM clients '
+            'WHERE client_id = ?', (client_id, )).fetchone()
+        if row is None:
+            raise local_db.NotFound(
+                f"Client with ID {client_id} not found.")
+        return row
+
+    def _contract_row_id(self, conn, client_id: str, contract_id: str) -> int:
+        row = conn.execute(
+            'SELECT contracts.id FROM contracts JOIN clients '
+            'ON contracts.client_row = clients.id '
+            'WHERE clients.client_id = ? AND contracts.contract_id = ?',
+            (client_id, contract_id)).fetchone()
+        if row is None:
+            raise local_db.NotFound(
+                f"Contract with ID {contract_id} not found.")
+        return row[0]
+
+    # Returns {version row: [blob IDs]} from version_history or
+    # version_parents for all versions of a contract.
+    def _version_lists(self, conn, table: str, contract_row: int) -> dict:
+        lists = {}
+        for version_row, blob_id in conn.execute(
+                f'SELECT h.version_row, h.blob_id FROM {table} h '
+                'JOIN versions v ON h.version_row = v.id '
+                'WHERE v.contract_row = ? '
+                'ORDER BY h.version_row, h.position', (contract_row, )):
+            lists.setdefault(version_row, []).append(blob_id)
+        return lists
+
+    def _versions(self, conn, contract_row: int) -> list[dict]:
+        history = self._version_lists(conn, 'version_history', contract_row)
+        parents = self._version_lists(conn, 'version_parents', contract_row)
+        versions = []
+        for row_id, blob_id, initial_blob_data, alias, extra in conn.execute(
+                'SELECT id, blob_id, initial_blob_data, alias, extra '
+                'FROM versions WHERE contract_row = ? ORDER BY id',
+            (contract_row, )):
+            version = {
+                'blob_id': blob_id,
+                'initial_blob_data': initial_blob_data
+            }
+            extra = json.loads(extra)
+            if row_id in parents:
+                version['parents'] = parents[row_id]
+            elif 'parents' in extra:
+                version['parents'] = extra.pop('parents')
+            else:
+                version['previous_versions'] = history.get(row_id, [])
+            version['alias'] = alias
+            version.update(extra)
+            versions.append(version)
+        return versions
+
+    def _client_dict(self, conn, row: tuple) -> dict:
+        row_id, client_id, name, extra = row
+        contracts = []
+        for contract_row, contract_id, contract_name, contract_extra in (
+                conn.execute(
+                    'SELECT id, contract_id, name, extra FROM contracts '
+                    'WHERE client_row = ? ORDER BY id', (row_id, ))):
+            contract = {'contract_id': contract_id}
+            if contract_name is not None:
+                contract['name'] = contract_name
+            contract.update(json.loads(contract_extra))
+            contract['versions'] = self._versions(conn, contract_row)
+            contracts.append(contract)
+        client = {'client_id': client_id, 'name': name}
+        client.update(json.loads(extra))
+        client['contracts'] = contracts
+        return client
+
+    def _insert_version(self, conn, contract_row: int, version: dict) -> None:
+        extra = {k: v for k, v in version.items() if k not in _VERSION_KEYS}
+        if version.get('parents') == []:
+            extra['parents'] = []
+        cursor = conn.execute(
+            'INSERT INTO versions '
+            '(contract_row, blob_id, initial_blob_data, alias, extra) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (contract_row, version['blob_id'],
+             version.get('initial_blob_data'), version.get('alias'),
+             json.dumps(extra)))
+        conn.executemany(
+            'INSERT INTO version_history (version_row, position, blob_id) '
+            'VALUES (?, ?, ?)',
+            [(cursor.lastrowid, i, blob_id) for i, blob_id in enumerate(
+                version.get('previous_versions') or [])])
+        conn.executemany(
+            'INSERT INTO version_parents (version_row, position, blob_id) '
+            'VALUES (?, ?, ?)',
+            [(cursor.lastrowid, i, blob_id)
+             for i, blob_id in enumerate(version.get('parents') or [])])
+
+    def _insert_contract(self, conn, client_row: int, contract: dict) -> None:
+        cursor = conn.execute(
+            'INSERT INTO contracts (client_row, contract_id, name, extra) '
+            'VALUES (?, ?, ?, ?)',
+            (client_row, contract['contract_id'], contract.get('name'),
+             _Extra(contract, _CONTRACT_KEYS)))
+        for version in contract.get('versions', []):
+            self._insert_version(conn, cursor.lastrowid, version)
+
+    def _insert_client(self, conn, client: dict) -> None:
+        cursor = conn.execute(
+            'INSERT INTO clients (client_id, name, extra) VALUES (?, ?, ?)',
+            (client['client_id'], client.get('name'),
+             _Extra(client, _CLIENT_KEYS)))
+        for contract in client.get('contracts', []):
+            self._insert_contract(conn, cursor.lastrowid, contract)
+
+    def load(self) -> dict:
+        return {'clients': self.list_clients()}
+
+    # Replaces the whole DB.  Only kept for LoadDatabase/SaveDatabase
+    # callers; prefer the row level mutations below.
+    def save(self, db: dict) -> None:
+        self._commit({'op': 'replace', 'db': db})
+
+    def _replace(self, conn, db: dict) -> None:
+        conn.execute('DELETE FROM version_parents')
+        conn.execute('DELETE FROM version_history')
+        conn.execute('DELETE FROM versions')
+        conn.execute('DELETE FROM contracts')
+        conn.execute('DELETE FROM clients')
+        for client in db['clients']:
+            self._insert_client(conn, client)
+
+    def list_clients(self) -> list[dict]:
+        conn = self._conn()
+        return [
+            self._client_dict(conn, row) for row in conn.execute(
+                'SELECT id, client_id, name, extra FROM clients ORDER BY id')
+        ]
+
+    def get_client(self, client_id: str) -> dict:
+        conn = self._conn()
+        return self._client_dict(conn, self._client_row(conn, client_id))
+
+    # Inserts a new version numbered after the contract's other versions,
+    # like local_db's JSON backend.  Versions are never removed, so the
+    # number is the row count.  Raises local_db.VersionExists if the
+    # contract already has the version.
+    def _append_version(self, conn, contract_row: int, version: dict) -> None:
+        if conn.execute(
+                'SELECT 1 FROM versions WHERE contract_row = ? AND '
+                'blob_id = ?', (contract_row, version['blob_id'])).fetchone():
+            contract_id = conn.execute(
+                'SELECT contract_id FROM contracts WHERE id = ?',
+                (contract_row, )).fetchone()[0]
+            raise local_db.VersionExists(contract_id, version['blob_id'])
+        if 'sequence' not in version:
+            version['sequence'] = conn.execute(
+                'SELECT COUNT(*) FROM versions WHERE contract_row = ?',
+                (contract_row, )).fetchone()[0] + 1
+        self._insert_version(conn, contract_row, version)
+
+    # Applies one mutation (see local_db.CheckMutation) inside the caller's
+    # transaction.
+    def _apply(self, conn, mutation: dict) -> None:
+        op = mutation['op']
+        if op == 'add_client':
+            self._insert_client(conn, mutation['client'])
+        elif op == 'add_contract':
+            client_row = self._client_row(conn, mutation['client_id'])[0]
+            self._insert_contract(conn, client_row, mutation['contract'])
+        elif op == 'add_version':
+            contract_row = self._contract_row_id(conn, mutation['client_id'],
+                                                 mutation['contract_id'])
+            self._append_version(conn, contract_row, mutation['version'])
+        elif op == 'add_versions':
+            contract_rows = {}
+            for client_id, contract_id, version in mutation['versions']:
+                key = (client_id, contract_id)
+                if key not in contract_rows:
+                    contract_rows[key] = self._contract_row_id(
+                        conn, client_id, contract_id)
+                self._append_version(conn, contract_rows[key], version)
+        elif op == 'update_version':
+            self._update_version(conn, mutation['client_id'],
+                                 mutation['contract_id'], mutation['blob_id'],
+                                 mutation['fields'])
+        elif op == 'replace':
+            self._replace(conn, mutation['db'])
+        else:
+            raise ValueError(f'Unknown mutation {op}')
+
+    # Applies mutations in order in one transaction.  Returns one error (or
+    # None) per mutation; a mutation that fails is rolled back to its
+    # savepoint and does not affect the others.
+    def apply_batch(self, mutations: list[dict]) -> list:
+        errors = []
+        with self._conn() as conn:
+            conn.execute('BEGIN')
+            for mutation in mutations:
+                conn.execute('SAVEPOINT mutation')
+                try:
+                    self._apply(conn, mutation)
+                    errors.append(None)
+                except (ValueError, sqlite3.IntegrityError) as e:
+                    conn.execute('ROLLBACK TO mutation')
+                    errors.append(ValueError(str(e)) if isinstance(
+                        e, sqlite3.IntegrityError) else e)
+                conn.execute('RELEASE mutation')
+        return errors
+
+    def _commit(self, mutation: dict) -> None:
+        error = self.apply_batch([mutation])[0]
+        if error is not None:
+            raise error
+
+    def add_client(self, client: dict) -> None:
+        self._commit({'op': 'add_client', 'client': client})
+
+    def add_contract(self, client_id: str, contract: dict) -> None:
+        self._commit({
+            'op': 'add_contract',
+            'client_id': client_id,
+            'contract': contract
+        })
+
+    def add_version(self, client_id: str, contract_id: str,
+                    version: dict) -> None:
+        self._commit({
+            'op': 'add_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'version': version
+        })
+
+    def add_versions(self, versions: list[tuple]) -> None:
+        self._commit({'op': 'add_versions', 'versions': versions})
+
+    def update_version(self, client_id: str, contract_id: str, blob_id: str,
+                       fields: dict) -> None:
+        self._commit({
+            'op': 'update_version',
+            'client_id': client_id,
+            'contract_id': contract_id,
+            'blob_id': blob_id,
+            'fields': fields
+        })
+
+    def _update_version(self, conn, client_id: str, contract_id: str,
+                        blob_id: str, fields: dict) -> None:
+        contract_row = self._contract_row_id(conn, client_id, contract_id)
+        row = conn.execute(
+            'SELECT id, initial_blob_data, alias, extra FROM versions '
+            'WHERE contract_row = ? AND blob_id = ?',
+            (contract_row, blob_id)).fetchone()
+        if row is None:
+            raise local_db.NotFound(
+                f"Version with blob ID {blob_id} not found.")
+        row_id, initial_blob_data, alias, extra = row
+        extra = json.loads(extra)
+        for key, value in fields.items():
+            if key == 'initial_blob_data':
+                initial_blob_data = value
+            elif key == 'alias':
+                alias = value
+            elif key in ('blob_id', 'previous_versions', 'parents'):
+                raise ValueError(f'{key} cannot be updated.')
+            else:
+                extra[key] = value
+        conn.execute(
+            'UPDATE versions SET initial_blob_data = ?, alias = ?, '
+            'extra = ? WHERE id = ?',
+            (initial_blob_data, alias, json.dumps(extra), row_id))
+
+    def close(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# One-shot migration of a JSON DB into a new SQLite DB.
+def MigrateFromJson(json_path: str, sqlite_path: str) -> None:
+    with open(json_path, 'r') as f:
+        db = json.load(f)
+    backend = SqliteBackend(sqlite_path)
+    try:
+        with backend._conn() as conn:
+            if conn.execute('SELECT COUNT(*) FROM clients').fetchone()[0]:
+                raise ValueError(f'{sqlite_path} is not empty.')
+            for client in db['clients']:
+                backend._insert_client(conn, client)
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'Usage: {sys.argv[0]} <local_db.json> <local_db.sqlite>')
+        sys.exit(1)
+    MigrateFromJson(sys.argv[1], sys.argv[2])
@@ -0,0 +1,97 @@
+# Unit tests.  Run from the repository root with
+#
+#   python -m unittest discover tests
+#
+# The library modules and the demo's modules are imported by name, like the
+# demo server and the benchmarks do.
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in ('demo_sign_contract/server', 'demo_sign_contract', ''):
+    _path = os.path.join(ROOT, _path).rstrip(os.sep)
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+
+# Runs each test in a fresh temporary directory, which holds the local DB
+# and everything else the modules keep relative to the working directory.
+class WorkdirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.workdir = tempfile.mkdtemp()
+        self._cwd = os.getcwd()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        super().tearDown()
+
+    def write_file(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+# A WorkdirTestCase with a local DB holding one client, `client1`, whose
+# contract `contract1` has the version BASE_BLOB_ID, and versioned_walrus
+# talking to a fresh fake publisher.
+class WalrusTestCase(WorkdirTestCase):
+
+    CLIENT_ID = 'client1'
+    CONTRACT_ID = 'contract1'
+    BASE_BLOB_ID = 'sRseDjpd4j8ryuByLboaXZSkT3BAbtDVw8W32cGjWMA'
+
+    def setUp(self):
+        super().setUp()
+        import fake_walrus
+        import local_db
+        import versioned_walrus
+        import walrus_transport
+
+        local_db.SetBackend(None)
+        db = {
+            'clients': [{
+                'client_id':
+                self.CLIENT_ID,
+                'name':
+                'Client 1',
+                'contracts': [{
+                    'contract_id':
+                    self.CONTRACT_ID,
+                    'name':
+                    'Contract 1',
+                    'versions': [{
+                        'blob_id': self.BASE_BLOB_ID,
+                        'initial_blob_data': self.BASE_BLOB_ID,
+                        'parents': [],
+                        'alias': 'doc1'
+                    }]
+                }]
+            }]
+        }
+        local_db.WriteJsonAtomically(local_db.DB_PATH, db)
+        # Also drops whatever the client repository cached.
+        local_db.SaveDatabase(db)
+        versioned_walrus.BLOB_CACHE_DIR = os.path.join(self.workdir,
+                                                       'blob_cache')
+        versioned_walrus._blob_cache = None
+        versioned_walrus._digest_index = None
+        versioned_walrus._lifetime_index = None
+        versioned_walrus._lifetime_manager = None
+        self.publisher = fake_walrus.FakePublisher()
+        self.publisher.start()
+        versioned_walrus.SetTransport(
+            walrus_transport.HttpTransport(self.publisher.url))
+
+    def tearDown(self):
+        import local_db
+        self.publisher.stop()
+        local_db.SetBackend(None)
+        super().tearDown()
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import unittest
+
+from tests import WorkdirTestCase
+
+import blob_cache
+import versioned_walrus
+
+
+class _EvictingCache(blob_cache.BlobCache):
+
+    # Another request commits a blob right after each commit, evicting the
+    # one just committed.
+    def commit(self, blob_id, tmp_path):
+        data = super().commit(blob_id, tmp_path)
+        if blob_id != 'other':
+            self.put_bytes('other', b'o' * 100)
+        return data
+
+
+class BlobCacheTest(WorkdirTestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = blob_cache.BlobCache('cache', max_bytes=300)
+        for blob_id in ('a', 'b', 'c'):
+            cache.put_bytes(blob_id, blob_id.encode() * 100)
+        # Reading `a` makes `b` the least recently used.
+        self.assertEqual(bytes(cache.get('a')), b'a' * 100)
+        cache.put_bytes('d', b'd' * 100)
+        self.assertEqual([b in cache for b in 'abcd'],
+                         [True, False, True, True])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {
+            'hits': 1,
+            'misses': 1,
+            'evictions': 1,
+            'entries': 3,
+            'bytes': 300
+        })
+        self.assertEqual(sorted(os.listdir('cache')), ['a', 'c', 'd'])
+
+    def test_oversized_blob_is_kept_alone(self):
+        cache = blob_cache.BlobCache('cache', max_bytes=100)
+        cache.put_bytes('a', b'a' * 50)
+        cache.put_bytes('big', b'b' * 200)
+        self.assertNotIn('a', cache)
+        self.assertEqual(bytes(cache.get('big')), b'b' * 200)
+
+    def test_order_is_restored_on_reopen(self):
+        cache = blob_cache.BlobCache('cache', max_bytes=300)
+        for blob_id in ('a/1', 'b/2', 'c/3'):
+            cache.put_bytes(blob_id, b'x' * 100)
+        # Modification times stand for the last use.
+        for i, name in enumerate(['b%2F2', 'c%2F3', 'a%2F1']):
+            os.utime(os.path.join('cache', name), (i, i))
+        reopened = blob_cache.BlobCache('cache', max_bytes=300)
+        self.assertEqual(reopened.stats()['bytes'], 300)
+        reopened.put_bytes('d', b'd' * 100)
+        self.assertNotIn('b/2', reopened)
+        self.assertIn('a/1', reopened)
+
+    def test_removed_file_is_a_miss(self):
+        cache = blob_cache.BlobCache('cache')
+        cache.put_bytes('a', b'a')
+        os.remove(os.path.join('cache', 'a'))
+        self.assertIsNone(cache.get('a'))
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_commit_survives_eviction(self):
+        cache = blob_cache.BlobCache('cache', max_bytes=100)
+        data = cache.put_bytes('a', b'a' * 100)
+        cache.put_bytes('b', b'b' * 100)
+        self.assertNotIn('a', cache)
+        self.assertEqual(bytes(data), b'a' * 100)
+
+    def test_cached_or_write_survives_eviction(self):
+        versioned_walrus._blob_cache = _EvictingCache('cache', max_bytes=100)
+        self.addCleanup(setattr, versioned_walrus, '_blob_cache', None)
+
+        async def write(path):
+            with open(path, 'wb') as f:
+                f.write(b'a' * 100)
+
+        data = asyncio.run(versioned_walrus._CachedOrWrite('a', write))
+        self.assertNotIn('a', versioned_walrus._blob_cache)
+        self.assertEqual(bytes(data), b'a' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
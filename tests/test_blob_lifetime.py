@@ -0,0 +1,208 @@
+import unittest
+
+from tests import WalrusTestCase, WorkdirTestCase
+
+import blob_lifetime
+import local_db
+import versioned_walrus
+import walrus_transport
+
+
+class _Transport(walrus_transport.WalrusTransport):
+
+    def __init__(self):
+        self.extended = []
+        self.batches = 0
+
+    def extend(self, blob_object_id: str, epochs: int) -> None:
+        self.extended.append((blob_object_id, epochs))
+
+    def extend_blobs(self, extensions: list[tuple]) -> dict:
+        self.batches += 1
+        return super().extend_blobs(extensions)
+
+
+def _Client(*blob_ids) -> dict:
+    return {
+        'client_id':
+        'client1',
+        'contracts': [{
+            'contract_id': 'contract1',
+            'versions': [{
+                'blob_id': blob_id
+            } for blob_id in blob_ids]
+        }]
+    }
+
+
+class LifetimeManagerTest(WorkdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.index = blob_lifetime.LifetimeIndex('lifetimes.jsonl')
+        self.index.observe_epoch(10)
+        self.transport = _Transport()
+        self.clients = []
+        self.listed = 0
+        self.manager = blob_lifetime.LifetimeManager(
+            self.index, lambda: self.transport, self.list_clients)
+
+    def list_clients(self) -> list[dict]:
+        self.listed += 1
+        return self.clients
+
+    def test_blob_committed_after_first_check_is_extended(self):
+        # Stored, and due at once, but its version is not committed yet.
+        self.index.record([{
+            'blob_id': 'blob1',
+            'end_epoch': 11,
+            'object_id': '0x1'
+        }])
+        self.assertEqual(self.manager.run_once(), 0)
+        self.assertEqual(self.transport.extended, [])
+
+        # Not looked at again until it expires.
+        self.assertEqual(self.manager.run_once(), 0)
+        self.assertEqual(self.listed, 1)
+
+        self.clients.append(_Client('blob1'))
+        self.manager.recheck(self.clients[0]['contracts'][0]['versions'])
+        self.assertEqual(self.manager.run_once(), 1)
+        self.assertEqual(self.transport.extended,
+                         [('0x1', 10 + blob_lifetime.KEEP_EPOCHS - 11)])
+        self.assertEqual(self.index.get('blob1')['end_epoch'],
+                         10 + blob_lifetime.KEEP_EPOCHS)
+
+    def test_due_blobs_are_extended_in_one_batch(self):
+        self.index.record([{
+            'blob_id': f'blob{i}',
+            'end_epoch': 11,
+            'object_id': f'0x{i}'
+        } for i in range(3)])
+        self.clients.append(_Client('blob0', 'blob1', 'blob2'))
+        self.assertEqual(self.manager.run_once(), 3)
+        self.assertEqual(self.transport.batches, 1)
+        self.assertEqual(self.listed, 1)
+
+    def test_unneeded_blob_lapses_at_its_end_epoch(self):
+        self.index.record([{
+            'blob_id': 'blob1',
+            'end_epoch': 11,
+            'object_id': '0x1'
+        }])
+        self.assertEqual(self.manager.run_once(), 0)
+        self.assertEqual(self.manager.run_once(), 0)
+        self.assertEqual(self.listed, 1)
+        self.index.observe_epoch(11)
+        self.assertEqual(self.manager.run_once(), 0)
+        self.assertEqual(self.listed, 2)
+        self.assertEqual(self.manager._heap, [])
+
+    def test_expired_blob_is_dropped(self):
+        self.index.record([{
+            'blob_id': 'blob1',
+            'end_epoch': 10,
+            'object_id': '0x1'
+        }])
+        self.assertEqual(self.manager.run_once(), 0)
+        self.clients.append(_Client('blob1'))
+        self.assertEqual(self.manager.run_once(), 0)
+        self.assertEqual(self.transport.extended, [])
+
+    def test_unmanaged_blob_is_not_extended(self):
+        self.index.record([{
+            'blob_id': 'blob1',
+            'end_epoch': 11,
+            'managed': False
+        }])
+        self.clients.append(_Client('blob1'))
+        self.assertEqual(self.manager.run_once(), 0)
+        self.assertFalse(self.index.get('blob1')['managed'])
+
+    def test_chunks_live_as_long_as_their_manifest(self):
+        self.index.record([{
+            'blob_id': 'chunk',
+            'end_epoch': 10
+        }, {
+            'blob_id': 'manifest',
+            'end_epoch': 12,
+            'children': ['chunk']
+        }])
+        self.assertFalse(self.index.alive('manifest'))
+        self.assertTrue(self.index.alive('unknown'))
+
+    def test_index_is_reloaded(self):
+        self.index.record([{
+            'blob_id': 'blob1',
+            'end_epoch': 11,
+            'managed': False
+        }])
+        index = blob_lifetime.LifetimeIndex('lifetimes.jsonl')
+        self.assertEqual(index.current_epoch(), 10)
+        self.assertEqual(index.get('blob1')['end_epoch'], 11)
+        self.assertFalse(index.get('blob1')['managed'])
+
+
+class ExpiredContentTest(WalrusTestCase):
+
+    def test_expired_blob_is_stored_again(self):
+        path = self.write_file('a.txt', b'contract text')
+        version = versioned_walrus.UploadFileOnVersion(
+            path, self.CLIENT_ID, self.BASE_BLOB_ID)
+        bid = version.blob_id.bid
+        self.assertEqual(self.publisher.store_calls, 1)
+
+        # Deduplicated while the blob lives.
+        versioned_walrus.UploadFileOnVersion(path, self.CLIENT_ID,
+                                             self.BASE_BLOB_ID)
+        self.assertEqual(self.publisher.store_calls, 1)
+
+        # Once it has lapsed the content is stored again.
+        index = versioned_walrus.GetLifetimeIndex()
+        self.publisher.current_epoch = index.get(bid)['end_epoch']
+        index.observe_epoch(self.publisher.current_epoch)
+        versioned_walrus.UploadFileOnVersion(path, self.CLIENT_ID,
+                                             self.BASE_BLOB_ID)
+        self.assertEqual(self.publisher.store_calls, 2)
+        self.assertTrue(index.alive(bid))
+        self.assertTrue(index.get(bid)['managed'])
+
+    def test_already_certified_blob_is_unmanaged(self):
+        path = self.write_file('a.txt', b'stored by someone else')
+        with open(path, 'rb') as f:
+            self.publisher.store(f.read(), 5)
+        version = versioned_walrus.UploadFileOnVersion(
+            path, self.CLIENT_ID, self.BASE_BLOB_ID)
+        blob = versioned_walrus.GetLifetimeIndex().get(version.blob_id.bid)
+        self.assertFalse(blob['managed'])
+        self.assertEqual(blob['end_epoch'], 6)
+
+
+class RecheckTest(WalrusTestCase):
+
+    def test_committed_version_is_rechecked(self):
+        index = versioned_walrus.GetLifetimeIndex()
+        index.observe_epoch(10)
+        index.record([{
+            'blob_id': 'blob1',
+            'end_epoch': 11,
+            'object_id': '0x1'
+        }])
+        manager = versioned_walrus.GetLifetimeManager()
+        transport = _Transport()
+        manager._get_transport = lambda: transport
+        self.assertEqual(manager.run_once(), 0)
+        local_db.AddVersion(
+            self.CLIENT_ID, self.CONTRACT_ID, {
+                'blob_id': 'blob1',
+                'initial_blob_data': self.BASE_BLOB_ID,
+                'parents': [self.BASE_BLOB_ID],
+                'alias': 'doc1'
+            })
+        self.assertEqual(manager.run_once(), 1)
+        self.assertEqual(transport.extended,
+                         [('0x1', 10 + blob_lifetime.KEEP_EPOCHS - 11)])
+
+
+if __name__ == '__main__':
+    unittest.main()
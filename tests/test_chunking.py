@@ -0,0 +1,104 @@
+import io
+import os
+import random
+import unittest
+
+from tests import WalrusTestCase
+
+import chunking
+import model
+import versioned_walrus
+
+_SIZES = {'min_size': 256, 'avg_size': 1024, 'max_size': 4096}
+
+
+def _Data(n: int, seed: int = 0) -> bytes:
+    return random.Random(seed).randbytes(n)
+
+
+def _Chunks(data: bytes, **sizes) -> list[bytes]:
+    return list(chunking.IterChunks(io.BytesIO(data), **sizes))
+
+
+class IterChunksTest(unittest.TestCase):
+
+    def test_chunks_rebuild_the_file(self):
+        data = _Data(100000)
+        chunks = _Chunks(data, **_SIZES)
+        self.assertEqual(b''.join(chunks), data)
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), _SIZES['min_size'])
+            self.assertLessEqual(len(chunk), _SIZES['max_size'])
+
+    def test_empty_and_small_files(self):
+        self.assertEqual(_Chunks(b'', **_SIZES), [])
+        self.assertEqual(_Chunks(b'small', **_SIZES), [b'small'])
+
+    def test_repeated_content_is_cut_at_max_size(self):
+        chunks = _Chunks(b'\0' * 10000, **_SIZES)
+        self.assertEqual([len(c) for c in chunks], [4096, 4096, 1808])
+
+    def test_edit_only_changes_nearby_chunks(self):
+        data = _Data(100000)
+        edited = data[:50000] + b'inserted' + data[50000:]
+        before = _Chunks(data, **_SIZES)
+        after = _Chunks(edited, **_SIZES)
+        changed = [c for c in after if c not in set(before)]
+        self.assertLessEqual(len(changed), 2)
+        self.assertEqual(b''.join(after), edited)
+
+    def test_prepended_content_keeps_later_chunks(self):
+        data = _Data(100000)
+        before = _Chunks(data, **_SIZES)
+        after = _Chunks(_Data(1000, seed=1) + data, **_SIZES)
+        self.assertEqual(after[-len(before) + 2:], before[2:])
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        manifest = chunking.BuildManifest([('a', 3), ('b', 4)])
+        self.assertEqual(chunking.ParseManifest(manifest), [('a', 3),
+                                                            ('b', 4)])
+        self.assertFalse(chunking.ChunksSealed(manifest))
+        self.assertTrue(
+            chunking.ChunksSealed(
+                chunking.BuildManifest([('a', 3)], sealed=True)))
+
+    def test_other_json_is_rejected(self):
+        with self.assertRaises(ValueError):
+            chunking.ParseManifest(b'{"chunks": []}')
+
+
+class ChunkedUploadTest(WalrusTestCase):
+
+    def upload(self, data: bytes, version_id: str) -> model.Version:
+        path = self.write_file('upload', data)
+        return versioned_walrus.UploadFileOnVersion(
+            path, self.CLIENT_ID, version_id, storage=model.STORAGE_CHUNKED)
+
+    def test_edit_stores_only_new_chunks(self):
+        data = _Data(512 * 1024)
+        version = self.upload(data, self.BASE_BLOB_ID)
+        chunks = _Chunks(data)
+        # Each chunk plus the manifest.
+        self.assertEqual(self.publisher.store_calls, len(chunks) + 1)
+
+        edited = data[:300000] + b'edited' + data[300006:]
+        new_chunks = [c for c in _Chunks(edited) if c not in set(chunks)]
+        self.assertLessEqual(len(new_chunks), 2)
+        edited_version = self.upload(edited, version.blob_id.bid)
+        self.assertEqual(self.publisher.store_calls,
+                         len(chunks) + 1 + len(new_chunks) + 1)
+
+        versioned_walrus._blob_cache = None
+        versioned_walrus.BLOB_CACHE_DIR = os.path.join(self.workdir,
+                                                       'other_cache')
+        self.assertEqual(
+            bytes(versioned_walrus.FetchFileByVersion(edited_version)),
+            edited)
+
+
+if __name__ == '__main__':
+    unittest.main()
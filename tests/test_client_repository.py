@@ -0,0 +1,117 @@
+import unittest
+from unittest import mock
+
+from tests import WalrusTestCase
+
+import client_repository
+import local_db
+import model
+
+
+def _Version(bid: str, parent: str = None, timestamp: int = 0) -> dict:
+    return {
+        'blob_id': bid,
+        'initial_blob_data': bid,
+        'parents': [parent] if parent else [],
+        'alias': 'doc',
+        'timestamp': timestamp
+    }
+
+
+class LocateTest(WalrusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.repository = client_repository.GetRepository()
+        patcher = mock.patch.object(local_db,
+                                    'ListClients',
+                                    wraps=local_db.ListClients)
+        self.list_clients = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def located(self, blob_id: str) -> list[tuple]:
+        return [(client.client_id, contract.contract_id, version.blob_id.bid)
+                for client, contract, version in self.repository.locate(
+                    blob_id)]
+
+    def test_commits_update_the_owner_index(self):
+        self.assertEqual(self.located(self.BASE_BLOB_ID),
+                         [(self.CLIENT_ID, self.CONTRACT_ID,
+                           self.BASE_BLOB_ID)])
+        local_db.AddVersion(self.CLIENT_ID, self.CONTRACT_ID,
+                            _Version('v2', self.BASE_BLOB_ID))
+        local_db.AddClient({
+            'client_id':
+            'client2',
+            'name':
+            'Client 2',
+            'contracts': [{
+                'contract_id': 'contract2',
+                'name': 'Contract 2',
+                'versions': [_Version('v2')]
+            }]
+        })
+        local_db.AddContract(self.CLIENT_ID, {
+            'contract_id': 'contract3',
+            'name': 'Contract 3',
+            'versions': [_Version('v3')]
+        })
+        self.assertEqual(self.located('v2'),
+                         [(self.CLIENT_ID, self.CONTRACT_ID, 'v2'),
+                          ('client2', 'contract2', 'v2')])
+        self.assertEqual(self.located('v3'),
+                         [(self.CLIENT_ID, 'contract3', 'v3')])
+        self.assertEqual(self.located('unknown'), [])
+        self.assertEqual(self.list_clients.call_count, 1)
+
+    def test_only_owners_are_loaded(self):
+        local_db.AddClient({
+            'client_id':
+            'client2',
+            'name':
+            'Client 2',
+            'contracts': [{
+                'contract_id': 'contract2',
+                'name': 'Contract 2',
+                'versions': [_Version('v2')]
+            }]
+        })
+        with mock.patch.object(local_db, 'GetClient',
+                               wraps=local_db.GetClient) as get_client:
+            self.located(self.BASE_BLOB_ID)
+            local_db.UpdateVersion('client2', 'contract2', 'v2',
+                                   {'signed_by': 'someone'})
+            self.located(self.BASE_BLOB_ID)
+        self.assertEqual([c.args for c in get_client.call_args_list],
+                         [(self.CLIENT_ID, )])
+
+    def test_replaced_db_is_listed_again(self):
+        self.located(self.BASE_BLOB_ID)
+        local_db.SaveDatabase({'clients': []})
+        self.assertEqual(self.located(self.BASE_BLOB_ID), [])
+        self.assertEqual(self.list_clients.call_count, 2)
+
+
+class VersionIndexTest(unittest.TestCase):
+
+    def version(self, timestamp: int, sequence: int) -> model.Version:
+        return model.Version(model.BlobID(bid=f'v{sequence}',
+                                          timestamp=timestamp),
+                             sequence=sequence)
+
+    def test_added_versions_are_sorted(self):
+        versions = [self.version(t, s) for s, t in enumerate([3, 1, 2], 1)]
+        built = model.VersionIndex(versions)
+        added = model.VersionIndex()
+        for version in versions:
+            added.add(version)
+        for index in (built, added):
+            self.assertEqual([v.sequence for v in index.range()], [2, 3, 1])
+            self.assertEqual(
+                [v.sequence for v in index.range(after=2, before=3)], [3, 1])
+            self.assertIs(index.by_sequence(2), versions[1])
+            self.assertEqual(len(index), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
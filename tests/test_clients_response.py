@@ -0,0 +1,50 @@
+import json
+import unittest
+
+from tests import WorkdirTestCase
+
+import clients_response
+import local_db
+
+
+class ClientsResponseCacheTest(WorkdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        local_db.SetBackend(None)
+        self.addCleanup(local_db.SetBackend, None)
+        self.write_db('Client 1')
+
+    def write_db(self, name: str) -> None:
+        local_db.WriteJsonAtomically(
+            local_db.DB_PATH, {
+                'clients': [{
+                    'client_id': 'client1',
+                    'name': name,
+                    'contracts': []
+                }]
+            })
+
+    def test_etag_follows_content(self):
+        etag, body = clients_response.ClientsResponseCache().get()
+        self.assertEqual(json.loads(body)[0]['name'], 'Client 1')
+        # Another process, or this one before a restart, changed the DB
+        # without this process committing anything.
+        self.write_db('Client 2')
+        new_etag, body = clients_response.ClientsResponseCache().get()
+        self.assertEqual(json.loads(body)[0]['name'], 'Client 2')
+        self.assertNotEqual(new_etag, etag)
+
+    def test_etag_changes_on_commit(self):
+        cache = clients_response.ClientsResponseCache()
+        etag, _ = cache.get()
+        self.assertEqual(cache.get()[0], etag)
+        local_db.AddContract('client1', {
+            'contract_id': 'contract1',
+            'versions': []
+        })
+        self.assertNotEqual(cache.get()[0], etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
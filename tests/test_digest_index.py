@@ -0,0 +1,68 @@
+import unittest
+
+from tests import WalrusTestCase, WorkdirTestCase
+
+import digest_index
+import versioned_walrus
+
+
+class DigestIndexTest(WorkdirTestCase):
+
+    def test_reload(self):
+        index = digest_index.DigestIndex('digests.jsonl')
+        index.record('d1', 'blob1')
+        index.record('d2', 'blob2')
+        index.record('d1', 'blob3')
+        reloaded = digest_index.DigestIndex('digests.jsonl')
+        self.assertEqual(reloaded.lookup('d1'), 'blob3')
+        self.assertEqual(reloaded.lookup('d2'), 'blob2')
+        self.assertIsNone(reloaded.lookup('d3'))
+        self.assertEqual(len(reloaded), 2)
+
+    def test_torn_last_line_is_dropped(self):
+        index = digest_index.DigestIndex('digests.jsonl')
+        index.record('d1', 'blob1')
+        with open('digests.jsonl', 'a') as f:
+            f.write('{"digest": "d2", "blob_id": "bl')
+        index = digest_index.DigestIndex('digests.jsonl')
+        self.assertIsNone(index.lookup('d2'))
+        # The next append is not joined to the torn line.
+        index.record('d3', 'blob3')
+        reloaded = digest_index.DigestIndex('digests.jsonl')
+        self.assertEqual(reloaded.lookup('d1'), 'blob1')
+        self.assertEqual(reloaded.lookup('d3'), 'blob3')
+
+    def test_complete_line_without_newline_is_dropped(self):
+        with open('digests.jsonl', 'w') as f:
+            f.write('{"digest": "d1", "blob_id": "blob1"}\n'
+                    '{"digest": "d2", "blob_id": "blob2"}')
+        index = digest_index.DigestIndex('digests.jsonl')
+        self.assertEqual(index.lookup('d1'), 'blob1')
+        self.assertIsNone(index.lookup('d2'))
+
+
+class DedupTest(WalrusTestCase):
+
+    def upload(self, name: str, data: bytes):
+        path = self.write_file(name, data)
+        return versioned_walrus.UploadFileOnVersion(path, self.CLIENT_ID,
+                                                    self.BASE_BLOB_ID)
+
+    def test_identical_content_is_stored_once(self):
+        first = self.upload('a.txt', b'contract text')
+        second = self.upload('b.txt', b'contract text')
+        self.assertEqual(self.publisher.store_calls, 1)
+        self.assertEqual(second.blob_id.bid, first.blob_id.bid)
+        self.upload('c.txt', b'other text')
+        self.assertEqual(self.publisher.store_calls, 2)
+
+    def test_index_survives_a_restart(self):
+        first = self.upload('a.txt', b'contract text')
+        versioned_walrus._digest_index = None
+        second = self.upload('b.txt', b'contract text')
+        self.assertEqual(self.publisher.store_calls, 1)
+        self.assertEqual(second.blob_id.bid, first.blob_id.bid)
+
+
+if __name__ == '__main__':
+    unittest.main()
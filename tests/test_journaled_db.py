@@ -0,0 +1,90 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from tests import WorkdirTestCase
+
+import journaled_db
+import local_db
+
+
+def _Client(client_id: str) -> dict:
+    return {'client_id': client_id, 'name': client_id, 'contracts': []}
+
+
+class JournaledJsonBackendTest(WorkdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open('db.json', 'w') as f:
+            json.dump({'clients': []}, f)
+
+    def open(self) -> journaled_db.JournaledJsonBackend:
+        backend = journaled_db.JournaledJsonBackend('db.json',
+                                                    compact_bytes=1 << 30)
+        self.addCleanup(backend.close)
+        return backend
+
+    def client_ids(self, backend) -> list[str]:
+        return [client['client_id'] for client in backend.list_clients()]
+
+    def test_replay(self):
+        backend = self.open()
+        backend.add_client(_Client('k1'))
+        backend.add_contract('k1', {'contract_id': 'c1', 'versions': []})
+        backend.close()
+        reopened = self.open()
+        self.assertEqual(reopened.get_client('k1')['contracts'][0]
+                         ['contract_id'], 'c1')
+
+    def test_torn_last_record_is_dropped(self):
+        backend = self.open()
+        backend.add_client(_Client('k1'))
+        backend.close()
+        with open('db.json.log', 'ab') as f:
+            f.write(b'{"op":"add_client","seq":2,"cli')
+        self.assertEqual(self.client_ids(self.open()), ['k1'])
+
+    def test_compaction(self):
+        backend = self.open()
+        backend.add_client(_Client('k1'))
+        backend.compact()
+        backend.add_client(_Client('k2'))
+        self.assertFalse(os.path.exists('db.json.log.old'))
+        with open('db.json') as f:
+            self.assertEqual(len(json.load(f)['clients']), 1)
+        self.assertEqual(self.client_ids(self.open()), ['k1', 'k2'])
+
+    def test_crash_during_compaction_after_failed_one(self):
+        backend = self.open()
+        backend.add_client(_Client('k1'))
+        # The snapshot write fails; k1 is left in the rotated log.
+        with mock.patch.object(local_db, 'WriteJsonAtomically',
+                               side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                backend.compact()
+        backend.add_client(_Client('k2'))
+        # The process dies while writing the next snapshot.
+        with mock.patch.object(local_db, 'WriteJsonAtomically',
+                               side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                backend.compact()
+        self.assertEqual(self.client_ids(self.open()), ['k1', 'k2'])
+
+    def test_compaction_after_failed_one(self):
+        backend = self.open()
+        backend.add_client(_Client('k1'))
+        with mock.patch.object(local_db, 'WriteJsonAtomically',
+                               side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                backend.compact()
+        backend.add_client(_Client('k2'))
+        backend.compact()
+        backend.add_client(_Client('k3'))
+        self.assertFalse(os.path.exists('db.json.log.old'))
+        self.assertEqual(self.client_ids(self.open()), ['k1', 'k2', 'k3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import threading
+import time
+import unittest
+
+import local_db
+
+
+# Records each batch and holds the first one until `release` is set, so the
+# other writers queue up behind it.
+class _Backend(object):
+
+    def __init__(self):
+        self.batches = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def apply_batch(self, mutations: list[dict]) -> list:
+        self.batches.append([m['n'] for m in mutations])
+        self.writing.set()
+        self.release.wait(10)
+        if any(m.get('crash') for m in mutations):
+            raise OSError('disk full')
+        return [
+            ValueError(m['n']) if m.get('reject') else None
+            for m in mutations
+        ]
+
+
+def _Start(target, *args) -> threading.Thread:
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class GroupCommitterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.committer = local_db.GroupCommitter()
+        self.backend = _Backend()
+        self.errors = {}
+
+    def commit(self, mutation: dict) -> None:
+        try:
+            self.committer.commit(self.backend, mutation)
+        except Exception as e:
+            self.errors[mutation['n']] = e
+
+    # Commits `mutations` from one thread each, the first one alone, and the
+    # others while it is being written.
+    def commit_concurrently(self, mutations: list[dict]) -> None:
+        threads = [_Start(self.commit, mutations[0])]
+        self.assertTrue(self.backend.writing.wait(10))
+        threads += [_Start(self.commit, m) for m in mutations[1:]]
+        while len(self.committer._pending) < len(mutations) - 1:
+            time.sleep(0.01)
+        self.backend.release.set()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+    def test_queued_writers_share_one_batch(self):
+        self.commit_concurrently([{'n': n} for n in range(5)])
+        self.assertEqual(self.backend.batches[0], [0])
+        self.assertEqual(sorted(self.backend.batches[1]), [1, 2, 3, 4])
+        self.assertEqual(len(self.backend.batches), 2)
+        self.assertEqual(self.errors, {})
+        self.assertFalse(self.committer._active)
+
+    def test_rejected_mutation_only_fails_its_writer(self):
+        self.commit_concurrently([{'n': 0}, {'n': 1, 'reject': True},
+                                  {'n': 2}])
+        self.assertEqual(list(self.errors), [1])
+        self.assertIsInstance(self.errors[1], ValueError)
+
+    def test_failed_batch_fails_each_writer(self):
+        self.commit_concurrently([{'n': 0}, {'n': 1, 'crash': True},
+                                  {'n': 2}])
+        self.assertEqual(sorted(self.errors), [1, 2])
+        self.assertIsInstance(self.errors[2], OSError)
+        # The next writer leads a batch of its own.
+        self.backend.batches = []
+        self.commit({'n': 3})
+        self.assertEqual(self.backend.batches, [[3]])
+
+
+class RWLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = local_db.RWLock()
+        self.events = []
+
+    def read(self, name: str) -> None:
+        with self.lock.read_locked():
+            self.events.append(name)
+
+    def write(self, name: str) -> None:
+        with self.lock.write_locked():
+            self.events.append(name)
+
+    def test_readers_share_the_lock(self):
+        barrier = threading.Barrier(2, timeout=10)
+
+        def read():
+            with self.lock.read_locked():
+                barrier.wait()
+
+        threads = [_Start(read) for _ in range(2)]
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+    def test_writer_excludes_readers_and_writers(self):
+        self.lock.acquire_write()
+        threads = [_Start(self.read, 'read'), _Start(self.write, 'write')]
+        time.sleep(0.1)
+        self.assertEqual(self.events, [])
+        self.lock.release_write()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(sorted(self.events), ['read', 'write'])
+
+    def test_waiting_writer_goes_before_new_readers(self):
+        self.lock.acquire_read()
+        writer = _Start(self.write, 'write')
+        while not self.lock._waiting_writers:
+            time.sleep(0.01)
+        reader = _Start(self.read, 'read')
+        time.sleep(0.1)
+        self.assertEqual(self.events, [])
+        self.lock.release_read()
+        for thread in (writer, reader):
+            thread.join(10)
+        self.assertEqual(self.events, ['write', 'read'])
+
+    def test_writer_may_lock_again(self):
+        with self.lock.write_locked():
+            with self.lock.write_locked(), self.lock.read_locked():
+                pass
+            # Still held after the nested sections.
+            reader = _Start(self.read, 'read')
+            time.sleep(0.1)
+            self.assertEqual(self.events, [])
+        reader.join(10)
+        self.assertEqual(self.events, ['read'])
+
+
+class ClientLockTest(unittest.TestCase):
+
+    def test_one_lock_per_client(self):
+        self.assertIs(local_db.ClientLock('k1'), local_db.ClientLock('k1'))
+        self.assertIsNot(local_db.ClientLock('k1'),
+                         local_db.ClientLock('k2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
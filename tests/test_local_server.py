@@ -0,0 +1,106 @@
+import http.client
+import json
+import os
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from tests import WalrusTestCase
+
+import blob_lifetime
+import local_db
+import local_server_main
+import signature_batch
+
+
+class LocalServerTest(WalrusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(local_server_main, 'UPLOAD_DIR',
+                                    os.path.join(self.workdir, 'tmp'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0),
+                                         local_server_main.RequestHandler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def request(self, method: str, path: str, body: bytes = None,
+                headers: dict = None) -> tuple:
+        conn = http.client.HTTPConnection(*self.httpd.server_address[:2])
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            conn.close()
+
+    def test_clients_page(self):
+        status, _, body = self.request('GET', '/get_clients?limit=1')
+        self.assertEqual(status, 200)
+        page = json.loads(body)
+        self.assertEqual([c['client_id'] for c in page['clients']],
+                         [self.CLIENT_ID])
+        self.assertIsNone(page['next_cursor'])
+
+    def test_clients_page_db_error(self):
+        with mock.patch.object(local_server_main._clients_response,
+                               '_refresh',
+                               side_effect=OSError('DB unreadable')):
+            status, _, body = self.request('GET', '/get_clients?limit=1')
+        self.assertEqual(status, 500)
+        self.assertIn('DB unreadable', json.loads(body)['message'])
+
+    def test_metrics(self):
+        self.request('GET', '/get_clients?limit=1')
+        status, headers, body = self.request('GET', '/metrics')
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['Content-Type'].startswith('text/plain'))
+        text = body.decode('utf-8')
+        self.assertIn(
+            'http_request_duration_seconds_bucket{handler="/get_clients",'
+            'method="GET",status="200",le="+Inf"} ', text)
+        self.assertIn('versioned_walrus_stage_seconds_count{stage="db_load"}',
+                      text)
+
+    def test_upload_with_bad_field_is_rejected(self):
+        body = (b'--b\r\n'
+                b'Content-Disposition: form-data; name="client_id"\r\n\r\n'
+                b'\xff\r\n'
+                b'--b--\r\n')
+        status, _, response = self.request(
+            'POST', '/upload_contract', body,
+            {'Content-Type': 'multipart/form-data; boundary=b'})
+        self.assertEqual(status, 400)
+        self.assertIn('UTF-8', json.loads(response)['message'])
+
+    def test_every_signer_keeps_its_anchor(self):
+        for signer in ('client', 'agent'):
+            status, _, _ = self.request(
+                'POST', '/sign_contract',
+                json.dumps({
+                    'client_id': self.CLIENT_ID,
+                    'contract_id': self.CONTRACT_ID,
+                    'version_blob_id': self.BASE_BLOB_ID,
+                    'signer': signer
+                }).encode('utf-8'), {'Content-Type': 'application/json'})
+            self.assertEqual(status, 200)
+        version = local_db.GetClient(
+            self.CLIENT_ID)['contracts'][0]['versions'][0]
+        anchors = []
+        for signer in ('client', 'agent'):
+            self.assertTrue(version[f'signed_by_{signer}'])
+            proof = version[f'sig_proof_{signer}']
+            self.assertEqual(proof['record']['signer'], signer)
+            self.assertTrue(signature_batch.VerifyProof(proof))
+            anchors.append(version[f'sig_blob_id_{signer}'])
+        self.assertEqual(blob_lifetime._VersionBlobs(version),
+                         [self.BASE_BLOB_ID] + anchors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import threading
+import unittest
+
+import metrics
+
+
+class HistogramTest(unittest.TestCase):
+
+    def histogram(self, labelnames: tuple = ()) -> metrics.Histogram:
+        histogram = metrics.Histogram('test_seconds', 'Test "help".',
+                                      labelnames, (0.1, 1, 0.5))
+        self.addCleanup(metrics._registry.remove, histogram)
+        return histogram
+
+    def test_buckets_are_cumulative(self):
+        histogram = self.histogram()
+        for value in (0.05, 0.1, 0.3, 2, 7):
+            histogram.observe(value)
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test "help".',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="0.5"} 3',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 5',
+            'test_seconds_sum 9.45',
+            'test_seconds_count 5',
+        ])
+
+    def test_series_per_label_values(self):
+        histogram = self.histogram(('handler', 'status'))
+        histogram.observe(0.2, handler='/b', status=200)
+        histogram.observe(0.2, handler='/a"\n', status=500)
+        lines = histogram.render()
+        self.assertEqual(len(lines), 2 + 2 * 6)
+        self.assertEqual(lines[2],
+                         'test_seconds_bucket{handler="/a\\"\\n",'
+                         'status="500",le="0.1"} 0')
+        self.assertEqual(lines[7], 'test_seconds_count'
+                         '{handler="/a\\"\\n",status="500"} 1')
+        self.assertEqual(lines[-1],
+                         'test_seconds_count{handler="/b",status="200"} 1')
+        with self.assertRaises(KeyError):
+            histogram.observe(0.2, handler='/a')
+
+    def test_time_observes_failed_blocks(self):
+        histogram = self.histogram()
+        with self.assertRaises(ValueError), histogram.time():
+            raise ValueError()
+        self.assertEqual(histogram.render()[-1], 'test_seconds_count 1')
+
+    def test_concurrent_observations_are_counted(self):
+        histogram = self.histogram()
+
+        def observe():
+            for _ in range(1000):
+                histogram.observe(0.2)
+
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(histogram.render()[-1], 'test_seconds_count 4000')
+
+    def test_render_lists_every_histogram(self):
+        self.histogram().observe(0.2)
+        with metrics.Stage('lookup'):
+            pass
+        text = metrics.Render()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('\ntest_seconds_count 1\n', text)
+        self.assertIn(
+            '\nversioned_walrus_stage_seconds_bucket'
+            '{stage="lookup",le="+Inf"} ', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import model
+
+
+def _BlobID(bid: str) -> model.BlobID:
+    return model.BlobID(bid=bid, timestamp=1700000000)
+
+
+class VersionTest(unittest.TestCase):
+
+    def test_to_dict_keeps_the_old_wire_format(self):
+        version = model.Version(_BlobID('v3'),
+                                initial_blob_data=_BlobID('v1'),
+                                previous_versions=[_BlobID('v1'),
+                                                   _BlobID('v2')],
+                                alias='doc',
+                                sequence=3)
+        self.assertEqual(
+            version.to_dict(), {
+                'blob_id': 'v3',
+                'initial_blob_data': 'v1',
+                'previous_versions': ['v1', 'v2'],
+                'alias': 'doc'
+            })
+
+    def test_add_version_appends_to_the_history(self):
+        graph = model.VersionGraph()
+        v1, v2, v3 = _BlobID('v1'), _BlobID('v2'), _BlobID('v3')
+        graph.add(v1, [])
+        graph.add(v2, [v1])
+        version = model.Version(v2,
+                                initial_blob_data=v1,
+                                parents=[v1],
+                                graph=graph)
+        version.add_version(v3)
+        self.assertEqual([v.bid for v in version.previous_versions],
+                         ['v1', 'v3'])
+        self.assertEqual(version.to_dict()['previous_versions'],
+                         ['v1', 'v3'])
+        self.assertEqual(version.parents, [v3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from tests import WalrusTestCase
+
+import model
+import packing
+import versioned_walrus
+
+
+class PackFormatTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        files = [b'first', b'', b'third file']
+        pack, ranges = packing.BuildPack(files)
+        self.assertEqual(ranges, [(0, 5), (5, 0), (5, 10)])
+        self.assertEqual(packing.ParseIndex(memoryview(pack)), ranges)
+        self.assertEqual(
+            [pack[offset:offset + length] for offset, length in ranges],
+            files)
+
+    def test_other_data_is_not_a_pack(self):
+        pack, _ = packing.BuildPack([b'data'])
+        for data in (b'VWPK', pack[:-1] + b'X', b'\x00\x00\x00\x09VWPK',
+                     b'{}\x00\x00\x00\x02VWPK'):
+            with self.assertRaises(ValueError):
+                packing.ParseIndex(data)
+
+    def test_packed_blob_id(self):
+        bid = packing.PackedBlobId('pack:id', 10, 20)
+        self.assertEqual(packing.ParsePackedBlobId(bid), ('pack:id', 10, 20))
+        for bid in ('pack', 'pack:1', ':1:2', 'pack:-1:2', 'pack:a:2'):
+            with self.assertRaises(ValueError):
+                packing.ParsePackedBlobId(bid)
+
+
+class PackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.packs = []
+
+    async def store(self, pack: bytes) -> str:
+        self.packs.append(pack)
+        return f'pack{len(self.packs)}'
+
+    def add_all(self, packer: packing.Packer, files: list[bytes]) -> list:
+
+        async def run():
+            return await asyncio.gather(*[packer.add(f) for f in files])
+
+        return asyncio.run(run())
+
+    def test_files_within_the_window_share_a_pack(self):
+        packer = packing.Packer(self.store, max_bytes=1000, window=0.05)
+        results = self.add_all(packer, [b'a', b'bb', b'ccc'])
+        self.assertEqual(results, [('pack1', 0, 1), ('pack1', 1, 2),
+                                   ('pack1', 3, 3)])
+        self.assertEqual(len(self.packs), 1)
+
+    def test_full_pack_is_written_at_once(self):
+        # A window the test would time out on.
+        packer = packing.Packer(self.store, max_bytes=4, window=60)
+        results = self.add_all(packer, [b'aa', b'bb', b'cccc'])
+        self.assertEqual([pack_id for pack_id, _, _ in results],
+                         ['pack1', 'pack1', 'pack2'])
+
+    def test_failed_store_fails_every_file(self):
+
+        async def store(pack):
+            raise OSError('store failed')
+
+        packer = packing.Packer(store, max_bytes=1000, window=0.01)
+
+        async def run():
+            return await asyncio.gather(packer.add(b'a'),
+                                        packer.add(b'b'),
+                                        return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertEqual([type(r) for r in results], [OSError, OSError])
+
+
+class PackedUploadTest(WalrusTestCase):
+
+    def test_small_files_are_stored_in_one_pack(self):
+        contents = [b'small file %d' % i for i in range(3)]
+        results = versioned_walrus.UploadFilesOnVersions(
+            [(self.write_file(f'upload{i}', data), self.CLIENT_ID,
+              self.BASE_BLOB_ID) for i, data in enumerate(contents)],
+            storage=model.STORAGE_PACKED)
+        self.assertEqual(self.publisher.store_calls, 1)
+        versions = [r.version for r in results]
+        self.assertEqual({v.storage for v in versions},
+                         {model.STORAGE_PACKED})
+        self.assertEqual(
+            len({packing.ParsePackedBlobId(v.blob_id.bid)[0]
+                 for v in versions}), 1)
+        self.assertEqual(
+            [bytes(versioned_walrus.FetchFileByVersion(v)) for v in versions],
+            contents)
+
+    def test_large_file_is_stored_as_a_blob(self):
+        path = self.write_file('upload', b'large file')
+        with mock.patch.object(versioned_walrus, 'PACK_THRESHOLD', 5):
+            version = versioned_walrus.UploadFileOnVersion(
+                path, self.CLIENT_ID, self.BASE_BLOB_ID,
+                storage=model.STORAGE_PACKED)
+        self.assertEqual(version.storage, model.STORAGE_BLOB)
+        self.assertEqual(bytes(versioned_walrus.FetchFileByVersion(version)),
+                         b'large file')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+
+from tests import WalrusTestCase
+
+import client_repository
+import local_db
+import model
+import utils
+import versioned_walrus
+
+
+def _Contract(contract_id: str, count: int, start: int) -> dict:
+    bids = [f'{contract_id}-v{i}' for i in range(1, count + 1)]
+    return {
+        'contract_id': contract_id,
+        'name': contract_id,
+        'versions': [{
+            'blob_id': bid,
+            'initial_blob_data': bids[0],
+            'parents': [bids[i - 1]] if i else [],
+            'alias': 'doc',
+            'timestamp': start + i,
+            'sequence': i + 1
+        } for i, bid in enumerate(bids)]
+    }
+
+
+class QueryTest(WalrusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        local_db.SaveDatabase({
+            'clients': [{
+                'client_id':
+                self.CLIENT_ID,
+                'name':
+                'Client 1',
+                'contracts': [
+                    _Contract('c1', 3, 1000),
+                    _Contract('c2', 3, 2000),
+                    _Contract('c3', 6, 3000)
+                ]
+            }]
+        })
+
+    # Returns the blob IDs of every page of GetContracts.
+    def contract_pages(self, **options) -> list[list[str]]:
+        pages = []
+        cursor = None
+        while True:
+            page = utils.GetContracts(
+                self.CLIENT_ID, model.QueryOptions(cursor=cursor, **options))
+            pages.append([
+                v.blob_id.bid for contract in page
+                for v in contract.versions
+            ])
+            cursor = page.next_cursor
+            if cursor is None:
+                return pages
+
+    def version_pages(self, bid: str, **options) -> list[list[str]]:
+        _, version = client_repository.GetRepository().find_version(
+            self.CLIENT_ID, bid)
+        pages = []
+        cursor = None
+        while True:
+            page = versioned_walrus.QueryVersions(
+                version, model.QueryOptions(cursor=cursor, **options))
+            pages.append([v.blob_id.bid for v in page])
+            cursor = page.next_cursor
+            if cursor is None:
+                return pages
+
+    def test_last_page_is_not_empty(self):
+        self.assertEqual(self.version_pages('c3-v1', limit=2),
+                         [['c3-v1', 'c3-v2'], ['c3-v3', 'c3-v4'],
+                          ['c3-v5', 'c3-v6']])
+
+    def test_pages_across_contracts(self):
+        self.assertEqual(self.contract_pages(limit=4), [
+            ['c1-v1', 'c1-v2', 'c1-v3', 'c2-v1'],
+            ['c2-v2', 'c2-v3', 'c3-v1', 'c3-v2'],
+            ['c3-v3', 'c3-v4', 'c3-v5', 'c3-v6'],
+        ])
+        # A page ending exactly at the end of a contract.
+        self.assertEqual(self.contract_pages(limit=3)[:2],
+                         [['c1-v1', 'c1-v2', 'c1-v3'],
+                          ['c2-v1', 'c2-v2', 'c2-v3']])
+
+    def test_no_limit(self):
+        self.assertEqual(len(self.contract_pages()[0]), 12)
+
+    def test_time_range(self):
+        time_range = model.TimeRange(after=1001, before=2001)
+        self.assertEqual(
+            self.contract_pages(query_by_time=time_range, limit=2),
+            [['c1-v2', 'c1-v3'], ['c2-v1', 'c2-v2']])
+
+    def test_by_sequence(self):
+        self.assertEqual(self.version_pages('c2-v3', query_by_version=2),
+                         [['c2-v2']])
+        self.assertEqual(self.version_pages('c2-v3', query_by_version=9),
+                         [[]])
+
+    def test_page_sees_new_versions(self):
+        first = utils.GetContracts(self.CLIENT_ID,
+                                   model.QueryOptions(limit=12))
+        self.assertIsNone(first.next_cursor)
+        local_db.AddVersion(
+            self.CLIENT_ID, 'c3', {
+                'blob_id': 'c3-v7',
+                'initial_blob_data': 'c3-v1',
+                'parents': ['c3-v6'],
+                'alias': 'doc',
+                'timestamp': 4000
+            })
+        self.assertEqual(self.contract_pages(limit=12)[-1], ['c3-v7'])
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', client_repository._EncodeCursor(
+                'client1', 'unknown', model.Version(
+                    model.BlobID('x', 0), sequence=1))):
+            with self.assertRaises(ValueError):
+                utils.GetContracts(self.CLIENT_ID,
+                                   model.QueryOptions(limit=2, cursor=cursor))
+
+
+if __name__ == '__main__':
+    unittest.main()
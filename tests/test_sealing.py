@@ -0,0 +1,130 @@
+import io
+import random
+import unittest
+from unittest import mock
+
+from tests import WalrusTestCase
+
+import digest_index
+import model
+import sealing
+import versioned_walrus
+
+
+def _Unseal(sealed: bytes, key: bytes = None) -> bytes:
+    out = io.BytesIO()
+    unsealer = sealing.Unsealer(out, lambda _: key)
+    # Odd write sizes split headers and frames across writes.
+    for i in range(0, len(sealed), 7):
+        unsealer.write(sealed[i:i + 7])
+    unsealer.close()
+    return out.getvalue()
+
+
+def _Data(size: int, seed: int = 0) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+@mock.patch.object(sealing, 'FRAME_SIZE', 1024)
+class SealTest(unittest.TestCase):
+
+    def seal(self, data: bytes, key: bytes = None) -> bytes:
+        return sealing.SealBytes(data, digest_index.BytesDigest(data), key)
+
+    def test_round_trip(self):
+        for data in (b'', b'short', _Data(5000), b'a' * 5000):
+            self.assertEqual(_Unseal(self.seal(data)), data)
+
+    def test_sealing_is_deterministic(self):
+        data = _Data(3000)
+        self.assertEqual(self.seal(data), self.seal(data))
+
+    def test_truncated_frame_is_rejected(self):
+        sealed = self.seal(_Data(3000))
+        for end in (len(sealed) - 1, len(sealed) - 1024, 30):
+            with self.assertRaises(sealing.SealError):
+                _Unseal(sealed[:end])
+
+    def test_data_after_last_frame_is_rejected(self):
+        sealed = self.seal(b'data')
+        with self.assertRaises(sealing.SealError):
+            _Unseal(sealed + sealed[-10:])
+
+    def test_not_sealed(self):
+        with self.assertRaises(sealing.SealError):
+            _Unseal(b'x' * 100)
+
+    @unittest.skipIf(sealing.AESGCM is None, 'needs cryptography')
+    def test_encrypted_round_trip(self):
+        key = bytes(range(32))
+        data = _Data(5000)
+        sealed = self.seal(data, key)
+        self.assertNotIn(data[:100], sealed)
+        self.assertEqual(_Unseal(sealed, key), data)
+        with self.assertRaises(sealing.SealError):
+            _Unseal(sealed, bytes(32))
+
+    @unittest.skipIf(sealing.AESGCM is None, 'needs cryptography')
+    def test_tampered_frame_is_rejected(self):
+        key = bytes(range(32))
+        sealed = bytearray(self.seal(_Data(3000), key))
+        sealed[-5] ^= 1
+        with self.assertRaises(sealing.SealError):
+            _Unseal(bytes(sealed), key)
+
+
+@mock.patch.object(sealing, 'SEAL_MODE', sealing.SEAL_COMPRESS)
+class SealedUploadTest(WalrusTestCase):
+
+    def upload(self, data: bytes, storage: str) -> model.Version:
+        path = self.write_file('upload', data)
+        return versioned_walrus.UploadFileOnVersion(path, self.CLIENT_ID,
+                                                    self.BASE_BLOB_ID,
+                                                    storage)
+
+    def fetch(self, version: model.Version) -> bytes:
+        return bytes(versioned_walrus.FetchFileByVersion(version))
+
+    def test_round_trip(self):
+        for storage in (model.STORAGE_BLOB, model.STORAGE_CHUNKED,
+                        model.STORAGE_PACKED):
+            data = _Data(300 * 1024, seed=len(storage)) + b'z' * 1000
+            version = self.upload(data, storage)
+            self.assertEqual(version.sealed_for, self.CLIENT_ID)
+            self.assertEqual(version.storage, storage if storage !=
+                             model.STORAGE_PACKED else model.STORAGE_BLOB)
+            self.assertEqual(self.fetch(version), data)
+
+    def test_insert_only_stores_changed_chunks(self):
+        data = _Data(1024 * 1024)
+        self.upload(data, model.STORAGE_CHUNKED)
+        stored = self.publisher.store_calls
+        edited = data[:500000] + b'!' + data[500000:]
+        version = self.upload(edited, model.STORAGE_CHUNKED)
+        # The chunk holding the edit, perhaps its neighbour, and the
+        # manifest.
+        self.assertLessEqual(self.publisher.store_calls - stored, 3)
+        self.assertEqual(self.fetch(version), edited)
+
+    @unittest.skipIf(sealing.AESGCM is None, 'needs cryptography')
+    @mock.patch.object(sealing, 'SEAL_MODE', sealing.SEAL_ENCRYPT)
+    @mock.patch.object(sealing, '_key_provider', lambda _: bytes(32))
+    def test_encrypted_insert_only_stores_changed_chunks(self):
+        self.test_insert_only_stores_changed_chunks()
+
+    def test_duplicate_is_not_sealed_again(self):
+        data = _Data(100 * 1024)
+        for storage in (model.STORAGE_BLOB, model.STORAGE_CHUNKED):
+            first = self.upload(data, storage)
+            stored = self.publisher.store_calls
+            with mock.patch.object(sealing, 'SealFile') as seal_file, \
+                    mock.patch.object(sealing, 'SealBytes') as seal_bytes:
+                second = self.upload(data, storage)
+            seal_file.assert_not_called()
+            seal_bytes.assert_not_called()
+            self.assertEqual(self.publisher.store_calls, stored)
+            self.assertEqual(second.blob_id.bid, first.blob_id.bid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import unittest
+
+from tests import WorkdirTestCase
+
+import sharded_db
+
+
+def _Db() -> dict:
+    # IDs that sanitize to the same shard name prefix, and one that is not
+    # ASCII.
+    client_ids = ['a/b', 'a_b', 'a b', 'klienté', 'z']
+    return {
+        'clients': [{
+            'client_id': client_id,
+            'name': client_id.upper(),
+            'contracts': [{
+                'contract_id': 'contract1',
+                'versions': [{
+                    'blob_id': f'{client_id}-v1',
+                    'initial_blob_data': f'{client_id}-v1',
+                    'parents': [],
+                    'alias': 'doc'
+                }]
+            }]
+        } for client_id in client_ids],
+        'settings': {
+            'theme': 'dark'
+        }
+    }
+
+
+class SplitMergeTest(WorkdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open('db.json', 'w') as f:
+            json.dump(_Db(), f)
+
+    def merged(self) -> dict:
+        sharded_db.Merge('shards', 'merged.json')
+        with open('merged.json') as f:
+            return json.load(f)
+
+    def test_round_trip(self):
+        sharded_db.Split('db.json', 'shards')
+        self.assertEqual(len(os.listdir('shards/clients')), 5)
+        self.assertEqual(self.merged(), _Db())
+
+    def test_round_trip_after_writes(self):
+        sharded_db.Split('db.json', 'shards')
+        backend = sharded_db.ShardedJsonBackend('shards')
+        backend.add_client({'client_id': 'new', 'name': 'N', 'contracts': []})
+        backend.add_version('a_b', 'contract1', {
+            'blob_id': 'a_b-v2',
+            'initial_blob_data': 'a_b-v1',
+            'parents': ['a_b-v1'],
+            'alias': 'doc'
+        })
+        added = backend.get_client('a_b')['contracts'][0]['versions'][-1]
+        self.assertEqual(added['blob_id'], 'a_b-v2')
+        expected = _Db()
+        expected['clients'][1]['contracts'][0]['versions'].append(added)
+        expected['clients'].append(backend.get_client('new'))
+        self.assertEqual(self.merged(), expected)
+        # Splitting the merged DB again gives the same DB.
+        sharded_db.Split('merged.json', 'shards2')
+        self.assertEqual(
+            sharded_db.ShardedJsonBackend('shards2').load(), expected)
+
+    def test_split_refuses_an_existing_db(self):
+        sharded_db.Split('db.json', 'shards')
+        with self.assertRaises(ValueError):
+            sharded_db.Split('db.json', 'shards')
+
+    def test_merge_refuses_a_missing_db(self):
+        with self.assertRaises(ValueError):
+            sharded_db.Merge('shards', 'merged.json')
+        self.assertFalse(os.path.exists('merged.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import copy
+import unittest
+
+import signature_batch
+
+
+def _Records(count: int) -> list[dict]:
+    return [{
+        'client_id': f'client{i}',
+        'contract_id': 'contract1',
+        'signature': f'sig{i}'
+    } for i in range(count)]
+
+
+class MerkleProofTest(unittest.TestCase):
+
+    def test_every_proof_verifies(self):
+        for count in (1, 2, 3, 5, 8):
+            batch, proofs = signature_batch.BuildBatch(_Records(count))
+            for proof in proofs:
+                self.assertTrue(signature_batch.VerifyProof(proof))
+                self.assertTrue(signature_batch.VerifyBatch(proof, batch))
+
+    def test_tampered_proof_is_rejected(self):
+        batch, proofs = signature_batch.BuildBatch(_Records(5))
+        proof = proofs[2]
+
+        def tampered(change) -> dict:
+            bad = copy.deepcopy(proof)
+            change(bad)
+            return bad
+
+        def flip_sibling(p):
+            sibling = bytearray.fromhex(p['path'][0][1])
+            sibling[0] ^= 1
+            p['path'][0][1] = sibling.hex()
+
+        def swap_side(p):
+            p['path'][0][0] = ('left'
+                               if p['path'][0][0] == 'right' else 'right')
+
+        for bad in (
+                tampered(lambda p: p['record'].update(signature='forged')),
+                tampered(flip_sibling),
+                tampered(swap_side),
+                tampered(lambda p: p['path'].pop()),
+                tampered(lambda p: p.update(root='00' * 32)),
+                tampered(lambda p: p['path'][0].__setitem__(0, 'up')),
+                tampered(lambda p: p['path'][0].__setitem__(1, 'zz')),
+                tampered(lambda p: p.pop('record')),
+        ):
+            self.assertFalse(signature_batch.VerifyProof(bad))
+            self.assertFalse(signature_batch.VerifyBatch(bad, batch))
+
+    def test_proof_for_another_leaf_is_rejected_by_batch(self):
+        batch, proofs = signature_batch.BuildBatch(_Records(4))
+        moved = dict(proofs[1], index=0)
+        self.assertTrue(signature_batch.VerifyProof(moved))
+        self.assertFalse(signature_batch.VerifyBatch(moved, batch))
+
+    def test_proof_against_another_batch_is_rejected(self):
+        _, proofs = signature_batch.BuildBatch(_Records(4))
+        other, _ = signature_batch.BuildBatch(_Records(5))
+        self.assertFalse(signature_batch.VerifyBatch(proofs[0], other))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import unittest
+
+from tests import WorkdirTestCase
+
+import local_db
+import sqlite_db
+
+
+def _Db() -> dict:
+    return {
+        'clients': [{
+            'client_id':
+            'k1',
+            'name':
+            'Client 1',
+            'contracts': [{
+                'contract_id':
+                'c1',
+                'name':
+                'Contract 1',
+                'versions': [{
+                    'blob_id': 'v1',
+                    'initial_blob_data': 'v1',
+                    'parents': [],
+                    'alias': 'doc'
+                }, {
+                    'blob_id': 'v2',
+                    'initial_blob_data': 'v1',
+                    'parents': ['v1'],
+                    'alias': 'doc',
+                    'signed_by_client': True
+                }, {
+                    'blob_id': 'v3',
+                    'initial_blob_data': 'v1',
+                    'previous_versions': ['v1', 'v2'],
+                    'alias': 'doc'
+                }]
+            }]
+        }]
+    }
+
+
+def _Version(bid: str) -> dict:
+    return {
+        'blob_id': bid,
+        'initial_blob_data': 'v1',
+        'parents': ['v1'],
+        'alias': 'doc'
+    }
+
+
+class SqliteBackendTest(WorkdirTestCase):
+
+    def open(self) -> sqlite_db.SqliteBackend:
+        backend = sqlite_db.SqliteBackend('db.sqlite')
+        self.addCleanup(backend.close)
+        return backend
+
+    def migrate(self) -> sqlite_db.SqliteBackend:
+        with open('db.json', 'w') as f:
+            json.dump(_Db(), f)
+        sqlite_db.MigrateFromJson('db.json', 'db.sqlite')
+        return self.open()
+
+    def test_migration_round_trip(self):
+        self.assertEqual(self.migrate().load(), _Db())
+
+    def test_migration_refuses_a_non_empty_db(self):
+        self.migrate()
+        with self.assertRaises(ValueError):
+            sqlite_db.MigrateFromJson('db.json', 'db.sqlite')
+
+    def test_add_version_numbers_it(self):
+        backend = self.migrate()
+        version = _Version('v4')
+        backend.add_version('k1', 'c1', version)
+        self.assertEqual(version['sequence'], 4)
+        self.assertEqual(
+            backend.get_client('k1')['contracts'][0]['versions'][-1],
+            dict(_Version('v4'), sequence=4))
+        with self.assertRaises(local_db.VersionExists):
+            backend.add_version('k1', 'c1', _Version('v4'))
+
+    def test_update_version_keeps_extra_fields(self):
+        backend = self.migrate()
+        backend.update_version('k1', 'c1', 'v2', {
+            'alias': 'renamed',
+            'sig_blob_id': 'sig'
+        })
+        version = backend.get_client('k1')['contracts'][0]['versions'][1]
+        self.assertEqual(version['alias'], 'renamed')
+        self.assertEqual(version['sig_blob_id'], 'sig')
+        self.assertTrue(version['signed_by_client'])
+        with self.assertRaises(ValueError):
+            backend.update_version('k1', 'c1', 'v2', {'parents': []})
+
+    def test_unknown_client_is_not_found(self):
+        backend = self.migrate()
+        with self.assertRaises(local_db.NotFound):
+            backend.get_client('unknown')
+        with self.assertRaises(local_db.NotFound):
+            backend.add_version('unknown', 'c1', _Version('v4'))
+
+    def test_failed_mutation_does_not_affect_its_batch(self):
+        backend = self.migrate()
+        errors = backend.apply_batch([{
+            'op': 'add_version',
+            'client_id': 'k1',
+            'contract_id': 'c1',
+            'version': _Version('v4')
+        }, {
+            'op': 'add_version',
+            'client_id': 'k1',
+            'contract_id': 'unknown',
+            'version': _Version('v5')
+        }, {
+            'op': 'add_client',
+            'client': {
+                'client_id': 'k2',
+                'name': 'Client 2',
+                'contracts': []
+            }
+        }])
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], local_db.NotFound)
+        self.assertIsNone(errors[2])
+        reopened = self.open()
+        self.assertEqual([c['client_id'] for c in reopened.list_clients()],
+                         ['k1', 'k2'])
+        self.assertEqual([
+            v['blob_id']
+            for v in reopened.get_client('k1')['contracts'][0]['versions']
+        ], ['v1', 'v2', 'v3', 'v4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
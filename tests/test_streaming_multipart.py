@@ -0,0 +1,118 @@
+import io
+import os
+import unittest
+from unittest import mock
+
+from tests import WorkdirTestCase
+
+import streaming_multipart
+
+_BOUNDARY = 'xYzBoundary'
+_CONTENT_TYPE = f'multipart/form-data; boundary={_BOUNDARY}'
+
+
+# Returns a multipart body of (name, filename or None, value) parts.
+def _Body(parts: list[tuple], preamble: bytes = b'',
+          epilogue: bytes = b'') -> bytes:
+    body = bytearray(preamble)
+    for name, filename, value in parts:
+        body += f'--{_BOUNDARY}\r\n'.encode('ascii')
+        disposition = f'Content-Disposition: form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += disposition.encode('utf-8') + b'\r\n'
+        if filename is not None:
+            body += b'Content-Type: application/octet-stream\r\n'
+        body += b'\r\n' + value + b'\r\n'
+    body += f'--{_BOUNDARY}--\r\n'.encode('ascii') + epilogue
+    return bytes(body)
+
+
+class ParseMultipartTest(WorkdirTestCase):
+
+    def parse(self, body: bytes, max_bytes: int = 1 << 20, **kwargs):
+        return streaming_multipart.ParseMultipart(io.BytesIO(body),
+                                                  _CONTENT_TYPE, len(body),
+                                                  'uploads', max_bytes,
+                                                  **kwargs)
+
+    def assertNoUploads(self):
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_fields_and_file(self):
+        # The file holds a prefix of the delimiter, which must not end it.
+        data = b'a\r\n--xYz' + bytes(range(256)) * 40 + b'\r\n-'
+        body = _Body([('client_id', None, 'klienté'.encode('utf-8')),
+                      ('file', 'dir/contract.pdf', data),
+                      ('empty', None, b'')],
+                     preamble=b'ignored\r\n',
+                     epilogue=b'also ignored')
+        # Block sizes that split the delimiters and headers at every
+        # offset.
+        for block_size in (1, 2, 7, 13, len(_BOUNDARY) + 3, 4096):
+            with mock.patch.object(streaming_multipart, '_BLOCK_SIZE',
+                                   block_size):
+                with self.parse(body) as form:
+                    self.assertEqual(form.fields, {
+                        'client_id': 'klienté',
+                        'empty': ''
+                    })
+                    part = form.files['file']
+                    self.assertEqual(part.filename, 'contract.pdf')
+                    self.assertEqual(part.size, len(data))
+                    with open(part.path, 'rb') as f:
+                        self.assertEqual(f.read(), data)
+            self.assertNoUploads()
+
+    def test_body_too_large(self):
+        body = _Body([('file', 'a.txt', b'x' * 1000)])
+        with self.assertRaises(streaming_multipart.UploadTooLarge):
+            self.parse(body, max_bytes=len(body) - 1)
+        with self.parse(body, max_bytes=len(body)) as form:
+            self.assertEqual(form.files['file'].size, 1000)
+
+    def test_field_too_large(self):
+        body = _Body([('file', 'a.txt', b'x' * 1000),
+                      ('note', None, b'n' * 101)])
+        with self.assertRaises(streaming_multipart.UploadTooLarge):
+            self.parse(body, max_field_bytes=100)
+        self.assertNoUploads()
+
+    def test_field_not_utf8(self):
+        body = _Body([('file', 'a.txt', b'data'),
+                      ('client_id', None, b'\xff\xfe')])
+        with self.assertRaises(streaming_multipart.MultipartError):
+            self.parse(body)
+        self.assertNoUploads()
+
+    def test_duplicate_file_field(self):
+        body = _Body([('file', 'a.txt', b'first'),
+                      ('file', 'b.txt', b'second')])
+        with self.assertRaises(streaming_multipart.MultipartError):
+            self.parse(body)
+        self.assertNoUploads()
+
+    def test_truncated_body(self):
+        body = _Body([('file', 'a.txt', b'x' * 1000)])
+        for end in (5, 100, len(body) - 10):
+            with self.assertRaises(streaming_multipart.MultipartError):
+                streaming_multipart.ParseMultipart(io.BytesIO(body[:end]),
+                                                   _CONTENT_TYPE, len(body),
+                                                   'uploads', 1 << 20)
+            self.assertNoUploads()
+
+    def test_malformed(self):
+        for body in (b'no delimiter at all',
+                     f'--{_BOUNDARY}\r\nno blank line'.encode('ascii'),
+                     f'--{_BOUNDARY}\r\n\r\nno disposition\r\n'
+                     f'--{_BOUNDARY}--'.encode('ascii')):
+            with self.assertRaises(streaming_multipart.MultipartError):
+                self.parse(body)
+        with self.assertRaises(streaming_multipart.MultipartError):
+            streaming_multipart.ParseMultipart(io.BytesIO(b''),
+                                               'application/json', 0,
+                                               'uploads', 1 << 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
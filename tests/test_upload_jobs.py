@@ -0,0 +1,127 @@
+import os
+import time
+import unittest
+from types import SimpleNamespace
+
+from tests import WalrusTestCase, WorkdirTestCase
+
+import local_db
+import model
+import upload_jobs
+import versioned_walrus
+
+
+def _Version(bid: str) -> SimpleNamespace:
+    return SimpleNamespace(blob_id=model.BlobID(bid=bid, timestamp=0),
+                           alias='doc',
+                           sequence=1,
+                           storage=model.STORAGE_BLOB)
+
+
+class JobQueueTest(WorkdirTestCase):
+
+    def open(self, upload, max_attempts: int = 3) -> upload_jobs.JobQueue:
+        queue = upload_jobs.JobQueue('jobs.sqlite',
+                                     'spool',
+                                     upload,
+                                     workers=1,
+                                     max_attempts=max_attempts,
+                                     retry_delay=0)
+        self.addCleanup(queue.stop)
+        return queue
+
+    def submit(self, queue: upload_jobs.JobQueue) -> str:
+        return queue.submit(self.write_file('upload', b'data'), 'a.txt',
+                            'client1', 'version1')
+
+    def wait(self, queue: upload_jobs.JobQueue, job_id: str) -> dict:
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            job = queue.get(job_id)
+            if job['state'] in (upload_jobs.SUCCEEDED, upload_jobs.FAILED):
+                return job
+            time.sleep(0.01)
+        self.fail(f'job {job_id} did not finish')
+
+    def test_succeeded_job_deletes_its_file(self):
+        queue = self.open(lambda *_: _Version('v2'))
+        queue.start()
+        job = self.wait(queue, self.submit(queue))
+        self.assertEqual(job['state'], upload_jobs.SUCCEEDED)
+        self.assertEqual(job['version']['blob_id'], 'v2')
+        self.assertEqual(os.listdir('spool'), [])
+
+    def test_not_found_fails_at_once(self):
+        calls = []
+
+        def upload(*args):
+            calls.append(args)
+            raise local_db.NotFound('Base version not found.')
+
+        queue = self.open(upload)
+        queue.start()
+        job = self.wait(queue, self.submit(queue))
+        self.assertEqual(job['state'], upload_jobs.FAILED)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(os.listdir('spool'), [])
+
+    def test_malformed_reply_is_retried(self):
+        calls = []
+
+        def upload(*args):
+            calls.append(args)
+            if len(calls) < 3:
+                raise ValueError('No BlobID found in Walrus response')
+            return _Version('v2')
+
+        queue = self.open(upload)
+        queue.start()
+        job = self.wait(queue, self.submit(queue))
+        self.assertEqual(job['state'], upload_jobs.SUCCEEDED)
+        self.assertEqual(len(calls), 3)
+
+    def test_last_attempt_deletes_its_file(self):
+
+        def upload(*_):
+            raise ValueError('No BlobID found in Walrus response')
+
+        queue = self.open(upload, max_attempts=2)
+        queue.start()
+        job = self.wait(queue, self.submit(queue))
+        self.assertEqual(job['state'], upload_jobs.FAILED)
+        self.assertEqual(job['attempts'], 2)
+        self.assertEqual(os.listdir('spool'), [])
+
+    def test_start_sweeps_orphans(self):
+        uploaded = []
+
+        def upload(path, *_):
+            with open(path, 'rb') as f:
+                uploaded.append(f.read())
+            return _Version('v2')
+
+        queue = self.open(upload)
+        queued = self.submit(queue)
+        # Left by a crash between spooling a file and queueing its job.
+        self.write_file('spool/orphan', b'orphan')
+        queue.start()
+        self.assertEqual(self.wait(queue, queued)['state'],
+                         upload_jobs.SUCCEEDED)
+        self.assertEqual(uploaded, [b'data'])
+        self.assertEqual(os.listdir('spool'), [])
+
+
+class UploadJobTest(WalrusTestCase):
+
+    def test_unknown_base_version_is_not_found(self):
+        path = self.write_file('upload', b'data')
+        with self.assertRaises(local_db.NotFound):
+            versioned_walrus.UploadFileOnVersion(path, self.CLIENT_ID,
+                                                 'unknown')
+        with self.assertRaises(local_db.NotFound):
+            versioned_walrus.UploadFileOnVersion(path, 'unknown',
+                                                 self.BASE_BLOB_ID)
+
+
+if __name__ == '__main__':
+    unittest.main()
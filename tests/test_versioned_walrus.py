@@ -0,0 +1,266 @@
+import asyncio
+import gc
+import os
+import threading
+import unittest
+import warnings
+from concurrent import futures
+from unittest import mock
+
+from tests import WalrusTestCase
+
+import client_repository
+import journaled_db
+import local_db
+import sharded_db
+import sqlite_db
+import versioned_walrus
+import walrus_transport
+
+
+class UploadTest(WalrusTestCase):
+
+    # Fails the upload if the client repository is used on the thread
+    # running the event loop.
+    def check_lookups_off_loop(self):
+        repository = client_repository.GetRepository()
+        loop_threads = set()
+        lookup = repository.lookup
+
+        def checked_lookup(*args):
+            if threading.get_ident() in loop_threads:
+                raise AssertionError('lookup on the event loop')
+            return lookup(*args)
+
+        run_sync = versioned_walrus._RunSync
+
+        def tracked_run_sync(coroutine):
+
+            async def run():
+                loop_threads.add(threading.get_ident())
+                return await coroutine
+
+            return run_sync(run())
+
+        for target, name, new in ((repository, 'lookup', checked_lookup),
+                                  (versioned_walrus, '_RunSync',
+                                   tracked_run_sync)):
+            patcher = mock.patch.object(target, name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_upload_looks_up_off_loop(self):
+        self.check_lookups_off_loop()
+        path = self.write_file('upload', b'data')
+        version = versioned_walrus.UploadFileOnVersion(
+            path, self.CLIENT_ID, self.BASE_BLOB_ID)
+        again = versioned_walrus.UploadFileOnVersion(path, self.CLIENT_ID,
+                                                     self.BASE_BLOB_ID)
+        self.assertEqual(again.blob_id.bid, version.blob_id.bid)
+
+    def test_batch_upload_looks_up_off_loop(self):
+        self.check_lookups_off_loop()
+        paths = [
+            self.write_file(f'upload{i}', b'data%d' % i) for i in range(3)
+        ]
+        results = versioned_walrus.UploadFilesOnVersions([
+            (path, self.CLIENT_ID, self.BASE_BLOB_ID) for path in paths
+        ])
+        self.assertEqual([r.error for r in results], [None] * 3)
+
+
+class BatchUploadTest(WalrusTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writes = []
+        add_versions = local_db.AddVersions
+
+        def counted(versions):
+            self.writes.append(len(versions))
+            return add_versions(versions)
+
+        patcher = mock.patch.object(local_db, 'AddVersions', counted)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored_versions(self) -> list[str]:
+        client = local_db.GetClient(self.CLIENT_ID)
+        return [v['blob_id'] for v in client['contracts'][0]['versions']]
+
+    def test_new_versions_are_written_at_once(self):
+        items = [(self.write_file(f'upload{i}', b'data%d' % i),
+                  self.CLIENT_ID, self.BASE_BLOB_ID) for i in range(3)]
+        results = versioned_walrus.UploadFilesOnVersions(items)
+        self.assertEqual(self.writes, [3])
+        self.assertEqual(self.publisher.store_calls, 3)
+        self.assertEqual([r.filepath for r in results],
+                         [path for path, _, _ in items])
+        self.assertEqual([r.version.sequence for r in results], [2, 3, 4])
+        self.assertEqual(self.stored_versions(), [self.BASE_BLOB_ID] +
+                         [r.version.blob_id.bid for r in results])
+
+    def test_failing_item_does_not_abort_the_others(self):
+        results = versioned_walrus.UploadFilesOnVersions([
+            (self.write_file('upload0', b'data0'), self.CLIENT_ID,
+             self.BASE_BLOB_ID),
+            (self.write_file('upload1', b'data1'), self.CLIENT_ID,
+             'unknown'),
+            (os.path.join(self.workdir, 'missing'), self.CLIENT_ID,
+             self.BASE_BLOB_ID),
+            (self.write_file('upload3', b'data3'), self.CLIENT_ID,
+             self.BASE_BLOB_ID),
+        ])
+        self.assertEqual([r.ok for r in results], [True, False, False, True])
+        self.assertIsNone(results[1].version)
+        self.assertIsNone(results[2].version)
+        self.assertEqual(self.writes, [2])
+        self.assertEqual(len(self.stored_versions()), 3)
+
+    def test_existing_version_is_not_written_again(self):
+        path = self.write_file('upload', b'data')
+        version = versioned_walrus.UploadFileOnVersion(
+            path, self.CLIENT_ID, self.BASE_BLOB_ID)
+        results = versioned_walrus.UploadFilesOnVersions([
+            (path, self.CLIENT_ID, self.BASE_BLOB_ID)
+        ])
+        self.assertTrue(results[0].ok)
+        self.assertEqual(results[0].version.blob_id.bid,
+                         version.blob_id.bid)
+        # The batch has nothing to write.
+        self.assertEqual(self.writes, [0])
+        self.assertEqual(self.publisher.store_calls, 1)
+
+    def test_failed_write_fails_the_new_versions(self):
+        patcher = mock.patch.object(local_db, 'AddVersions',
+                                    side_effect=OSError('disk full'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        results = versioned_walrus.UploadFilesOnVersions([
+            (self.write_file(f'upload{i}', b'data%d' % i), self.CLIENT_ID,
+             self.BASE_BLOB_ID) for i in range(2)
+        ])
+        self.assertEqual([type(r.error) for r in results], [OSError] * 2)
+        self.assertEqual([r.version for r in results], [None, None])
+        self.assertEqual(self.stored_versions(), [self.BASE_BLOB_ID])
+
+
+class ConcurrentUploadTest(WalrusTestCase):
+
+    # Makes the first `count` existence checks wait for each other, so
+    # every upload checks before any of them writes.
+    def race(self, count: int) -> None:
+        barrier = threading.Barrier(count, timeout=10)
+        calls = []
+        new_version = versioned_walrus._NewVersion
+
+        def racing(*args, **kwargs):
+            calls.append(None)
+            result = new_version(*args, **kwargs)
+            if len(calls) <= count:
+                barrier.wait()
+            return result
+
+        patcher = mock.patch.object(versioned_walrus, '_NewVersion', racing)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored_versions(self) -> list[str]:
+        client = local_db.GetClient(self.CLIENT_ID)
+        return [v['blob_id'] for v in client['contracts'][0]['versions']]
+
+    def check_single_uploads(self):
+        self.race(4)
+        paths = [self.write_file(f'upload{i}', b'same') for i in range(4)]
+        with futures.ThreadPoolExecutor(4) as pool:
+            versions = list(
+                pool.map(
+                    lambda path: versioned_walrus.UploadFileOnVersion(
+                        path, self.CLIENT_ID, self.BASE_BLOB_ID), paths))
+        blob_id = versions[0].blob_id.bid
+        self.assertEqual(self.stored_versions(),
+                         [self.BASE_BLOB_ID, blob_id])
+        self.assertEqual({(v.blob_id.bid, v.sequence) for v in versions},
+                         {(blob_id, 2)})
+
+    def check_batch_uploads(self):
+        self.race(2)
+        items = [[(self.write_file(f'upload{i}', b'same'), self.CLIENT_ID,
+                   self.BASE_BLOB_ID)] for i in range(2)]
+        with futures.ThreadPoolExecutor(2) as pool:
+            results = list(
+                pool.map(versioned_walrus.UploadFilesOnVersions, items))
+        self.assertEqual([r[0].error for r in results], [None, None])
+        blob_id = results[0][0].version.blob_id.bid
+        self.assertEqual(self.stored_versions(),
+                         [self.BASE_BLOB_ID, blob_id])
+        self.assertEqual(
+            {(r[0].version.blob_id.bid, r[0].version.sequence)
+             for r in results}, {(blob_id, 2)})
+
+    def use_backend(self, backend) -> None:
+        local_db.SetBackend(backend)
+        client_repository.GetRepository().invalidate()
+
+    def test_json(self):
+        self.check_single_uploads()
+
+    def test_json_batch(self):
+        self.check_batch_uploads()
+
+    def test_sqlite(self):
+        sqlite_db.MigrateFromJson(local_db.DB_PATH, 'db.sqlite')
+        self.use_backend(sqlite_db.SqliteBackend('db.sqlite'))
+        self.check_single_uploads()
+
+    def test_sqlite_batch(self):
+        sqlite_db.MigrateFromJson(local_db.DB_PATH, 'db.sqlite')
+        self.use_backend(sqlite_db.SqliteBackend('db.sqlite'))
+        self.check_batch_uploads()
+
+    def test_journal(self):
+        self.use_backend(journaled_db.JournaledJsonBackend(local_db.DB_PATH))
+        self.check_single_uploads()
+
+    def test_sharded(self):
+        sharded_db.Split(local_db.DB_PATH, 'shards')
+        self.use_backend(sharded_db.ShardedJsonBackend('shards'))
+        self.check_single_uploads()
+
+
+class EventLoopTest(WalrusTestCase):
+
+    def test_loop_state_is_dropped_at_shutdown(self):
+        transport = versioned_walrus.GetTransport()
+        # The background loop of the blocking calls never shuts down.
+        semaphores = dict(versioned_walrus._semaphores)
+        for i in range(5):
+            path = self.write_file(f'upload{i}', b'data%d' % i)
+            asyncio.run(
+                versioned_walrus.async_upload_file_on_version(
+                    path, self.CLIENT_ID, self.BASE_BLOB_ID))
+        self.assertEqual(self.publisher.store_calls, 5)
+        self.assertEqual(len(transport._async_pools), 0)
+        self.assertEqual(versioned_walrus._semaphores, semaphores)
+
+    def test_close_with_pools_on_other_loops(self):
+        transport = versioned_walrus.GetTransport()
+        # Leaves idle connections on the background loop and on a loop
+        # closed without shutting it down.
+        versioned_walrus.StoreBytes(b'sync')
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(transport.async_store_bytes(b'loop', 1))
+        loop.close()
+        self.assertEqual(len(transport._async_pools), 2)
+        # The closed loop's shutdown task is destroyed while pending, and its
+        # connections are never closed.
+        with self.assertLogs('asyncio', 'ERROR'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', ResourceWarning)
+            versioned_walrus.SetTransport(
+                walrus_transport.HttpTransport(self.publisher.url))
+            gc.collect()
+        versioned_walrus._RunSync(asyncio.sleep(0))
+        self.assertEqual(len(transport._async_pools), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from tests import ROOT, WorkdirTestCase
+
+import fake_walrus
+import walrus_transport
+
+
+class SubprocessTransportTest(WorkdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        env = {'FAKE_WALRUS_DIR': os.path.join(self.workdir, 'walrus')}
+        for patcher in (mock.patch.dict(os.environ, env),
+                        mock.patch.object(tempfile, 'tempdir',
+                                          self.workdir)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.transport = walrus_transport.SubprocessTransport(
+            os.path.join(ROOT, 'fake_walrus.py'),
+            os.path.join(ROOT, 'client_config.yaml'))
+
+    def temp_files(self) -> list:
+        return [
+            name for name in os.listdir(self.workdir)
+            if name.startswith('walrus-store-')
+        ]
+
+    def test_async_store_bytes(self):
+        reply = asyncio.run(self.transport.async_store_bytes(b'data', 3))
+        self.assertEqual(reply['newlyCreated']['blobObject']['blobId'],
+                         fake_walrus.BlobIdForContent(b'data'))
+        self.assertEqual(self.temp_files(), [])
+
+    def test_cancelled_store_kills_walrus(self):
+        os.environ['FAKE_WALRUS_STORE_LATENCY'] = '30'
+
+        async def cancel_store():
+            task = asyncio.create_task(
+                self.transport.async_store_bytes(b'data', 3))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        start = time.monotonic()
+        asyncio.run(cancel_store())
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(self.temp_files(), [])
+
+    def test_extend_blobs(self):
+        self.assertEqual(
+            self.transport.extend_blobs([('0x1', 2), ('0x2', 3)]), {})
+
+    def test_extend_blobs_reports_failures(self):
+        self.transport.walrus_path = os.path.join(self.workdir, 'missing')
+        errors = self.transport.extend_blobs([('0x1', 2)])
+        self.assertEqual(list(errors), ['0x1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
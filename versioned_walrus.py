@@ -2,163 +2,854 @@
 # of the undelrying blob IDs.
 #
 # Every store, queyr and fetch operations go through this lib.
+#
+# The implementation is asyncio based: async_upload_file_on_version,
+# async_fetch_file_by_version and async_query_versions can be awaited
+# directly from async code.  The blocking functions (UploadFileOnVersion,
+# FetchFileByVersion, ...) are thin wrappers that run the same coroutines on
+# a shared background event loop.
+import asyncio
+import atexit
+import logging
 import os
-import subprocess
-import json
-
+import tempfile
+import threading
+import time
+
+import blob_cache
+import blob_lifetime
+import chunking
+import client_repository
+import digest_index
 import model
 import local_db
-import utils
+import metrics
+import packing
+import sealing
+import walrus_transport
+
+logger = logging.getLogger(__name__)
 
 PATH_TO_WALRUS_CONFIG = os.path.join(os.getcwd(), '../../client_config.yaml')
 PATH_TO_WALRUS = 'walrus'
+# Layout used for new versions, one of the model.STORAGE_* values.  In
+# 'chunked' mode files are split into content-defined chunks, so a new
+# version only uploads the chunks that changed.  In 'packed' mode files of
+# up to PACK_THRESHOLD bytes uploaded within PACK_WINDOW seconds of each other
+# are stored together in one pack blob of up to PACK_MAX_BYTES; larger files
+# are stored as plain blobs.
+STORAGE_MODE = os.environ.get('WALRUS_STORAGE_MODE', model.STORAGE_BLOB)
+BLOB_CACHE_DIR = os.environ.get('WALRUS_BLOB_CACHE_DIR',
+                                os.path.join(os.getcwd(), 'blob_cache'))
+BLOB_CACHE_MAX_BYTES = int(
+    os.environ.get('WALRUS_BLOB_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# Maximum number of Walrus calls in flight per event loop.
+CONCURRENCY_LIMIT = int(os.environ.get('WALRUS_CONCURRENCY_LIMIT', 8))
+PACK_THRESHOLD = int(os.environ.get('WALRUS_PACK_THRESHOLD', 256 * 1024))
+PACK_MAX_BYTES = int(os.environ.get('WALRUS_PACK_MAX_BYTES', 4 * 1024 * 1024))
+PACK_WINDOW = float(os.environ.get('WALRUS_PACK_WINDOW', 0.1))
+
+_blob_cache = None
+_digest_index = None
+_lifetime_index = None
+_lifetime_manager = None
+_lifetime_lock = threading.Lock()
+# Event loop -> semaphore enforcing CONCURRENCY_LIMIT.  Like _packers,
+# entries are dropped when their loop shuts down.
+_semaphores = {}
+# Event loop -> packing.Packer buffering that loop's small files.
+_packers = {}
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+
+# Returns the transport used for all Walrus calls.  It is created once and
+# reused, so HTTP connections to the publisher stay open between uploads.
+def GetTransport() -> walrus_transport.WalrusTransport:
+    return walrus_transport.GetTransport(PATH_TO_WALRUS, PATH_TO_WALRUS_CONFIG)
+
+
+# Overrides the transport, e.g. to point at a fake publisher.
+def SetTransport(transport: walrus_transport.WalrusTransport) -> None:
+    walrus_transport.SetTransport(transport)
+
+
+# Returns the process-wide cache of fetched blobs.
+def GetBlobCache() -> blob_cache.BlobCache:
+    global _blob_cache
+    if _blob_cache is None:
+        _blob_cache = blob_cache.BlobCache(BLOB_CACHE_DIR,
+                                           BLOB_CACHE_MAX_BYTES)
+    return _blob_cache
+
+
+# Returns the process-wide index of stored content digests.  It lives next to
+# the local DB.
+def GetDigestIndex() -> digest_index.DigestIndex:
+    global _digest_index
+    if _digest_index is None:
+        _digest_index = digest_index.DigestIndex(local_db.DIGEST_INDEX_PATH)
+    return _digest_index
+
+
+# Returns the process-wide index of blob expiry epochs.  It lives next to the
+# local DB.
+def GetLifetimeIndex() -> blob_lifetime.LifetimeIndex:
+    global _lifetime_index
+    with _lifetime_lock:
+        if _lifetime_index is None:
+            _lifetime_index = blob_lifetime.LifetimeIndex(
+                local_db.LIFETIMES_PATH)
+        return _lifetime_index
+
+
+# Returns the manager extending the blobs still in use.  Call start() on it
+# to run it in the background.
+def GetLifetimeManager() -> blob_lifetime.LifetimeManager:
+    global _lifetime_manager
+    index = GetLifetimeIndex()
+    with _lifetime_lock:
+        if _lifetime_manager is None:
+            _lifetime_manager = blob_lifetime.LifetimeManager(
+                index, GetTransport, local_db.ListClients)
+        return _lifetime_manager
+
+
+# local_db commit listener.  Tells the lifetime manager about the blobs of
+# committed versions, which may have come due while no version used them.
+def _RecheckLifetimes(mutation: dict, client_ids: set) -> None:
+    manager = _lifetime_manager
+    if manager is None or mutation is None:
+        return
+    op = mutation['op']
+    if op == 'add_version':
+        manager.recheck([mutation['version']])
+    elif op == 'add_versions':
+        manager.recheck([version for _, _, version in mutation['versions']])
+    elif op == 'update_version':
+        # Signing adds the signature batch blobs.
+        manager.recheck(
+            [dict(mutation['fields'], blob_id=mutation['blob_id'])])
+
+
+local_db.AddCommitListener(_RecheckLifetimes)
+
+
+# Changes the maximum number of concurrent Walrus calls.  Applies to event
+# loops that did not make a call yet.
+def SetConcurrencyLimit(limit: int) -> None:
+    global CONCURRENCY_LIMIT
+    CONCURRENCY_LIMIT = limit
+    _semaphores.clear()
+
+
+def _Semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
+        _semaphores[loop] = semaphore
+        walrus_transport.CallOnLoopShutdown(
+            lambda loop: _semaphores.pop(loop, None))
+    return semaphore
+
+
+def _Packer() -> packing.Packer:
+    loop = asyncio.get_running_loop()
+    packer = _packers.get(loop)
+    if packer is None:
+        packer = packing.Packer(_StoreBytes, PACK_MAX_BYTES, PACK_WINDOW)
+        _packers[loop] = packer
+        walrus_transport.CallOnLoopShutdown(
+            lambda loop: _packers.pop(loop, None))
+    return packer
+
+
+# Returns the event loop the blocking wrappers run on, starting it on first
+# use.  Sharing one loop keeps the transport's async connections alive
+# between calls.
+def _SyncLoop() -> asyncio.AbstractEventLoop:
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever,
+                             name='versioned_walrus',
+                             daemon=True).start()
+            atexit.register(_StopSyncLoop, _sync_loop)
+        return _sync_loop
+
+
+# Cancels the tasks left on the background loop at exit, as asyncio.run()
+# does for its loop, so the transport closes its connections.
+def _StopSyncLoop(loop: asyncio.AbstractEventLoop) -> None:
+
+    async def cancel_tasks():
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result(5)
+    except Exception:
+        logger.exception('stopping the background event loop failed')
+    loop.call_soon_threadsafe(loop.stop)
+
+
+# Runs a coroutine on the background loop and waits for its result.  If the
+# caller is interrupted the coroutine is cancelled.
+def _RunSync(coro):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError(
+            'Blocking versioned_walrus call from async code; use the '
+            'async_* functions instead.')
+    future = asyncio.run_coroutine_threadsafe(coro, _SyncLoop())
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+# Finds the version `version_id` of a client.
+# Returns the (contract, version) pair.
+def _FindBaseVersion(client_id: str, version_id: str) -> tuple:
+    with metrics.Stage('lookup'):
+        return client_repository.GetRepository().find_version(
+            client_id, version_id)
+
+
+# Returns the blob ID of a Walrus store reply.
+def _BlobIdFromStoreResult(json_result_dict: dict) -> str:
+    newly_created = json_result_dict.get("newlyCreated", None)
+    if newly_created:
+        blob_id = newly_created.get("blobObject", {}).get("blobId")
+    else:
+        already_certified = json_result_dict.get("alreadyCertified", None)
+        blob_id = already_certified.get("blobId") if already_certified else None
+
+    if not blob_id:
+        raise ValueError("No BlobID found in Walrus response")
+    return blob_id
+
+
+# Returns the blob ID the digest index has for `key`, or None if there is
+# none or its blob, or a chunk or pack it lives in, has expired since.
+def _LiveBlobId(key: str, storage: str = model.STORAGE_BLOB) -> str:
+    blob_id = GetDigestIndex().lookup(key)
+    if not blob_id:
+        return None
+    stored_blob_id = blob_id
+    if storage == model.STORAGE_PACKED:
+        stored_blob_id = packing.ParsePackedBlobId(blob_id)[0]
+    if not GetLifetimeIndex().alive(stored_blob_id):
+        logger.info('blob %s has expired, storing its content again',
+                    stored_blob_id)
+        return None
+    logger.debug('content already stored as %s, skipping Walrus store',
+                 blob_id)
+    return blob_id
+
+
+# Returns the blob ID stored for `digest`, awaiting `store()` to store the
+# content if it was never stored before or its blob has expired.
+async def _StoreContent(digest: str, store) -> str:
+    blob_id = _LiveBlobId(digest)
+    if blob_id:
+        return blob_id
+
+    async with _Semaphore():
+        json_result_dict = await store()
+    logger.debug('Walrus store reply %s', json_result_dict)
+
+    blob_id = _BlobIdFromStoreResult(json_result_dict)
+    await asyncio.to_thread(_RecordLifetime, blob_id, json_result_dict)
+    await asyncio.to_thread(GetDigestIndex().record, digest, blob_id)
+    return blob_id
+
+
+# Records the lifetime of a stored blob for the lifetime manager.
+def _RecordLifetime(blob_id: str, json_result_dict: dict) -> None:
+    end_epoch, object_id, start_epoch = (
+        blob_lifetime.LifetimeFromStoreResult(json_result_dict))
+    index = GetLifetimeIndex()
+    if start_epoch is not None:
+        index.observe_epoch(start_epoch)
+    index.record([{
+        'blob_id': blob_id,
+        'end_epoch': end_epoch,
+        'object_id': object_id,
+        # Blobs certified by someone else's object cannot be extended.
+        'managed': object_id is not None
+    }])
+
+
+# Stores in-memory data unless identical content was stored before.
+async def _StoreBytes(data: bytes) -> str:
+    return await _StoreContent(
+        digest_index.BytesDigest(data),
+        lambda: GetTransport().async_store_bytes(
+            data, epochs=blob_lifetime.INITIAL_EPOCHS))
+
+
+# Returns the digest index key of content sealed for `tenant`.  Sealed
+# content is looked up by its plaintext digest, so a duplicate upload is
+# found before it is sealed again.
+def _SealedKey(layout: str, tenant: str, digest: str) -> str:
+    return f'sealed:{sealing.SEAL_MODE}:{tenant}:{layout}:{digest}'
+
+
+# Returns the key to seal the content of `tenant` with per
+# sealing.SEAL_MODE, or None to only compress.
+def _SealKey(tenant: str) -> bytes:
+    if sealing.SEAL_MODE == sealing.SEAL_ENCRYPT:
+        return sealing.TenantKey(tenant)
+    if sealing.SEAL_MODE == sealing.SEAL_COMPRESS:
+        return None
+    raise ValueError(f'Unknown seal mode {sealing.SEAL_MODE}')
+
+
+# Seals one chunk and stores it.  Returns (blob ID, sealed length).
+async def _StoreSealedChunk(chunk: bytes, tenant: str, key: bytes) -> tuple:
+    digest = digest_index.BytesDigest(chunk)
+    chunk_key = _SealedKey('chunk', tenant, digest)
+    # The sealed length is kept with the blob ID, for the manifest.
+    known = GetDigestIndex().lookup(chunk_key)
+    if known:
+        blob_id, length = known.rsplit(':', 1)
+        if GetLifetimeIndex().alive(blob_id):
+            return blob_id, int(length)
+    with metrics.Stage('seal'):
+        sealed = await asyncio.to_thread(sealing.SealBytes, chunk, digest,
+                                         key)
+    blob_id = await _StoreBytes(sealed)
+    await asyncio.to_thread(GetDigestIndex().record, chunk_key,
+                            f'{blob_id}:{len(sealed)}')
+    return blob_id, len(sealed)
+
+
+# Stores a file as content-defined chunks plus a manifest.  Chunks that are
+# already stored, e.g. the unchanged parts of the base version, are skipped.
+# With `seal`, a (tenant, key) pair, each chunk is sealed on its own after
+# the file is chunked, so unchanged chunks still seal to the same blobs.
+# Returns the blob ID of the manifest.
+async def _StoreFileChunked(filepath: str,
+                            digest: str,
+                            seal: tuple = None) -> str:
+    # The same content has a different blob ID in each layout.
+    if seal is None:
+        file_key = f'{model.STORAGE_CHUNKED}:{digest}'
+    else:
+        file_key = _SealedKey(model.STORAGE_CHUNKED, seal[0], digest)
+    blob_id = _LiveBlobId(file_key)
+    if blob_id:
+        return blob_id
+
+    chunks = []
+    with open(filepath, 'rb') as f:
+        # Chunking is CPU bound, so each chunk is cut in a thread.  Only one
+        # chunk is held in memory at a time.
+        chunk_iter = chunking.IterChunks(f)
+        while True:
+            chunk = await asyncio.to_thread(next, chunk_iter, None)
+            if chunk is None:
+                break
+            if seal is None:
+                chunks.append((await _StoreBytes(chunk), len(chunk)))
+            else:
+                chunks.append(await _StoreSealedChunk(chunk, *seal))
+    blob_id = await _StoreBytes(
+        chunking.BuildManifest(chunks, sealed=seal is not None))
+    # The chunks live as long as the manifest.
+    await asyncio.to_thread(GetLifetimeIndex().record, [{
+        'blob_id': blob_id,
+        'children': [chunk_blob_id for chunk_blob_id, _ in chunks]
+    }])
+    await asyncio.to_thread(GetDigestIndex().record, file_key, blob_id)
+    return blob_id
+
+
+# Stores a small file in the next pack.  Returns its packed blob ID.
+async def _StoreFilePacked(filepath: str, digest: str) -> str:
+    file_key = f'{model.STORAGE_PACKED}:{digest}'
+    blob_id = _LiveBlobId(file_key, model.STORAGE_PACKED)
+    if blob_id:
+        return blob_id
+
+    with open(filepath, 'rb') as f:
+        data = await asyncio.to_thread(f.read)
+    blob_id = packing.PackedBlobId(*await _Packer().add(data))
+    await asyncio.to_thread(GetDigestIndex().record, file_key, blob_id)
+    return blob_id
+
+
+# Returns the storage a file is stored with in mode `storage`: in packed
+# mode files larger than PACK_THRESHOLD are stored as plain blobs.
+def _Layout(filepath: str, storage: str) -> str:
+    if storage not in (model.STORAGE_BLOB, model.STORAGE_CHUNKED,
+                       model.STORAGE_PACKED):
+        raise ValueError(f'Unknown storage mode {storage}')
+    if (storage == model.STORAGE_PACKED and
+            os.path.getsize(filepath) > PACK_THRESHOLD):
+        return model.STORAGE_BLOB
+    return storage
+
+
+# Stores a file to Walrus unless identical content was stored before.
+# `storage` is a layout returned by _Layout.  Returns the blob ID.
+async def _StoreFile(filepath: str, digest: str, storage: str) -> str:
+    if storage == model.STORAGE_PACKED:
+        return await _StoreFilePacked(filepath, digest)
+    if storage == model.STORAGE_CHUNKED:
+        return await _StoreFileChunked(filepath, digest)
+    return await _StoreContent(
+        digest,
+        lambda: GetTransport().async_store(
+            filepath, epochs=blob_lifetime.INITIAL_EPOCHS))
+
+
+# Seals a file into a temporary file.  Returns the temporary file's path.
+def _SealFile(filepath: str, digest: str, key: bytes) -> str:
+    fd, sealed_path = tempfile.mkstemp(prefix='sealed-')
+    try:
+        with metrics.Stage('seal'), os.fdopen(fd, 'wb') as out:
+            sealing.SealFile(filepath, out, digest, key)
+    except BaseException:
+        os.remove(sealed_path)
+        raise
+    return sealed_path
+
+
+# Stores an uploaded file of `client_id`, sealed first unless
+# sealing.SEAL_MODE is off.  Chunked files are sealed chunk by chunk; blob
+# and packed files as a whole (the pack threshold applies to the plaintext
+# size).  Returns (blob ID, storage, sealed_for).
+async def _StoreUpload(filepath: str, client_id: str, storage: str) -> tuple:
+    storage = _Layout(filepath, storage)
+    digest = await asyncio.to_thread(digest_index.FileDigest, filepath)
+    if sealing.SEAL_MODE == sealing.SEAL_NONE:
+        return await _StoreFile(filepath, digest, storage), storage, None
+    key = await asyncio.to_thread(_SealKey, client_id)
+    if storage == model.STORAGE_CHUNKED:
+        blob_id = await _StoreFileChunked(filepath, digest, (client_id, key))
+        return blob_id, storage, client_id
+
+    file_key = _SealedKey(storage, client_id, digest)
+    blob_id = _LiveBlobId(file_key, storage)
+    if blob_id:
+        return blob_id, storage, client_id
+    sealed_path = await asyncio.to_thread(_SealFile, filepath, digest, key)
+    try:
+        sealed_digest = await asyncio.to_thread(digest_index.FileDigest,
+                                                sealed_path)
+        blob_id = await _StoreFile(sealed_path, sealed_digest, storage)
+    finally:
+        os.remove(sealed_path)
+    await asyncio.to_thread(GetDigestIndex().record, file_key, blob_id)
+    return blob_id, storage, client_id
+
+
+# Creates the version `new_blob_id_str` on top of `based_on_version`.
+# Returns (version, created); if the contract already has that version it is
+# returned as is and nothing is created.  The cached contract is only
+# updated once the new version is committed to the local DB, so versions
+# created but not yet committed by the caller are passed in `pending`, keyed
+# by (contract ID, blob ID).  Blocks on the client repository, so async
+# callers run it in a thread.
+def _NewVersion(client_id: str,
+                based_on_contract,
+                based_on_version,
+                new_blob_id_str: str,
+                storage: str = model.STORAGE_BLOB,
+                pending: dict = None,
+                sealed_for: str = None) -> tuple:
+    key = (based_on_contract.contract_id, new_blob_id_str)
+    if pending is not None and key in pending:
+        logger.debug('version %s already exists', new_blob_id_str)
+        return pending[key], False
+    for contract, version in client_repository.GetRepository().lookup(
+            client_id, new_blob_id_str):
+        if contract.contract_id == based_on_contract.contract_id:
+            logger.debug('version %s already exists', new_blob_id_str)
+            return version, False
+
+    # Create a BlobID object from the returned blob ID
+    new_blob_id = model.BlobID(bid=new_blob_id_str,
+                               timestamp=int(time.time()))
+
+    # Create a new Version object.  Only the parent is stored; the
+    # history is answered by the contract's version graph.
+    new_version = model.Version(
+        blob_id=new_blob_id,
+        initial_blob_data=based_on_version.initial_blob_data,
+        parents=[based_on_version.blob_id],
+        alias=based_on_version.alias,
+        graph=based_on_contract.graph,
+        storage=storage,
+        sealed_for=sealed_for)
+    if pending is not None:
+        pending[key] = new_version
+    return new_version, True
 
 
 # Stores the data to Walrus DB.
+# `storage` overrides STORAGE_MODE for this upload.
 # Returns the Version object that was created/updated.
-def UploadFileOnVersion(filepath: str, client_id: str,
-                        version_id: str) -> model.Version:
-    print(
-        f'Calling UploadFileOnVersion({filepath}, {client_id}, {version_id})')
-
-    # Load the local DB where version information is stored
-    db = local_db.LoadDatabase()
-    print("Loaded DB:", db)
-
-    # Find the client using the client_id
-    client = utils.GetClientById(client_id)
-    print('Client found:', client)
-
-    # Find the base version by searching through the contracts and their versions
-    based_on_version = None
-    for contract in client.contracts:
-        for version in contract.versions:
-            if version.blob_id.bid == version_id:
-                based_on_version = version
-                break
-        if based_on_version:
-            break
+async def async_upload_file_on_version(filepath: str,
+                                       client_id: str,
+                                       version_id: str,
+                                       storage: str = None) -> model.Version:
+    logger.debug('upload file=%s client_id=%s version_id=%s', filepath,
+                 client_id, version_id)
 
-    if not based_on_version:
-        raise ValueError(
-            f'Base version with version_id {version_id} not found.')
+    # Find the base version through the client repository
+    based_on_contract, based_on_version = await asyncio.to_thread(
+        _FindBaseVersion, client_id, version_id)
 
-    print('based_on_version=', based_on_version)
+    storage = storage or STORAGE_MODE
 
     # Upload file to Walrus and get the new BlobID
     try:
-        store_json_command = f"""{{ "config" : "{PATH_TO_WALRUS_CONFIG}",
-          "command" : {{ "store" :
-          {{ "file" : "{filepath}", "epochs" : 2  }}}}
-        }}"""
-        print(f'Running command: {store_json_command}')
-        result = subprocess.run(
-            [PATH_TO_WALRUS, "json"],
-            text=True,
-            capture_output=True,
-            input=store_json_command,
-        )
-
-        # Ensure the subprocess ran successfully
-        if result.returncode != 0:
-            raise RuntimeError(
-                f"Error storing file in Walrus: {result.stderr}")
-
-        print(result.stdout.strip())
-
-        # Parse the JSON result
-        json_result_dict = json.loads(result.stdout.strip())
-
-        # Extract the BlobID from the Walrus response
-        newly_created = json_result_dict.get("newlyCreated", None)
-        if not newly_created:
-          print("Already exist. skip ")
-          already_certified = json_result_dict.get("alreadyCertified", None)
-          bid = already_certified.get("blobId")
-          return model.Version(model.BlobID(bid, 0), None, None, "Already eixsts")
-
-        new_blob_id_str = newly_created.get("blobObject").get("blobId")
-
-        if not new_blob_id_str:
-            raise ValueError("No BlobID found in Walrus response")
-
-        print(f'New BlobID {new_blob_id_str}')
-
-        # Create a BlobID object from the returned blob ID
-        new_blob_id = model.BlobID(
-            bid=new_blob_id_str, timestamp=0)
-
-        # Create a new Version object
-        new_version = model.Version(
-            blob_id=new_blob_id,
-            initial_blob_data=based_on_version.initial_blob_data,
-            previous_versions=based_on_version.previous_versions +
-            [based_on_version.blob_id],
-            alias=based_on_version.alias)
-
-        # Add the new version to the corresponding contract
-        for contract in client.contracts:
-            if based_on_version in contract.versions:
-                contract.versions.append(new_version)
-                break
+        new_blob_id_str, storage, sealed_for = await _StoreUpload(
+            filepath, client_id, storage)
+        logger.debug('stored file=%s blob_id=%s', filepath, new_blob_id_str)
+
+        new_version, created = await asyncio.to_thread(
+            _NewVersion,
+            client_id,
+            based_on_contract,
+            based_on_version,
+            new_blob_id_str,
+            storage,
+            sealed_for=sealed_for)
+        if created:
+            # Append the new version to the base version's contract.  Only
+            # that contract's rows are written.
+            record = new_version.to_record()
+            try:
+                await asyncio.to_thread(local_db.AddVersion, client_id,
+                                        based_on_contract.contract_id,
+                                        record)
+            except local_db.VersionExists:
+                # A concurrent upload of the same content added it first;
+                # return that version.
+                new_version, created = await asyncio.to_thread(
+                    _NewVersion,
+                    client_id,
+                    based_on_contract,
+                    based_on_version,
+                    new_blob_id_str,
+                    storage,
+                    sealed_for=sealed_for)
+                if created:
+                    raise
+                return new_version
+            new_version.sequence = record['sequence']
+            logger.info('new version client_id=%s contract_id=%s blob_id=%s',
+                        client_id, based_on_contract.contract_id,
+                        new_blob_id_str)
+        return new_version
+    except Exception as e:
+        logger.warning('upload of %s failed: %s', filepath, e)
+        raise
 
-        # Replace the old client with the updated client in the database
-        db['clients'] = [c if c['client_id'] != client_id else client.to_dict() for c in db['clients']]
 
+def UploadFileOnVersion(filepath: str,
+                        client_id: str,
+                        version_id: str,
+                        storage: str = None) -> model.Version:
+    return _RunSync(
+        async_upload_file_on_version(filepath, client_id, version_id,
+                                     storage))
+
+
+# Sets the version of each stored item of a batch upload, reusing the
+# versions that exist.  `bases` and `blob_ids` map item indexes to their base
+# (contract, version) and to their (blob ID, storage, sealed_for).  Returns
+# the records of the new versions, as AddVersions takes them, and the
+# indexes of their items.
+async def _NewVersions(results: list[model.UploadResult], bases: dict,
+                       blob_ids: dict) -> tuple:
+    new_records = []
+    created_items = []
+    pending = {}
+    for i in sorted(blob_ids):
+        based_on_contract, based_on_version = bases[i]
+        blob_id, item_storage, sealed_for = blob_ids[i]
+        version, created = await asyncio.to_thread(
+            _NewVersion, results[i].client_id, based_on_contract,
+            based_on_version, blob_id, item_storage,
+            pending.setdefault(results[i].client_id, {}), sealed_for)
+        results[i].version = version
+        if created:
+            new_records.append((results[i].client_id,
+                                based_on_contract.contract_id,
+                                version.to_record()))
+            created_items.append(i)
+    return new_records, created_items
+
+
+# Uploads many files at once.  `items` is a list of
+# (filepath, client_id, version_id) tuples with the same meaning as the
+# arguments of UploadFileOnVersion.
+#
+# Base versions are looked up in the client repository, up to `max_workers`
+# files are stored concurrently, and all new versions are written to the
+# local DB in one transaction.  A failing item does not abort the others.
+# Returns one model.UploadResult per item, in order.
+async def async_upload_files_on_versions(
+        items: list[tuple],
+        max_workers: int = 8,
+        storage: str = None) -> list[model.UploadResult]:
+    logger.debug('batch upload of %d files', len(items))
+    storage = storage or STORAGE_MODE
+    results = [
+        model.UploadResult(filepath, client_id, version_id)
+        for filepath, client_id, version_id in items
+    ]
+
+    # Find every base version.
+    bases = {}
+    for i, result in enumerate(results):
+        try:
+            bases[i] = await asyncio.to_thread(_FindBaseVersion,
+                                               result.client_id,
+                                               result.version_id)
+        except Exception as e:
+            result.error = e
+
+    # Store all files concurrently.
+    workers = asyncio.Semaphore(max_workers)
+
+    async def store(i):
+        async with workers:
+            return await _StoreUpload(results[i].filepath,
+                                      results[i].client_id, storage)
+
+    indexes = list(bases)
+    # Index -> (blob ID, storage, sealed_for)
+    blob_ids = {}
+    for i, outcome in zip(
+            indexes, await asyncio.gather(*[store(i) for i in indexes],
+                                          return_exceptions=True)):
+        if isinstance(outcome, asyncio.CancelledError):
+            raise outcome
+        if isinstance(outcome, Exception):
+            logger.warning('upload of %s failed: %s', results[i].filepath,
+                           outcome)
+            results[i].error = outcome
+        else:
+            blob_ids[i] = outcome
+
+    # Apply all new versions in one DB write.
+    new_records, created_items = await _NewVersions(results, bases, blob_ids)
+    try:
+        try:
+            await asyncio.to_thread(local_db.AddVersions, new_records)
+        except local_db.VersionExists:
+            # A concurrent upload added some of them first, and the write
+            # was rejected as a whole.  Look the versions up again and only
+            # write the remaining ones.
+            new_records, created_items = await _NewVersions(
+                results, bases, blob_ids)
+            await asyncio.to_thread(local_db.AddVersions, new_records)
+    except Exception as e:
+        logger.warning('saving %d new versions failed: %s',
+                       len(new_records), e)
+        for i in created_items:
+            results[i].version = None
+            results[i].error = e
+    else:
+        for i, (_, _, record) in zip(created_items, new_records):
+            results[i].version.sequence = record['sequence']
 
-        # Save the updated database
-        local_db.SaveDatabase(db)
-        print(f"New version stored with BlobID: {new_blob_id_str}")
+    return results
 
-    except Exception as e:
-        print(f"Error during upload: {e}")
-        raise
 
-    return new_version
+def UploadFilesOnVersions(items: list[tuple],
+                          max_workers: int = 8,
+                          storage: str = None) -> list[model.UploadResult]:
+    return _RunSync(
+        async_upload_files_on_versions(items, max_workers, storage))
+
+
+# Returns a cache entry as a read-only mmap, filling it on a miss by
+# awaiting `write(tmp_path)`.
+async def _CachedOrWrite(key: str, write):
+    cache = GetBlobCache()
+    data = await asyncio.to_thread(cache.get, key)
+    if data is not None:
+        return data
+    tmp_path = cache.temp_path()
+    try:
+        await write(tmp_path)
+        return await asyncio.to_thread(cache.commit, key, tmp_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Returns a single blob as a read-only mmap, from the blob cache when
+# possible.
+async def _FetchBlob(bid: str):
+
+    async def read(path):
+        async with _Semaphore():
+            await GetTransport().async_read(bid, path)
+
+    return await _CachedOrWrite(bid, read)
+
+
+# Returns a packed file as a slice of its pack.  The whole pack is fetched
+# and cached once, so the other files packed with it are then read locally;
+# the slice only touches the pages of the cached pack it covers.
+async def _FetchPacked(bid: str):
+    pack_blob_id, offset, length = packing.ParsePackedBlobId(bid)
+    pack = await _FetchBlob(pack_blob_id)
+    if offset + length > len(pack):
+        raise ValueError(f'Pack {pack_blob_id} is too short for {bid}')
+    return memoryview(pack)[offset:offset + length]
+
+
+# Writes the content of a version to the binary file object `out`.  Chunked
+# versions are reassembled by streaming their chunks in order and sealed
+# versions are unsealed frame by frame, so the whole file is never held in
+# memory.
+async def async_stream_file_by_version(version: model.Version, out) -> None:
+    if version.sealed_for is None:
+        await _StreamStored(version, out)
+        return
+    tenant = version.sealed_for
+
+    def key(_):
+        return sealing.TenantKey(tenant)
+
+    if version.storage == model.STORAGE_CHUNKED:
+        manifest = await _FetchBlob(version.blob_id.bid)
+        if chunking.ChunksSealed(manifest):
+            # Each chunk was sealed on its own.
+            async for chunk in _IterChunks(manifest):
+                unsealer = sealing.Unsealer(out, key)
+                await asyncio.to_thread(unsealer.write, chunk)
+                unsealer.close()
+            return
+    unsealer = sealing.Unsealer(out, key)
+    await _StreamStored(version, unsealer)
+    unsealer.close()
+
+
+# Yields the chunks a manifest lists, in order.
+async def _IterChunks(manifest):
+    for chunk_blob_id, length in chunking.ParseManifest(manifest):
+        chunk = await _FetchBlob(chunk_blob_id)
+        if len(chunk) != length:
+            raise ValueError(f'Chunk {chunk_blob_id} has the wrong length')
+        yield chunk
+
+
+# Writes the content of a version as stored in Walrus to `out`.
+async def _StreamStored(version: model.Version, out) -> None:
+    if version.storage == model.STORAGE_BLOB:
+        await asyncio.to_thread(out.write, await _FetchBlob(version.blob_id.bid))
+        return
+    if version.storage == model.STORAGE_PACKED:
+        await asyncio.to_thread(out.write, await _FetchPacked(
+            version.blob_id.bid))
+        return
+    if version.storage != model.STORAGE_CHUNKED:
+        raise ValueError(f'Unknown storage mode {version.storage}')
+    async for chunk in _IterChunks(await _FetchBlob(version.blob_id.bid)):
+        await asyncio.to_thread(out.write, chunk)
+
+
+def StreamFileByVersion(version: model.Version, out) -> None:
+    _RunSync(async_stream_file_by_version(version, out))
 
 
 # Fetch data
-def FetchFileByVersion(version: model.Version) -> bytes:
-    print(f'Fetching file for version with BlobID: {version.blob_id.bid}')
+# Returns the file content as a read-only mmap (bytes-like), or for packed
+# versions a memoryview of one.  Blobs are served from the local blob cache
+# when possible; misses are read from Walrus and added to the cache.
+async def async_fetch_file_by_version(version: model.Version):
+    bid = version.blob_id.bid
+    logger.debug('fetch blob_id=%s', bid)
 
-    # Fetch the data from Walrus based on the blob_id in the version
-    file_data = walrus.read(
-        version.blob_id.bid)  # Assuming walrus.read fetches the file by BlobID
+    if version.sealed_for is None:
+        if version.storage == model.STORAGE_BLOB:
+            return await _FetchBlob(bid)
+        if version.storage == model.STORAGE_PACKED:
+            return await _FetchPacked(bid)
 
-    return file_data
+    # Reassembled and unsealed files are cached too, under a key that cannot
+    # collide with a blob ID.
+    async def write(path):
+        with open(path, 'wb') as out:
+            await async_stream_file_by_version(version, out)
 
+    key = f'{bid}.{version.storage}'
+    if version.sealed_for is not None:
+        key += '.unsealed'
+    return await _CachedOrWrite(key, write)
 
-# Queries the data by blobid and query options.
-# Returns a list of the Versions that match the query criteria.
-def QueryVersions(version: model.Version,
-                  query_options: model.QueryOptions) -> list[model.Version]:
-    print(f'Querying versions based on options: {query_options}')
-
-    # Load the local DB where version information is stored
-    db = local_db.LoadDatabase()
-
-    # Filter versions by timestamp (before/after)
-    if query_options.query_by_time:
-        before = query_options.query_by_time.before
-        after = query_options.query_by_time.after
-        versions_by_time = [
-            v for v in db['versions']
-            if (before is None or v.blob_id.timestamp <= before) and (
-                after is None or v.blob_id.timestamp >= after)
-        ]
-    else:
-        versions_by_time = db['versions']
-
-    # Filter versions by incremental version number
-    if query_options.query_by_version is not None:
-        versions_by_version = [
-            v for v in versions_by_time
-            if v.blob_id.version == query_options.query_by_version
-        ]
-    else:
-        versions_by_version = versions_by_time
 
+def FetchFileByVersion(version: model.Version):
+    return _RunSync(async_fetch_file_by_version(version))
+
+
+# Stores in-memory data that is not a file version, e.g. a batch of
+# signatures.  Returns the blob ID.
+async def async_store_bytes(data: bytes) -> str:
+    return await _StoreBytes(data)
+
+
+def StoreBytes(data: bytes) -> str:
+    return _RunSync(async_store_bytes(data))
+
+
+# Returns the content of a blob as a read-only mmap, from the blob cache
+# when possible.
+async def async_fetch_blob(bid: str):
+    return await _FetchBlob(bid)
+
+
+def FetchBlob(bid: str):
+    return _RunSync(async_fetch_blob(bid))
+
+
+# Queries the data by blobid and query options.
+# Returns the versions of the contract(s) `version` belongs to that match the
+# query criteria, ordered by time, as a model.QueryPage.  With
+# `query_options.limit` set, pass the page's `next_cursor` as
+# `query_options.cursor` to get the next page.
+async def async_query_versions(
+        version: model.Version,
+        query_options: model.QueryOptions) -> model.QueryPage:
+    logger.debug('query versions of %s', version.blob_id.bid)
+
+    # Find every contract with this version.  The same blob can be a version
+    # of several clients.
+    contracts = []
+    with metrics.Stage('lookup'):
+        located = await asyncio.to_thread(
+            client_repository.GetRepository().locate, version.blob_id.bid)
+    for client, contract, _ in located:
+        if (client.client_id, contract) not in contracts:
+            contracts.append((client.client_id, contract))
+
+    # Filter by time range and version number with the contracts' indexes.
     # TODO: Add AI-based filtering or keyword matching
+    page = client_repository.QueryContracts(contracts, query_options)
+    return model.QueryPage(
+        [v for _, _, versions in page for v in versions], page.next_cursor)
+
 
-    # Return the filtered versions
-    return versions_by_version
+def QueryVersions(version: model.Version,
+                  query_options: model.QueryOptions) -> model.QueryPage:
+    return _RunSync(async_query_versions(version, query_options))
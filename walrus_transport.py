@@ -0,0 +1,730 @@
+# Transports used to talk to Walrus.
+#
+# Every transport exposes the same two operations:
+#   store(filepath, epochs) -> the Walrus JSON reply as a dict, i.e.
+#       {"newlyCreated": {...}} or {"alreadyCertified": {...}}
+#   store_bytes(data, epochs) -> the same for in-memory data
+#   read(blob_id, out_path) -> writes the blob content to out_path
+#   extend(blob_object_id, epochs) -> extends a stored blob's lifetime
+#   extend_blobs([(blob_object_id, epochs)]) -> the same for many blobs
+# and asyncio counterparts async_store, async_store_bytes and async_read.
+# The async methods of the built-in transports do their I/O on the event
+# loop (asyncio subprocesses and streams); a transport that only implements
+# the blocking methods gets async ones that run them in a thread.
+#
+# SubprocessTransport shells out to `walrus json` once per call.  It is the
+# slow but dependency free fallback.  HttpTransport talks to a Walrus
+# publisher/aggregator over pooled keep-alive connections, so the per-call
+# cost is one HTTP round trip instead of a process startup.
+import asyncio
+import http.client
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Read/write block size when streaming files over HTTP.
+_BLOCK_SIZE = 64 * 1024
+# Most `walrus json` extend processes SubprocessTransport runs at once.
+EXTEND_CONCURRENCY = int(os.environ.get('WALRUS_EXTEND_CONCURRENCY', 8))
+
+
+class TransportError(RuntimeError):
+    pass
+
+
+# Tasks waiting for their event loop to shut down; see CallOnLoopShutdown.
+_shutdown_tasks = set()
+
+
+# Calls `callback(loop)` on the running event loop when it shuts down, i.e.
+# when asyncio.run() cancels the tasks left at its end.  Used to drop state
+# kept per event loop, which would otherwise outlive the loop.  Cancelling
+# the returned task runs the callback early.
+def CallOnLoopShutdown(callback) -> asyncio.Task:
+    loop = asyncio.get_running_loop()
+
+    async def wait():
+        try:
+            await loop.create_future()
+        except asyncio.CancelledError:
+            callback(loop)
+            raise
+
+    task = loop.create_task(wait())
+    _shutdown_tasks.add(task)
+    task.add_done_callback(_shutdown_tasks.discard)
+    return task
+
+
+# Parses a Walrus JSON reply.
+def _ParseReply(reply) -> dict:
+    with metrics.Stage('json_parse'):
+        return json.loads(reply)
+
+
+class WalrusTransport(object):
+
+    def store(self, filepath: str, epochs: int) -> dict:
+        raise NotImplementedError()
+
+    # Stores in-memory data.  Transports that can only store files go
+    # through a temporary file.
+    def store_bytes(self, data: bytes, epochs: int) -> dict:
+        fd, tmp_path = tempfile.mkstemp(prefix='walrus-store-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return self.store(tmp_path, epochs)
+        finally:
+            os.remove(tmp_path)
+
+    def read(self, blob_id: str, out_path: str) -> None:
+        raise NotImplementedError()
+
+    # `blob_object_id` is the Sui object of the blob, from the store reply.
+    def extend(self, blob_object_id: str, epochs: int) -> None:
+        raise TransportError(f'{type(self).__name__} cannot extend blobs')
+
+    # Extends many blobs, given as (blob object ID, epochs) pairs.  Returns
+    # the error of each blob object that could not be extended.
+    def extend_blobs(self, extensions: list[tuple]) -> dict:
+        errors = {}
+        for blob_object_id, epochs in extensions:
+            try:
+                self.extend(blob_object_id, epochs)
+            except Exception as e:
+                errors[blob_object_id] = e
+        return errors
+
+    async def async_store(self, filepath: str, epochs: int) -> dict:
+        return await asyncio.to_thread(self.store, filepath, epochs)
+
+    async def async_store_bytes(self, data: bytes, epochs: int) -> dict:
+        return await asyncio.to_thread(self.store_bytes, data, epochs)
+
+    async def async_read(self, blob_id: str, out_path: str) -> None:
+        await asyncio.to_thread(self.read, blob_id, out_path)
+
+    def close(self) -> None:
+        pass
+
+
+# Runs one `walrus json` process per call.
+class SubprocessTransport(WalrusTransport):
+
+    def __init__(self, walrus_path: str, config_path: str):
+        self.walrus_path = walrus_path
+        self.config_path = config_path
+
+    def _json_command(self, command: dict) -> str:
+        json_command = json.dumps({
+            "config": self.config_path,
+            "command": command
+        })
+        logger.debug('running walrus command %s', json_command)
+        return json_command
+
+    def _run(self, command: dict) -> str:
+        json_command = self._json_command(command)
+        with metrics.Stage('walrus_spawn'):
+            process = subprocess.Popen([self.walrus_path, "json"],
+                                       text=True,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        with process, metrics.Stage('walrus_transfer'):
+            try:
+                stdout, stderr = process.communicate(json_command)
+            except BaseException:
+                process.kill()
+                raise
+        if process.returncode != 0:
+            raise TransportError(f"Error running walrus: {stderr}")
+        return stdout.strip()
+
+    def store(self, filepath: str, epochs: int) -> dict:
+        return _ParseReply(
+            self._run({"store": {
+                "file": filepath,
+                "epochs": epochs
+            }}))
+
+    def read(self, blob_id: str, out_path: str) -> None:
+        self._run({"read": {"blobId": blob_id, "out": out_path}})
+
+    def extend(self, blob_object_id: str, epochs: int) -> None:
+        self._run({
+            "extend": {
+                "blobObjId": blob_object_id,
+                "epochsExtended": epochs
+            }
+        })
+
+    # `walrus json` extends one blob object per command, so the processes
+    # of a batch run side by side, EXTEND_CONCURRENCY at a time.
+    def extend_blobs(self, extensions: list[tuple]) -> dict:
+        return asyncio.run(self._async_extend_blobs(extensions))
+
+    async def _async_extend_blobs(self, extensions: list[tuple]) -> dict:
+        semaphore = asyncio.Semaphore(EXTEND_CONCURRENCY)
+        errors = {}
+
+        async def extend(blob_object_id: str, epochs: int) -> None:
+            async with semaphore:
+                try:
+                    await self._async_run({
+                        "extend": {
+                            "blobObjId": blob_object_id,
+                            "epochsExtended": epochs
+                        }
+                    })
+                except Exception as e:
+                    errors[blob_object_id] = e
+
+        await asyncio.gather(*(extend(*e) for e in extensions))
+        return errors
+
+    # Runs `walrus json` as an asyncio subprocess.  The process is killed if
+    # the calling task is cancelled.
+    async def _async_run(self, command: dict) -> str:
+        json_command = self._json_command(command)
+        with metrics.Stage('walrus_spawn'):
+            process = await asyncio.create_subprocess_exec(
+                self.walrus_path,
+                "json",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        try:
+            with metrics.Stage('walrus_transfer'):
+                stdout, stderr = await process.communicate(
+                    json_command.encode('utf-8'))
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        if process.returncode != 0:
+            raise TransportError(
+                f"Error running walrus: {stderr.decode('utf-8', 'replace')}")
+        return stdout.decode('utf-8').strip()
+
+    async def async_store(self, filepath: str, epochs: int) -> dict:
+        return _ParseReply(await self._async_run(
+            {"store": {
+                "file": filepath,
+                "epochs": epochs
+            }}))
+
+    # `walrus json` only stores files, so the data goes through a temporary
+    # file written off the event loop.
+    async def async_store_bytes(self, data: bytes, epochs: int) -> dict:
+
+        def write() -> str:
+            fd, tmp_path = tempfile.mkstemp(prefix='walrus-store-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return tmp_path
+
+        tmp_path = await asyncio.to_thread(write)
+        try:
+            return await self.async_store(tmp_path, epochs)
+        finally:
+            os.remove(tmp_path)
+
+    async def async_read(self, blob_id: str, out_path: str) -> None:
+        await self._async_run({"read": {"blobId": blob_id, "out": out_path}})
+
+
+# A small pool of keep-alive HTTP connections to one host.
+class _ConnectionPool(object):
+
+    def __init__(self, url: str, size: int, timeout: float):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == 'https':
+            self._connection_class = http.client.HTTPSConnection
+        elif parsed.scheme == 'http':
+            self._connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError(f'Unsupported URL: {url}')
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _acquire(self) -> http.client.HTTPConnection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connection_class(self.host,
+                                          self.port,
+                                          timeout=self.timeout)
+
+    def _release(self, conn: http.client.HTTPConnection) -> None:
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    # Sends one request and hands the response to `consume`.  A pooled
+    # connection may have been closed by the server while idle, so a request
+    # that fails before any response arrived is retried once on a fresh
+    # connection.  `rewind` resets a streamed body before the retry.
+    def request(self, method, path, consume, body=None, headers=None,
+                rewind=None):
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.request(method, self.base_path + path, body=body,
+                             headers=headers or {})
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                conn.close()
+                if attempt == 1:
+                    raise
+                if rewind:
+                    rewind()
+                continue
+            except Exception:
+                conn.close()
+                raise
+            try:
+                result = consume(response)
+                # The body must be fully drained before the connection can
+                # be reused.
+                response.read()
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return result
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# The body of an HTTP response read from an asyncio stream.
+class _AsyncResponseBody(object):
+
+    def __init__(self, reader: asyncio.StreamReader, headers: dict):
+        self._reader = reader
+        self._chunked = 'chunked' in headers.get('transfer-encoding', '')
+        length = headers.get('content-length')
+        self._remaining = int(length) if length is not None else None
+        self._done = False
+
+    # Yields the body in blocks.
+    async def iter_blocks(self):
+        reader = self._reader
+        if self._chunked:
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Trailers end with an empty line.
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    break
+                while size:
+                    block = await reader.read(min(size, _BLOCK_SIZE))
+                    if not block:
+                        raise ConnectionError('Connection closed mid-body')
+                    size -= len(block)
+                    yield block
+                await reader.readline()
+        elif self._remaining is not None:
+            while self._remaining:
+                block = await reader.read(min(self._remaining, _BLOCK_SIZE))
+                if not block:
+                    raise ConnectionError('Connection closed mid-body')
+                self._remaining -= len(block)
+                yield block
+        else:
+            while True:
+                block = await reader.read(_BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+        self._done = True
+
+    async def read(self) -> bytes:
+        return b''.join([block async for block in self.iter_blocks()])
+
+    async def drain(self) -> None:
+        if not self._done:
+            async for _ in self.iter_blocks():
+                pass
+
+
+# The asyncio counterpart of _ConnectionPool.  Streams are bound to the event
+# loop that opened them, so each loop gets its own pool.
+class _AsyncConnectionPool(object):
+
+    def __init__(self, url: str, size: int, timeout: float):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported URL: {url}')
+        self.ssl = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.ssl else 80)
+        self.base_path = parsed.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+
+    # Sends one request and returns `await consume(status, body)`.  `body`
+    # is bytes or an async callable that writes the body to a StreamWriter.
+    # Like _ConnectionPool.request, a failure on a reused connection before
+    # the response arrived is retried once on a fresh connection.
+    async def request(self, method, path, consume, body=b'', headers=None):
+        for attempt in range(2):
+            reused = bool(self._idle)
+            if reused:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host,
+                                            self.port,
+                                            ssl=self.ssl or None),
+                    self.timeout)
+            try:
+                return await asyncio.wait_for(
+                    self._exchange(reader, writer, method, path, consume,
+                                   body, headers or {}), self.timeout)
+            except (ConnectionResetError, BrokenPipeError,
+                    asyncio.IncompleteReadError) as e:
+                writer.close()
+                if not reused or attempt == 1 or getattr(
+                        e, 'response_started', False):
+                    raise
+            except BaseException:
+                # Includes cancellation: the connection is in an unknown
+                # state and cannot be reused.
+                writer.close()
+                raise
+
+    async def _exchange(self, reader, writer, method, path, consume, body,
+                        headers):
+        host = self.host if self.port in (80, 443) else (
+            f'{self.host}:{self.port}')
+        lines = [f'{method} {self.base_path}{path} HTTP/1.1', f'Host: {host}']
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+        lines.extend(f'{k}: {v}' for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            writer.write(body)
+        else:
+            await body(writer)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        response_body = _AsyncResponseBody(reader, response_headers)
+        try:
+            result = await consume(status, response_body)
+            await response_body.drain()
+        except (ConnectionResetError, BrokenPipeError,
+                asyncio.IncompleteReadError) as e:
+            e.response_started = True
+            raise
+        keep_alive = (response_headers.get('connection', '').lower() !=
+                      'close' and ('content-length' in response_headers or
+                                   'transfer-encoding' in response_headers))
+        if keep_alive and len(self._idle) < self.size:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return result
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+# Talks to a Walrus publisher (stores) and aggregator (reads) over HTTP.
+class HttpTransport(WalrusTransport):
+
+    def __init__(self,
+                 publisher_url: str,
+                 aggregator_url: str = None,
+                 pool_size: int = 8,
+                 timeout: float = 300):
+        self.publisher_url = publisher_url
+        self.aggregator_url = aggregator_url or publisher_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._publisher = _ConnectionPool(publisher_url, pool_size, timeout)
+        self._aggregator = _ConnectionPool(self.aggregator_url, pool_size,
+                                           timeout)
+        # Event loop -> (publisher pool, aggregator pool, shutdown task).
+        # Entries are dropped when their loop shuts down.
+        self._async_pools = {}
+
+    @staticmethod
+    def _check(response: http.client.HTTPResponse) -> None:
+        if response.status != 200:
+            raise TransportError(
+                f'Walrus HTTP error {response.status}: '
+                f'{response.read().decode("utf-8", "replace")}')
+
+    @classmethod
+    def _consume_store(cls, response) -> bytes:
+        cls._check(response)
+        return response.read()
+
+    def store_bytes(self, data: bytes, epochs: int) -> dict:
+        with metrics.Stage('walrus_transfer'):
+            reply = self._publisher.request(
+                'PUT',
+                f'/v1/store?epochs={epochs}',
+                self._consume_store,
+                body=bytes(data),
+                headers={'Content-Type': 'application/octet-stream'})
+        return _ParseReply(reply)
+
+    def store(self, filepath: str, epochs: int) -> dict:
+        with open(filepath, 'rb') as f:
+            headers = {
+                'Content-Length': str(os.fstat(f.fileno()).st_size),
+                'Content-Type': 'application/octet-stream',
+            }
+            with metrics.Stage('walrus_transfer'):
+                reply = self._publisher.request('PUT',
+                                                f'/v1/store?epochs={epochs}',
+                                                self._consume_store,
+                                                body=f,
+                                                headers=headers,
+                                                rewind=lambda: f.seek(0))
+        return _ParseReply(reply)
+
+    def read(self, blob_id: str, out_path: str) -> None:
+
+        def consume(response):
+            self._check(response)
+            with open(out_path, 'wb') as out:
+                shutil.copyfileobj(response, out, _BLOCK_SIZE)
+
+        with metrics.Stage('walrus_transfer'):
+            self._aggregator.request('GET',
+                                     f'/v1/{urllib.parse.quote(blob_id)}',
+                                     consume)
+
+    def _pools(self) -> tuple:
+        loop = asyncio.get_running_loop()
+        entry = self._async_pools.get(loop)
+        if entry is None:
+            pools = (_AsyncConnectionPool(self.publisher_url, self.pool_size,
+                                          self.timeout),
+                     _AsyncConnectionPool(self.aggregator_url,
+                                          self.pool_size, self.timeout))
+            entry = pools + (CallOnLoopShutdown(
+                lambda loop: self._drop_pools(loop, pools)), )
+            self._async_pools[loop] = entry
+        return entry[:2]
+
+    # Closes a loop's pools.  Runs on that loop.
+    def _drop_pools(self, loop: asyncio.AbstractEventLoop,
+                    pools: tuple) -> None:
+        if self._async_pools.get(loop, ())[:2] == pools:
+            del self._async_pools[loop]
+        for pool in pools:
+            pool.close()
+
+    @staticmethod
+    async def _async_check(status: int, body: _AsyncResponseBody) -> None:
+        if status != 200:
+            raise TransportError(
+                f'Walrus HTTP error {status}: '
+                f'{(await body.read()).decode("utf-8", "replace")}')
+
+    @classmethod
+    async def _async_consume_store(cls, status, body) -> bytes:
+        await cls._async_check(status, body)
+        return await body.read()
+
+    async def async_store_bytes(self, data: bytes, epochs: int) -> dict:
+        with metrics.Stage('walrus_transfer'):
+            reply = await self._pools()[0].request(
+                'PUT',
+                f'/v1/store?epochs={epochs}',
+                self._async_consume_store,
+                body=bytes(data),
+                headers={'Content-Type': 'application/octet-stream'})
+        return _ParseReply(reply)
+
+    async def async_store(self, filepath: str, epochs: int) -> dict:
+        size = await asyncio.to_thread(os.path.getsize, filepath)
+
+        # Streams the file in blocks; reads happen off the event loop.
+        async def write_body(writer):
+            with open(filepath, 'rb') as f:
+                while True:
+                    block = await asyncio.to_thread(f.read, _BLOCK_SIZE)
+                    if not block:
+                        return
+                    writer.write(block)
+                    await writer.drain()
+
+        with metrics.Stage('walrus_transfer'):
+            reply = await self._pools()[0].request(
+                'PUT',
+                f'/v1/store?epochs={epochs}',
+                self._async_consume_store,
+                body=write_body,
+                headers={
+                    'Content-Length': str(size),
+                    'Content-Type': 'application/octet-stream',
+                })
+        return _ParseReply(reply)
+
+    async def async_read(self, blob_id: str, out_path: str) -> None:
+
+        async def consume(status, body):
+            await self._async_check(status, body)
+            with open(out_path, 'wb') as out:
+                async for block in body.iter_blocks():
+                    await asyncio.to_thread(out.write, block)
+
+        with metrics.Stage('walrus_transfer'):
+            await self._pools()[1].request(
+                'GET', f'/v1/{urllib.parse.quote(blob_id)}', consume)
+
+    def close(self) -> None:
+        self._publisher.close()
+        self._aggregator.close()
+        # Streams can only be closed on their own loop, which may be running
+        # in another thread, so the loop is asked to run the shutdown task
+        # early.  Those of a closed loop are gone already.
+        for loop, (_, _, task) in list(self._async_pools.items()):
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                self._async_pools.pop(loop, None)
+                _shutdown_tasks.discard(task)
+
+
+# Returns True if `e` means the transport could not be reached at all.
+def _Unreachable(e: Exception) -> bool:
+    return (isinstance(e, (ConnectionError, OSError, asyncio.TimeoutError))
+            and not isinstance(e, FileNotFoundError))
+
+
+# Uses `primary` and switches to `fallback` when `primary` cannot be reached.
+# Errors reported by a reachable server are not retried.
+class FallbackTransport(WalrusTransport):
+
+    def __init__(self, primary: WalrusTransport, fallback: WalrusTransport):
+        self.primary = primary
+        self.fallback = fallback
+
+    def _call(self, method: str, *args):
+        try:
+            return getattr(self.primary, method)(*args)
+        except Exception as e:
+            if not _Unreachable(e):
+                raise
+            logger.warning('primary transport unavailable (%s), falling back',
+                           e)
+            return getattr(self.fallback, method)(*args)
+
+    async def _async_call(self, method: str, *args):
+        try:
+            return await getattr(self.primary, method)(*args)
+        except Exception as e:
+            if not _Unreachable(e):
+                raise
+            logger.warning('primary transport unavailable (%s), falling back',
+                           e)
+            return await getattr(self.fallback, method)(*args)
+
+    def store(self, filepath: str, epochs: int) -> dict:
+        return self._call('store', filepath, epochs)
+
+    def store_bytes(self, data: bytes, epochs: int) -> dict:
+        return self._call('store_bytes', data, epochs)
+
+    def read(self, blob_id: str, out_path: str) -> None:
+        self._call('read', blob_id, out_path)
+
+    # The publisher HTTP API cannot extend blobs; the fallback can.
+    def extend(self, blob_object_id: str, epochs: int) -> None:
+        self.fallback.extend(blob_object_id, epochs)
+
+    def extend_blobs(self, extensions: list[tuple]) -> dict:
+        return self.fallback.extend_blobs(extensions)
+
+    async def async_store(self, filepath: str, epochs: int) -> dict:
+        return await self._async_call('async_store', filepath, epochs)
+
+    async def async_store_bytes(self, data: bytes, epochs: int) -> dict:
+        return await self._async_call('async_store_bytes', data, epochs)
+
+    async def async_read(self, blob_id: str, out_path: str) -> None:
+        await self._async_call('async_read', blob_id, out_path)
+
+    def close(self) -> None:
+        self.primary.close()
+        self.fallback.close()
+
+
+_lock = threading.Lock()
+_transport = None
+
+
+# Builds the default transport.  When WALRUS_PUBLISHER_URL is set the HTTP
+# transport is used, with the `walrus` CLI as a fallback.
+def _DefaultTransport(walrus_path: str, config_path: str) -> WalrusTransport:
+    subprocess_transport = SubprocessTransport(walrus_path, config_path)
+    publisher_url = os.environ.get('WALRUS_PUBLISHER_URL')
+    if not publisher_url:
+        return subprocess_transport
+    http_transport = HttpTransport(publisher_url,
+                                   os.environ.get('WALRUS_AGGREGATOR_URL'))
+    return FallbackTransport(http_transport, subprocess_transport)
+
+
+# Returns the process-wide transport, creating it on first use.
+def GetTransport(walrus_path: str, config_path: str) -> WalrusTransport:
+    global _transport
+    with _lock:
+        if _transport is None:
+            _transport = _DefaultTransport(walrus_path, config_path)
+        return _transport
+
+
+# Replaces the process-wide transport, e.g. with an HttpTransport pointed at
+# a fake publisher.  Passing None restores the default on next use.
+def SetTransport(transport: WalrusTransport) -> None:
+    global _transport
+    with _lock:
+        if _transport is not None and _transport is not transport:
+            _transport.close()
+        _transport = transport